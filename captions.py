@@ -1,22 +1,76 @@
-from transformers import BlipProcessor, BlipForConditionalGeneration
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
 from PIL import Image
-import torch
-from functools import lru_cache
-from config import BLIP_MODEL
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import BLIP_MODEL, BLIP_BATCH_SIZE, BLIP_NUM_BEAMS, BLIP_MAX_TOKENS, BLIP_DTYPE
+from db import CaptionCache
+from models import registry
 
-@lru_cache(maxsize=1)
-def _blip():
+def _load_blip():
+    import torch
+    from transformers import BlipProcessor, BlipForConditionalGeneration
     processor = BlipProcessor.from_pretrained(BLIP_MODEL)
     model = BlipForConditionalGeneration.from_pretrained(BLIP_MODEL)
     device = "cpu"
     if torch.backends.mps.is_available():
         device = "mps"
+    if BLIP_DTYPE == "int8" and device == "cpu":
+        # int8 weights for the Linear layers (most of BLIP's compute); activations stay float
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif BLIP_DTYPE == "bf16":
+        model = model.to(torch.bfloat16)
     model.to(device)
+    model.eval()
     return processor, model, device
 
+def caption_images(
+    pil_images: Sequence[Image.Image],
+    batch_size: int = BLIP_BATCH_SIZE,
+    num_beams: int = BLIP_NUM_BEAMS,
+    max_new_tokens: int = BLIP_MAX_TOKENS,
+) -> List[Optional[str]]:
+    """Captions for `pil_images`, `batch_size` images per generate() call."""
+    import torch
+    processor, model, device = registry.get("blip")
+    dtype = next(model.parameters()).dtype if BLIP_DTYPE == "bf16" else torch.float32
+    out: List[Optional[str]] = []
+    for i in range(0, len(pil_images), batch_size):
+        chunk = list(pil_images[i:i + batch_size])
+        inputs = processor(images=chunk, return_tensors="pt")
+        pixel_values = inputs["pixel_values"].to(device, dtype=dtype)
+        with torch.inference_mode():
+            ids = model.generate(pixel_values=pixel_values, max_new_tokens=max_new_tokens, num_beams=num_beams)
+        out.extend(t.strip() or None for t in processor.batch_decode(ids, skip_special_tokens=True))
+    return out
+
 def caption_image(pil_image: Image.Image) -> str:
-    processor, model, device = _blip()
-    inputs = processor(images=pil_image, return_tensors="pt").to(device)
-    out = model.generate(**inputs, max_new_tokens=30)
-    text = processor.decode(out[0], skip_special_tokens=True)
-    return text
+    return caption_images([pil_image])[0]
+
+# ---- caption cache (content hash -> caption) ----
+
+def cached_captions(sess, hashes: Iterable[str]) -> Dict[str, str]:
+    """hash -> caption for the hashes already captioned by the current BLIP_MODEL."""
+    hashes = sorted({h for h in hashes if h})
+    out = {}
+    for i in range(0, len(hashes), 500):
+        rows = sess.execute(
+            select(CaptionCache.hash, CaptionCache.caption)
+            .where(CaptionCache.hash.in_(hashes[i:i + 500]), CaptionCache.model == BLIP_MODEL)
+        ).all()
+        out.update(rows)
+    return out
+
+def remember_captions(sess, pairs: Iterable[Tuple[str, str]]):
+    """Store (hash, caption) pairs; committed with the caller's transaction."""
+    rows = {h: c for h, c in pairs if h and c}
+    if not rows:
+        return
+    stmt = sqlite_insert(CaptionCache).values(
+        [{"hash": h, "model": BLIP_MODEL, "caption": c} for h, c in rows.items()]
+    )
+    sess.execute(stmt.on_conflict_do_update(
+        index_elements=[CaptionCache.hash],
+        set_={"model": stmt.excluded.model, "caption": stmt.excluded.caption},
+    ))
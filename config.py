@@ -10,11 +10,15 @@ DATA_DIR = APP_DIR / "data"
 DATA_DIR.mkdir(exist_ok=True)
 
 CHROMA_DIR = DATA_DIR / "chroma"
+VECTORS_DIR = DATA_DIR / "vectors"  # built-in memory-mapped vector store
 THUMBS_DIR = DATA_DIR / "thumbs"
 THUMBS_DIR.mkdir(exist_ok=True)
 
 SQLITE_PATH = DATA_DIR / "app.db"
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE") or 256 * 1024 * 1024)  # bytes
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB") or 64 * 1024)
 PERSONS_JSON = DATA_DIR / "persons.json"
+FACE_EMB_PATH = DATA_DIR / "face_embeddings.f16"  # memory-mapped, row = faces.id
 
 # ===== Indexing mode =====
 # FULL = vision-heavy (CLIP, BLIP, faces, optional OpenAI tags)
@@ -23,25 +27,125 @@ INDEX_MODE = (os.getenv("INDEX_MODE") or "FULL").strip().upper()
 if INDEX_MODE not in {"FULL", "FAST"}:
     INDEX_MODE = "FULL"
 
+# Ingest pipeline: decode threads and the bound on decoded images waiting for the model stage
+INGEST_DECODE_WORKERS = int(os.getenv("INGEST_DECODE_WORKERS") or min(8, os.cpu_count() or 4))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE") or 64)
+# Multi-process ingest: >1 shards decode + models across this many worker processes (each with its
+# own models and INGEST_WORKER_THREADS threads); this process keeps all writes. 0/1 = in-process.
+INGEST_PROCESSES = int(os.getenv("INGEST_PROCESSES") or 0)
+INGEST_WORKER_THREADS = int(os.getenv("INGEST_WORKER_THREADS") or max(1, (os.cpu_count() or 4) // max(1, INGEST_PROCESSES)))
+# Writer stage: vectors per vector-store call, and attempts before a failing batch fails the run
+VECTOR_CHUNK = int(os.getenv("VECTOR_CHUNK") or 256)
+WRITE_RETRIES = int(os.getenv("WRITE_RETRIES") or 3)
+
+# Content-hash every indexed file so moved/renamed files are recognized by content.
+# Costs one extra read per new file; off by default in FAST mode where (size, mtime) is enough.
+INGEST_CONTENT_HASH = (os.getenv("INGEST_CONTENT_HASH") or ("1" if INDEX_MODE == "FULL" else "0")).strip().lower() in {"1", "true", "yes"}
+
+# Folder scan (see scanner.py): parallel directory listing threads, the per-directory listing cache
+# (an unchanged directory mtime means unchanged names, so the directory isn't read again; its photos
+# are still stat'ed, so files rewritten in place are re-indexed), and comma-separated name globs.
+SCAN_THREADS = int(os.getenv("SCAN_THREADS") or 16)
+SCAN_DIR_CACHE = os.getenv("SCAN_DIR_CACHE", "true").lower() != "false"
+SCAN_INCLUDE = [g.strip() for g in (os.getenv("SCAN_INCLUDE") or "").split(",") if g.strip()]  # empty = all photos
+SCAN_EXCLUDE = [g.strip() for g in (os.getenv("SCAN_EXCLUDE") or ".thumbnails,@eaDir,*.lrdata,#recycle,.Trash-*,$RECYCLE.BIN").split(",") if g.strip()]
+
+# Watch mode (see watcher.py): roots the worker keeps indexed as files change (os.pathsep-separated).
+# Events are applied once WATCH_DEBOUNCE_S pass without new ones, or after WATCH_MAX_WAIT_S at most.
+# WATCH_BACKEND: "auto" (inotify on Linux, else polling), "inotify" or "poll" (every WATCH_POLL_S).
+WATCH_ROOTS = [p for p in (os.getenv("WATCH_ROOTS") or "").split(os.pathsep) if p.strip()]
+WATCH_BACKEND = (os.getenv("WATCH_BACKEND") or "auto").strip().lower()
+WATCH_DEBOUNCE_S = float(os.getenv("WATCH_DEBOUNCE_S") or 2.0)
+WATCH_MAX_WAIT_S = float(os.getenv("WATCH_MAX_WAIT_S") or 30.0)
+WATCH_POLL_S = float(os.getenv("WATCH_POLL_S") or 10.0)
+
+# Duplicate detection (see dedup.py): copies reuse an already indexed image's model outputs
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() != "false"
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE") or 6)  # max Hamming distance (of 64 bits) for a near-duplicate
+SEARCH_COLLAPSE_DUPS = os.getenv("SEARCH_COLLAPSE_DUPS", "false").lower() == "true"
+
+# Vector store backend for CLIP embeddings: "chroma" or "mmap" (built-in, see vectorstore.py)
+VECTOR_BACKEND = (os.getenv("VECTOR_BACKEND") or "chroma").strip().lower()
+if VECTOR_BACKEND not in {"chroma", "mmap"}:
+    VECTOR_BACKEND = "chroma"
+VECTOR_IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE") or 8)  # cells scanned when an IVF index exists
+# mmap store upkeep, done by the worker between jobs (or `python worker.py --maintain`): compact once
+# this share of rows is deleted/superseded; partition into IVF cells from this many live rows (0 = never)
+VECTOR_COMPACT_DEAD_RATIO = float(os.getenv("VECTOR_COMPACT_DEAD_RATIO") or 0.25)
+VECTOR_IVF_MIN_ROWS = int(os.getenv("VECTOR_IVF_MIN_ROWS") or 200_000)
+
+# Models load lazily on first use (models.py). Opt-in background warm-up when the UI starts:
+# "all" or a comma list of clip, blip, faces, openai. Ignored in FAST mode.
+MODEL_WARMUP = [m.strip().lower() for m in (os.getenv("MODEL_WARMUP") or "").split(",") if m.strip()]
+if MODEL_WARMUP == ["all"]:
+    MODEL_WARMUP = ["clip", "blip", "faces", "openai"]
+
 # CLIP model (open_clip)
 CLIP_MODEL = "ViT-B-32"
 CLIP_PRETRAINED = "laion2b_s34b_b79k"
+# Images per CLIP forward pass during FULL ingest
+CLIP_BATCH_SIZE = int(os.getenv("CLIP_BATCH_SIZE") or 16)
 
 # BLIP captioning
 BLIP_MODEL = "Salesforce/blip-image-captioning-base"
+BLIP_MIN_SIDE = 384  # BLIP input resolution; also covers CLIP's 224
+BLIP_BATCH_SIZE = int(os.getenv("BLIP_BATCH_SIZE") or 8)
+BLIP_NUM_BEAMS = int(os.getenv("BLIP_NUM_BEAMS") or 1)  # 1 = greedy decoding
+BLIP_MAX_TOKENS = int(os.getenv("BLIP_MAX_TOKENS") or 30)
+# Weight precision: "fp32", "bf16", or "int8" (dynamic quantization of Linear layers; CPU only)
+BLIP_DTYPE = (os.getenv("BLIP_DTYPE") or "fp32").lower()
+
+# Thumbnails (packed into THUMBS_DIR/pack-*.bin, see thumbstore.py)
+THUMB_MAX_SIDE = 400
+THUMB_PACK_BYTES = int(os.getenv("THUMB_PACK_BYTES") or 256 * 1024 * 1024)
+# the worker rewrites the packs once this share of their bytes belongs to removed photos
+THUMB_COMPACT_DEAD_RATIO = float(os.getenv("THUMB_COMPACT_DEAD_RATIO") or 0.25)
 
 # Face recognition
 FACE_PROVIDER = "onnxruntime"  # or "cpu"
 FACE_DET_SIZE = 640
+FACE_EMB_DIM = 512  # InsightFace recognition embedding size
+# ONNX Runtime threads per face model session (0 = its default, one per core); ingest workers set it
+FACE_ORT_THREADS = int(os.getenv("FACE_ORT_THREADS") or 0)
+# Detector cascade: run face detection only where CLIP's zero-shot "people" probability reaches
+# FACE_GATE_THRESHOLD (lower = more recall, 0 = always detect). Group shots (CLIP says group/crowd,
+# or FACE_GROUP_MIN_FACES found) are re-detected at FACE_DET_SIZE_LARGE (0 = off) for small faces.
+FACE_GATE_THRESHOLD = float(os.getenv("FACE_GATE_THRESHOLD") or 0.15)
+FACE_DET_SIZE_LARGE = int(os.getenv("FACE_DET_SIZE_LARGE") or 1024)
+FACE_GROUP_THRESHOLD = float(os.getenv("FACE_GROUP_THRESHOLD") or 0.5)
+FACE_GROUP_MIN_FACES = int(os.getenv("FACE_GROUP_MIN_FACES") or 4)
+RED_SHIRT_MIN_RATIO = 0.06  # red pixel share of the torso crop that counts as "red shirt"
+# Person matching: score = mean of the best FACE_TOPK reference similarities per person
+FACE_TOPK = int(os.getenv("FACE_TOPK") or 3)
+FACE_MAX_REFS = int(os.getenv("FACE_MAX_REFS") or 50)  # reference embeddings kept per person
 
 SUPPORTED_EXTS = {
     ".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff", ".heic", ".heif"
 }
 
+# Query path
+TEXT_EMB_CACHE_SIZE = int(os.getenv("TEXT_EMB_CACHE_SIZE") or 2048)  # in-memory LRU entries (embeddings, expansions)
+QUERY_CACHE_PERSIST = os.getenv("QUERY_CACHE_PERSIST", "true").lower() != "false"  # also keep them in SQLite
+EXPAND_DEADLINE_S = float(os.getenv("EXPAND_DEADLINE_S") or 0.35)  # OpenAI query expansion is used only if it's back by then
+
+# Place search: offline gazetteer (CSV of place bounding boxes, see geo.py)
+GAZETTEER_PATH = Path(os.getenv("GAZETTEER_PATH") or APP_DIR / "gazetteer.csv")
+
+# Search UI
+UI_PAGE_SIZE = int(os.getenv("UI_PAGE_SIZE") or 30)  # result tiles per page
+UI_MAX_RESULTS = int(os.getenv("UI_MAX_RESULTS") or 200)
+
 # OpenAI (optional)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL_TEXT = "gpt-4o-mini"   # for query expansion
 OPENAI_MODEL_VISION = "gpt-4o-mini" # for tagging
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # e.g. a local stub server for testing
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT") or 60)
+# Vision tagging: parallel requests, average request rate, retries, and upload size
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY") or 8)
+OPENAI_RPM = float(os.getenv("OPENAI_RPM") or 300)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES") or 4)
+OPENAI_UPLOAD_SIDE = int(os.getenv("OPENAI_UPLOAD_SIDE") or 512)
 
 # Flags (auto-downgrade in FAST mode)
 USE_OPENAI_EXPAND_QUERY = True if INDEX_MODE == "FULL" else False
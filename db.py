@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, ForeignKey, UniqueConstraint
+from sqlalchemy import create_engine, event, Index, Column, Integer, String, Float, DateTime, Text, ForeignKey, UniqueConstraint, LargeBinary
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 from pathlib import Path
 from typing import Optional
-from config import SQLITE_PATH
+from functools import lru_cache
+from config import SQLITE_PATH, SQLITE_MMAP_SIZE, SQLITE_CACHE_KB
 from sqlalchemy import text
 
 Base = declarative_base()
@@ -12,12 +13,33 @@ class Image(Base):
     id = Column(Integer, primary_key=True)
     path = Column(Text, unique=True, nullable=False)
     ts = Column(DateTime, nullable=True)  # timestamp
-    gps = Column(String, nullable=True)   # "lat,lon" if available
+    gps = Column(String, nullable=True)   # "lat,lon" if available, "" if the file has none, NULL if not read yet
+    lat = Column(Float, nullable=True)    # decimal degrees, indexed by the images_geo R*Tree (see geo.py)
+    lon = Column(Float, nullable=True)
     width = Column(Integer, nullable=True)
     height = Column(Integer, nullable=True)
     caption = Column(Text, nullable=True) # BLIP caption
     clip_id = Column(String, nullable=True)  # chroma doc id
     tags = Column(Text, nullable=True)  # JSON-encoded list of strings
+    # fingerprint for incremental indexing (see manifest.py)
+    file_size = Column(Integer, nullable=True)
+    file_mtime = Column(Float, nullable=True)
+    content_hash = Column(String, nullable=True)
+    # calendar parts of ts, maintained at ingest so date filters are index lookups
+    year = Column(Integer, nullable=True)
+    month = Column(Integer, nullable=True)
+    day = Column(Integer, nullable=True)
+    # perceptual hashes and duplicate group (pHash of the group's canonical image), see dedup.py
+    phash = Column(Integer, nullable=True)
+    dhash = Column(Integer, nullable=True)
+    dup_group = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index("ix_images_ts", "ts"),
+        Index("ix_images_ymd", "year", "month", "day"),
+        Index("ix_images_md", "month", "day"),
+        Index("ix_images_dup_group", "dup_group"),
+    )
 
     faces = relationship("Face", back_populates="image")
 
@@ -30,17 +52,207 @@ class Face(Base):
     red_ratio = Column(Float, nullable=True)     # heuristic for red shirt in torso crop (0..1)
 
     image = relationship("Image", back_populates="faces")
-    
-def _ensure_migrations(engine):
-    with engine.connect() as conn:
-        info = conn.execute(text("PRAGMA table_info(images)")).fetchall()
-        cols = {row[1] for row in info}  # column names
-        if "tags" not in cols:
-            conn.execute(text("ALTER TABLE images ADD COLUMN tags TEXT"))
-            conn.commit()
+
+class Thumb(Base):
+    """Where a photo's thumbnail lives in the packed thumbnail store (see thumbstore.py)."""
+    __tablename__ = "thumbs"
+    path = Column(Text, primary_key=True)
+    pack = Column(Integer, nullable=False)
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
+
+class Meta(Base):
+    """Small key/value table for app-wide state (e.g. the index generation counter)."""
+    __tablename__ = "meta"
+    key = Column(String, primary_key=True)
+    value = Column(Text, nullable=True)
+
+class CaptionCache(Base):
+    """BLIP caption per image content hash, so re-indexed, moved and duplicate files skip BLIP."""
+    __tablename__ = "caption_cache"
+    hash = Column(String, primary_key=True)
+    model = Column(String, nullable=False)  # captions from another BLIP_MODEL are ignored
+    caption = Column(Text, nullable=False)
+
+class TagCache(Base):
+    """OpenAI vision tags (JSON list) per image content hash."""
+    __tablename__ = "tag_cache"
+    hash = Column(String, primary_key=True)
+    model = Column(String, nullable=False)
+    tags = Column(Text, nullable=False)
+
+class QueryCache(Base):
+    """Per-query results worth keeping across restarts (CLIP text embeddings, query expansions)."""
+    __tablename__ = "query_cache"
+    kind = Column(String, primary_key=True)
+    key = Column(Text, primary_key=True)    # normalized query text
+    model = Column(String, nullable=False)
+    value = Column(LargeBinary, nullable=False)
+
+class DirCache(Base):
+    """Last listing of a scanned directory, reused while its mtime is unchanged (see scanner.py)."""
+    __tablename__ = "dir_cache"
+    path = Column(Text, primary_key=True)
+    mtime_ns = Column(Integer, nullable=False)
+    listing = Column(Text, nullable=False)  # JSON {"files": [[name, size, mtime], ...], "dirs": [name, ...]}
+
+class Job(Base):
+    """Background indexing job (see jobs.py / worker.py)."""
+    __tablename__ = "jobs"
+    id = Column(Integer, primary_key=True)
+    root = Column(Text, nullable=False)     # folder to index ("" for a relabel job)
+    kind = Column(String, nullable=False, default="index")  # index | relabel (re-score faces after enrollment)
+    state = Column(String, nullable=False, default="queued")  # queued|running|paused|done|failed|cancelled
+    control = Column(String, nullable=True)  # request for the worker: "pause" | "resume" | "cancel"
+    phase = Column(String, nullable=True)    # scanning | indexing | reading GPS | relabeling
+    seen = Column(Integer, default=0)        # files found by the scan
+    todo = Column(Integer, default=0)        # new/changed files to index
+    processed = Column(Integer, default=0)   # stored
+    skipped = Column(Integer, default=0)     # unchanged (or moved) files
+    failed = Column(Integer, default=0)      # undecodable files and the files of a batch that could not be written
+    rate = Column(Float, nullable=True)      # photos/sec while indexing
+    eta_s = Column(Float, nullable=True)
+    detail = Column(Text, nullable=True)     # JSON, e.g. face-detection cascade counters
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_jobs_state", "state"),)
+
+def bump_index_generation(sess):
+    """Mark the index as changed; part of the caller's transaction. Readers key caches on it."""
+    sess.execute(text(
+        "INSERT INTO meta (key, value) VALUES ('index_generation', '1') "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT)"
+    ))
+
+def get_index_generation(sess=None) -> int:
+    own = sess is None
+    sess = sess or get_session()
+    try:
+        v = sess.execute(text("SELECT value FROM meta WHERE key = 'index_generation'")).scalar()
+        return int(v or 0)
+    finally:
+        if own:
+            sess.close()
+
+# ---- Schema migrations ----
+# The schema version lives in SQLite's PRAGMA user_version. A fresh database is created straight
+# from the models and stamped with the latest version; an existing one runs every migration newer
+# than its stamp, once, when the engine is first built. Append new steps, never edit old ones.
+# create_all only adds missing *tables*, so new columns and indexes on existing tables go here.
+
+def _add_column(conn, table: str, name: str, ddl: str):
+    cols = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})")).fetchall()}
+    if name not in cols:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+def _m1_tags(conn):
+    _add_column(conn, "images", "tags", "TEXT")
+
+def _m2_fingerprints(conn):
+    _add_column(conn, "images", "file_size", "INTEGER")
+    _add_column(conn, "images", "file_mtime", "FLOAT")
+    _add_column(conn, "images", "content_hash", "VARCHAR")
+
+def _m3_calendar(conn):
+    _add_column(conn, "images", "year", "INTEGER")
+    _add_column(conn, "images", "month", "INTEGER")
+    _add_column(conn, "images", "day", "INTEGER")
+    conn.execute(text(
+        "UPDATE images SET year = CAST(strftime('%Y', ts) AS INTEGER), "
+        "month = CAST(strftime('%m', ts) AS INTEGER), day = CAST(strftime('%d', ts) AS INTEGER) "
+        "WHERE ts IS NOT NULL"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_images_ts ON images (ts)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_images_ymd ON images (year, month, day)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_images_md ON images (month, day)"))
+
+def _m4_fts(conn):
+    import fts
+    fts.create_table(conn)
+    fts.rebuild(conn)
+
+def _m5_dedup(conn):
+    _add_column(conn, "images", "phash", "INTEGER")
+    _add_column(conn, "images", "dhash", "INTEGER")
+    _add_column(conn, "images", "dup_group", "INTEGER")
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_images_dup_group ON images (dup_group)"))
+
+def _m6_geo(conn):
+    import geo
+    _add_column(conn, "images", "lat", "FLOAT")
+    _add_column(conn, "images", "lon", "FLOAT")
+    conn.execute(text(
+        "UPDATE images SET lat = CAST(substr(gps, 1, instr(gps, ',') - 1) AS REAL), "
+        "lon = CAST(substr(gps, instr(gps, ',') + 1) AS REAL) WHERE instr(gps, ',') > 0"
+    ))
+    geo.create_table(conn)
+    geo.rebuild(conn)
+
+def _m7_job_kind(conn):
+    # a database from before background jobs gets the whole table from create_all
+    if conn.execute(text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='jobs'")).first():
+        _add_column(conn, "jobs", "kind", "VARCHAR NOT NULL DEFAULT 'index'")
+
+MIGRATIONS = [
+    (1, _m1_tags),
+    (2, _m2_fingerprints),
+    (3, _m3_calendar),
+    (4, _m4_fts),
+    (5, _m5_dedup),
+    (6, _m6_geo),
+    (7, _m7_job_kind),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _create_virtual_tables(conn):
+    # Not expressible as models, so create_all can't make them on a fresh database.
+    import fts, geo
+    fts.create_table(conn)
+    geo.create_table(conn)
+
+def _migrate(engine):
+    with engine.begin() as conn:
+        fresh = not conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='images'")
+        ).first()
+        version = conn.execute(text("PRAGMA user_version")).scalar() or 0
+        if not fresh:
+            for v, step in MIGRATIONS:
+                if v > version:
+                    step(conn)
+        Base.metadata.create_all(conn)
+        _create_virtual_tables(conn)
+        if fresh or version < SCHEMA_VERSION:
+            conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+
+def _set_sqlite_pragmas(dbapi_conn, _record):
+    # WAL lets search read while ingest writes; NORMAL sync is durable across app crashes in WAL mode.
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.close()
+
+@lru_cache(maxsize=1)
+def get_engine():
+    """Process-wide engine; pragmas are applied per connection and migrations run once here."""
+    engine = create_engine(
+        f"sqlite:///{Path(SQLITE_PATH)}",
+        connect_args={"check_same_thread": False},
+    )
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    _migrate(engine)
+    return engine
+
+@lru_cache(maxsize=1)
+def _session_factory():
+    return sessionmaker(bind=get_engine())
 
 def get_session():
-    engine = create_engine(f"sqlite:///{Path(SQLITE_PATH)}")
-    Base.metadata.create_all(engine)
-    _ensure_migrations(engine)
-    return sessionmaker(bind=engine)()
+    return _session_factory()()
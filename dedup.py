@@ -0,0 +1,145 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+from sqlalchemy import select
+
+from config import DEDUP_MAX_DISTANCE
+from db import Image as ImageRow
+
+# Duplicate and burst detection for ingest.
+#
+# Exact copies (phone backups, exported albums) are found by content hash; near-duplicates (bursts,
+# re-saves, resized copies) by two 64-bit perceptual hashes: pHash (signs of the low-frequency DCT
+# block) looked up in a BK-tree, confirmed with dHash (horizontal gradient signs). Both hashes are
+# computed for a whole batch with array ops. Every image stores its group id (images.dup_group),
+# which is the pHash of the group's canonical image, so search can collapse a group to one hit.
+# Hashes are stored as signed 64-bit ints (SQLite INTEGER).
+
+_MASK = (1 << 64) - 1
+_N = 32  # pHash input side
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * x + 1) * k / (2 * n)).astype(np.float32)
+
+_DCT = _dct_matrix(_N)
+
+def _gray(pils: Sequence[Image.Image], w: int, h: int) -> np.ndarray:
+    return np.stack([np.asarray(p.convert("L").resize((w, h), Image.BILINEAR), dtype=np.float32) for p in pils])
+
+def _pack(bits: np.ndarray) -> List[int]:
+    """(n, 64) bool -> n signed 64-bit ints."""
+    return np.packbits(bits.astype(np.uint8), axis=1).view(">i8").ravel().tolist()
+
+def perceptual_hashes(pils: Sequence[Image.Image]) -> Tuple[List[int], List[int]]:
+    """(phashes, dhashes) for a batch of images."""
+    if not pils:
+        return [], []
+    g = _gray(pils, 9, 8)                               # (n, 8, 9)
+    dh = (g[:, :, 1:] > g[:, :, :-1]).reshape(len(g), 64)
+    x = _gray(pils, _N, _N)                             # (n, 32, 32)
+    c = (_DCT @ x @ _DCT.T)[:, :8, :8].reshape(len(x), 64)
+    med = np.median(c[:, 1:], axis=1, keepdims=True)    # DC term excluded
+    return _pack(c > med), _pack(dh)
+
+def hamming(a: int, b: int) -> int:
+    return ((a ^ b) & _MASK).bit_count()
+
+class BKTree:
+    """Metric tree over 64-bit hashes under Hamming distance."""
+
+    def __init__(self):
+        self.root = None  # node: [hash, value, {distance: child}]
+        self.size = 0
+
+    def add(self, h: int, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [h, value, {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, value, {}]
+                return
+            node = child
+
+    def search(self, h: int, radius: int) -> List[Tuple[int, object]]:
+        """(distance, value) for every entry within `radius` of `h`, nearest first."""
+        out = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                out.append((d, node[1]))
+            for dist, child in node[2].items():
+                if d - radius <= dist <= d + radius:
+                    stack.append(child)
+        out.sort(key=lambda t: t[0])
+        return out
+
+class DedupIndex:
+    """
+    Canonical images known so far (already indexed rows plus this run), by content hash and pHash.
+    A ref is a dict shared by every copy of one canonical: {"group", "image_id"} for indexed rows,
+    {"group"} for images of this run; ingest fills in caption/clip_emb/tags/faces once known.
+    """
+
+    def __init__(self, max_distance: int = DEDUP_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.by_hash: Dict[str, dict] = {}
+        self.tree = BKTree()
+
+    @classmethod
+    def from_db(cls, sess, max_distance: int = DEDUP_MAX_DISTANCE) -> "DedupIndex":
+        idx = cls(max_distance)
+        rows = sess.execute(select(
+            ImageRow.id, ImageRow.content_hash, ImageRow.phash, ImageRow.dhash, ImageRow.dup_group
+        )).all()
+        for id_, h, ph, dh, group in rows:
+            if ph is None and not h:
+                continue
+            ref = {"image_id": id_, "group": group if group is not None else ph}
+            if h and h not in idx.by_hash:
+                idx.by_hash[h] = ref
+            if ph is not None and dh is not None and group == ph:
+                idx.tree.add(ph, (dh, ref))
+        return idx
+
+    def match(self, content_hash: Optional[str], phash: int, dhash: int) -> Tuple[Optional[str], Optional[dict]]:
+        """("exact" | "near", ref) for a known duplicate, (None, None) otherwise."""
+        if content_hash and content_hash in self.by_hash:
+            return "exact", self.by_hash[content_hash]
+        for _, (dh, ref) in self.tree.search(phash, self.max_distance):
+            if hamming(dhash, dh) <= self.max_distance and not ref.get("gone"):
+                return "near", ref
+        return None, None
+
+    def discard(self, rows: Sequence[Tuple[int, Optional[str], Optional[int], Optional[int]]]):
+        """
+        Forget the canonicals among removed (image_id, content_hash, phash, dhash) rows, so an index
+        kept across runs (watch mode) never hands out a deleted image. The BK-tree can't delete, so
+        their refs are marked gone and skipped. Refs of this run (no image_id yet) match on hashes.
+        """
+        for id_, h, ph, dh in rows:
+            ref = self.by_hash.get(h) if h else None
+            if ref is not None and ref.get("image_id", id_) == id_:
+                ref["gone"] = True
+                del self.by_hash[h]
+            if ph is not None and dh is not None:
+                for _, (d, ref) in self.tree.search(ph, 0):
+                    if d == dh and ref.get("image_id", id_) == id_:
+                        ref["gone"] = True
+
+    def add(self, content_hash: Optional[str], phash: int, dhash: int) -> dict:
+        """Register a new canonical image; returns its (still empty) ref."""
+        ref = {"group": phash}
+        if content_hash:
+            self.by_hash[content_hash] = ref
+        self.tree.add(phash, (dhash, ref))
+        return ref
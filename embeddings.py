@@ -1,28 +1,75 @@
+from typing import List, Tuple
 from PIL import Image
-import torch
-import open_clip
 import numpy as np
-from config import CLIP_MODEL, CLIP_PRETRAINED
+from config import CLIP_MODEL, CLIP_PRETRAINED, CLIP_BATCH_SIZE
+from models import registry
+import querycache
 
-_device = "cpu"
-if torch.backends.mps.is_available():
-    _device = "mps"
-elif torch.cuda.is_available():
-    _device = "cuda"
-
-_model, _, _preprocess = open_clip.create_model_and_transforms(CLIP_MODEL, pretrained=CLIP_PRETRAINED, device=_device)
-_tokenizer = open_clip.get_tokenizer(CLIP_MODEL)
+def _load_clip():
+    import torch
+    import open_clip
+    device = "cpu"
+    if torch.backends.mps.is_available():
+        device = "mps"
+    elif torch.cuda.is_available():
+        device = "cuda"
+    model, _, preprocess = open_clip.create_model_and_transforms(CLIP_MODEL, pretrained=CLIP_PRETRAINED, device=device)
+    tokenizer = open_clip.get_tokenizer(CLIP_MODEL)
+    return model, preprocess, tokenizer, device
 
 def image_embedding(pil_image: Image.Image) -> np.ndarray:
-    img = _preprocess(pil_image).unsqueeze(0).to(_device)
-    with torch.no_grad():
-        feat = _model.encode_image(img)
-        feat = feat / feat.norm(dim=-1, keepdim=True)
-    return feat.cpu().numpy().astype("float32")[0]
+    return image_embeddings([pil_image], batch_size=1)[0]
+
+def image_embeddings(pil_images: List[Image.Image], batch_size: int = CLIP_BATCH_SIZE) -> np.ndarray:
+    """Embed many images, `batch_size` per forward pass. Returns an (N, D) float32 array of unit vectors."""
+    import torch
+    model, preprocess, _, device = registry.get("clip")
+    out = []
+    for i in range(0, len(pil_images), batch_size):
+        chunk = pil_images[i:i + batch_size]
+        imgs = torch.stack([preprocess(im) for im in chunk]).to(device)
+        with torch.no_grad():
+            feat = model.encode_image(imgs)
+            feat = feat / feat.norm(dim=-1, keepdim=True)
+        out.append(feat.cpu().numpy().astype("float32"))
+    if not out:
+        return np.zeros((0, model.visual.output_dim), dtype="float32")
+    return np.concatenate(out, axis=0)
 
 def text_embedding(text: str) -> np.ndarray:
-    toks = _tokenizer([text])
+    """CLIP text embedding, memoized by normalized query text (querycache.py)."""
+    emb = querycache.cached(
+        "clip_text", text, f"{CLIP_MODEL}/{CLIP_PRETRAINED}",
+        lambda: _encode_text(querycache.normalize(text)),
+        encode=lambda a: np.asarray(a, dtype="float32").tobytes(),
+        decode=lambda b: np.frombuffer(b, dtype="float32"),
+    )
+    return emb.copy()
+
+def _encode_text(text: str) -> np.ndarray:
+    import torch
+    model, _, tokenizer, device = registry.get("clip")
+    toks = tokenizer([text])
     with torch.no_grad():
-        txt = _model.encode_text(toks.to(_device))
+        txt = model.encode_text(toks.to(device))
         txt = txt / txt.norm(dim=-1, keepdim=True)
     return txt.cpu().numpy().astype("float32")[0]
+
+# Zero-shot "does this photo show people?" from an image embedding (gates face detection).
+# The first prompts describe people (the two after that, group shots); the rest are common non-people photos.
+_PEOPLE_PROMPTS = ["a photo of a person", "a portrait photo of a face", "a photo of people",
+                   "a group photo of many people", "a crowd of people"]
+_GROUP_PROMPTS = 2  # the last two people prompts
+_OTHER_PROMPTS = ["a landscape photo", "a photo of food", "a screenshot of a phone or computer screen",
+                  "a photo of a document or text", "a photo of an animal", "a photo of an object",
+                  "a photo of a building", "a photo of a car"]
+
+def person_scores(image_embs) -> Tuple[np.ndarray, np.ndarray]:
+    """(P(people), P(group shot)) per image, from CLIP image embeddings via softmax over the prompts."""
+    t = np.stack([text_embedding(p) for p in _PEOPLE_PROMPTS + _OTHER_PROMPTS])
+    logits = 100.0 * np.asarray(image_embs, dtype="float32") @ t.T  # CLIP's logit scale
+    logits -= logits.max(axis=1, keepdims=True)
+    p = np.exp(logits)
+    p /= p.sum(axis=1, keepdims=True)
+    n = len(_PEOPLE_PROMPTS)
+    return p[:, :n].sum(axis=1), p[:, n - _GROUP_PROMPTS:n].sum(axis=1)
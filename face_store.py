@@ -0,0 +1,71 @@
+import os
+import threading
+from pathlib import Path
+from typing import Iterator, Sequence, Tuple
+
+import numpy as np
+
+from config import FACE_EMB_PATH, FACE_EMB_DIM
+
+# Persistent face-embedding store: a memory-mapped float16 matrix whose row i is the embedding of
+# faces.id == i (ids are dense autoincrement keys, so no sidecar index is needed). A zero row means
+# "no embedding" (never stored, or the face was deleted). 512-d float16 is 1 KiB per face.
+
+_DTYPE = np.float16
+_ROW_BYTES = FACE_EMB_DIM * np.dtype(_DTYPE).itemsize
+_lock = threading.Lock()
+
+def _rows(path: Path = FACE_EMB_PATH) -> int:
+    try:
+        return os.path.getsize(path) // _ROW_BYTES
+    except OSError:
+        return 0
+
+def write(ids: Sequence[int], embeddings: Sequence[np.ndarray], path: Path = FACE_EMB_PATH):
+    """Store embeddings under their face ids, growing the file as needed."""
+    if not len(ids):
+        return
+    ids_a = np.asarray(ids, dtype=np.int64)
+    need = int(ids_a.max()) + 1
+    with _lock:
+        if _rows(path) < need:
+            with open(path, "ab") as f:
+                f.truncate(need * _ROW_BYTES)
+        mm = np.memmap(path, dtype=_DTYPE, mode="r+", shape=(need, FACE_EMB_DIM))
+        mm[ids_a] = np.asarray(np.stack(embeddings), dtype=np.float32).astype(_DTYPE)
+        mm.flush()
+        del mm
+
+def read(ids: Sequence[int], path: Path = FACE_EMB_PATH) -> np.ndarray:
+    """float32 embeddings for `ids` (zero rows where none is stored)."""
+    n = _rows(path)
+    out = np.zeros((len(ids), FACE_EMB_DIM), dtype=np.float32)
+    ids_a = np.asarray(ids, dtype=np.int64)
+    ok = np.flatnonzero(ids_a < n)
+    if n and len(ok):
+        mm = np.memmap(path, dtype=_DTYPE, mode="r", shape=(n, FACE_EMB_DIM))
+        out[ok] = mm[ids_a[ok]]
+    return out
+
+def delete(ids: Sequence[int], path: Path = FACE_EMB_PATH):
+    n = _rows(path)
+    ids_a = np.asarray([i for i in ids if i < n], dtype=np.int64)
+    if not len(ids_a):
+        return
+    with _lock:
+        mm = np.memmap(path, dtype=_DTYPE, mode="r+", shape=(n, FACE_EMB_DIM))
+        mm[ids_a] = 0
+        mm.flush()
+        del mm
+
+def iter_chunks(chunk: int = 65536, path: Path = FACE_EMB_PATH) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yield (face_ids, float32 embeddings) for every stored face, `chunk` rows of the file at a time."""
+    n = _rows(path)
+    if not n:
+        return
+    mm = np.memmap(path, dtype=_DTYPE, mode="r", shape=(n, FACE_EMB_DIM))
+    for a in range(0, n, chunk):
+        block = np.asarray(mm[a:a + chunk], dtype=np.float32)
+        present = np.flatnonzero(np.any(block != 0, axis=1))
+        if len(present):
+            yield present + a, block[present]
@@ -1,58 +1,155 @@
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 import numpy as np
 import cv2
 import json
+import threading
 from pathlib import Path
-from insightface.app import FaceAnalysis
-from config import FACE_PROVIDER, FACE_DET_SIZE, PERSONS_JSON
+from config import FACE_PROVIDER, FACE_DET_SIZE, FACE_ORT_THREADS, PERSONS_JSON, FACE_TOPK, FACE_MAX_REFS
+from models import registry
 from PIL import Image
 
-# Load face detector/recognizer
-_face_app = FaceAnalysis(providers=[FACE_PROVIDER], allowed_modules=['detection','recognition'])
-_face_app.prepare(ctx_id=0, det_size=(FACE_DET_SIZE, FACE_DET_SIZE))
+def _load_face_app():
+    # Face detector + recognizer
+    from insightface.app import FaceAnalysis
+    kwargs = {}
+    if FACE_ORT_THREADS:
+        # passed through to each model's onnxruntime InferenceSession
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = FACE_ORT_THREADS
+        opts.inter_op_num_threads = 1
+        kwargs["sess_options"] = opts
+    app = FaceAnalysis(providers=[FACE_PROVIDER], allowed_modules=['detection','recognition'], **kwargs)
+    app.prepare(ctx_id=0, det_size=(FACE_DET_SIZE, FACE_DET_SIZE))
+    return app
 
-def detect_faces(pil_image: Image.Image):
+def detect_faces(pil_image: Image.Image, det_size: Optional[int] = None):
+    """Faces with bbox (in pil_image pixels) and normalized embedding; det_size overrides the detector input size."""
+    from insightface.app.common import Face
+    app = registry.get("faces")
     img = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-    faces = _face_app.get(img)  # each has bbox, normed_embedding
+    size = None
+    if det_size and det_size != FACE_DET_SIZE:
+        size = (det_size, det_size)
+    # FaceAnalysis.get(), with a per-call input size for the detector
+    bboxes, kpss = app.det_model.detect(img, input_size=size, max_num=0, metric="default")
     results = []
-    for f in faces:
+    for i in range(bboxes.shape[0]):
+        f = Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+        for task, model in app.models.items():
+            if task != "detection":
+                model.get(img, f)
         x1,y1,x2,y2 = [int(v) for v in f.bbox]
         emb = f.normed_embedding.astype("float32")
         results.append({"bbox": (x1,y1,x2,y2), "embedding": emb})
     return results
 
-def load_persons() -> Dict[str, List[float]]:
+def _as_refs(v) -> List[List[float]]:
+    # persons.json used to hold one averaged vector per person; now it holds a list of references
+    if v and isinstance(v[0], (int, float)):
+        return [v]
+    return v or []
+
+def load_persons() -> Dict[str, List[List[float]]]:
+    """name -> list of reference embeddings."""
     p = Path(PERSONS_JSON)
     if p.exists():
-        return json.loads(p.read_text())
+        return {name: _as_refs(v) for name, v in json.loads(p.read_text()).items()}
     return {}
 
-def save_persons(d: Dict[str, List[float]]):
+def save_persons(d: Dict[str, List[List[float]]]):
     Path(PERSONS_JSON).write_text(json.dumps(d, indent=2))
 
 def register_person(name: str, face_embeddings: List[np.ndarray]):
+    """Add reference embeddings for `name` (keeps the newest FACE_MAX_REFS)."""
     persons = load_persons()
     if not face_embeddings:
         return
-    avg = np.mean(np.stack(face_embeddings, axis=0), axis=0)
-    avg = avg / (np.linalg.norm(avg) + 1e-9)
-    persons[name] = avg.tolist()
+    refs = persons.get(name, [])
+    for e in face_embeddings:
+        e = np.asarray(e, dtype="float32")
+        refs.append((e / (np.linalg.norm(e) + 1e-9)).tolist())
+    persons[name] = refs[-FACE_MAX_REFS:]
     save_persons(persons)
 
+class PersonGallery:
+    """
+    All enrolled reference embeddings as one L2-normalized (R, D) matrix, rows grouped by person.
+    persons.json is re-read only when its mtime changes. Matching N faces is one (N, D) x (D, R)
+    product; a person's score is the mean of its top_k best reference similarities.
+    """
+
+    def __init__(self, path: Path = PERSONS_JSON, top_k: int = FACE_TOPK):
+        self.path = Path(path)
+        self.top_k = max(1, top_k)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self.names: List[str] = []
+        self._slices: List[Tuple[int, int]] = []
+        self._refs = np.zeros((0, 0), dtype="float32")
+
+    def _refresh(self):
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            persons = load_persons() if mtime is not None else {}
+            names, slices, rows = [], [], []
+            for name, refs in persons.items():
+                if not refs:
+                    continue
+                slices.append((len(rows), len(rows) + len(refs)))
+                rows.extend(refs)
+                names.append(name)
+            refs = np.asarray(rows, dtype="float32").reshape(len(rows), -1)
+            if len(rows):
+                refs /= np.linalg.norm(refs, axis=1, keepdims=True) + 1e-9
+            self.names, self._slices, self._refs = names, slices, refs
+            self._mtime = mtime
+
+    def scores(self, embeddings: np.ndarray) -> np.ndarray:
+        """(N, P) person scores for N face embeddings; columns follow self.names."""
+        self._refresh()
+        names, slices, refs = self.names, self._slices, self._refs
+        E = np.asarray(embeddings, dtype="float32").reshape(len(embeddings), -1)
+        if not names or not len(E):
+            return np.zeros((len(E), len(names)), dtype="float32")
+        E = E / (np.linalg.norm(E, axis=1, keepdims=True) + 1e-9)
+        S = E @ refs.T
+        out = np.empty((len(E), len(names)), dtype="float32")
+        for j, (a, b) in enumerate(slices):
+            k = min(self.top_k, b - a)
+            block = S[:, a:b]
+            out[:, j] = np.partition(block, b - a - k, axis=1)[:, -k:].mean(axis=1)
+        return out
+
+    def match(self, embeddings: np.ndarray, thr: float = 0.4) -> List[Tuple[str, float]]:
+        """Best (name, similarity) per embedding; name is "" below the threshold."""
+        S = self.scores(embeddings)
+        if not S.shape[1]:
+            return [("", 0.0)] * len(S)
+        best = S.argmax(axis=1)
+        sims = S[np.arange(len(S)), best]
+        return [
+            (self.names[b] if s >= (1.0 - thr) else "", float(s))  # similarity close to 1
+            for b, s in zip(best, sims)
+        ]
+
+gallery = PersonGallery()
+
 def recognize(embedding: np.ndarray, thr: float = 0.4) -> Tuple[str, float]:
-    # cosine distance threshold - smaller is closer; we use similarity
-    persons = load_persons()
-    if not persons:
-        return "", 0.0
-    best_name, best_sim = "", -1.0
-    for name, ref in persons.items():
-        refv = np.array(ref, dtype="float32")
-        sim = float(np.dot(embedding, refv) / (np.linalg.norm(embedding)*np.linalg.norm(refv) + 1e-9))
-        if sim > best_sim:
-            best_sim, best_name = sim, name
-    if best_sim >= (1.0 - thr):  # similarity close to 1
-        return best_name, best_sim
-    return "", best_sim
+    return gallery.match(np.asarray(embedding)[None, :], thr)[0]
+
+def recognize_batch(embeddings: List[np.ndarray], thr: float = 0.4) -> List[Tuple[str, float]]:
+    """Recognize every face of an image (or a whole ingest batch) with one matrix multiply."""
+    if not len(embeddings):
+        return []
+    return gallery.match(np.stack(embeddings), thr)
 
 def red_shirt_ratio(pil_image: Image.Image, bbox):
     # crude heuristic: crop a rectangle below the face (torso zone)
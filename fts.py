@@ -0,0 +1,95 @@
+import json
+import re
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Integer, column, table, text
+
+# SQLite FTS5 keyword index over path tokens, captions and vision tags.
+# Row ids are images.id; the writer keeps it in sync inside the same transaction as the images rows.
+# Queries are token based (so "art" no longer matches "party"), prefix-matched and BM25-ranked.
+
+FTS_TABLE = "images_fts"
+# bm25 column weights: path tokens, caption, tags
+_WEIGHTS = (2.0, 1.0, 1.5)
+
+_TOKEN_SPLIT = re.compile(r"[^A-Za-z0-9]+")
+
+def path_tokens(p: Path) -> List[str]:
+    parts = list(Path(p).parts)
+    toks: List[str] = []
+    for part in parts:
+        for t in _TOKEN_SPLIT.split(part):
+            t = t.strip()
+            if len(t) >= 2:
+                toks.append(t)
+    return toks
+
+def create_table(conn):
+    conn.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "path_tokens, caption, tags, tokenize = 'unicode61 remove_diacritics 2')"
+    ))
+
+def _tags_text(tags_json: Optional[str]) -> str:
+    if not tags_json:
+        return ""
+    try:
+        tags = json.loads(tags_json)
+        if isinstance(tags, list):
+            return " ".join(str(t) for t in tags)
+    except Exception:
+        pass
+    return tags_json
+
+def index_rows(conn, rows: Iterable[Tuple[int, str, Optional[str], Optional[str]]]):
+    """(Re)index (image_id, path, caption, tags_json) rows. `conn` may be a Session or Connection."""
+    params = [
+        {"id": id_, "p": " ".join(path_tokens(Path(path))), "c": caption or "", "t": _tags_text(tags)}
+        for id_, path, caption, tags in rows
+    ]
+    if not params:
+        return
+    delete_rows(conn, [p["id"] for p in params])
+    conn.execute(
+        text(f"INSERT INTO {FTS_TABLE} (rowid, path_tokens, caption, tags) VALUES (:id, :p, :c, :t)"),
+        params,
+    )
+
+def delete_rows(conn, ids: Sequence[int]):
+    if ids:
+        conn.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), [{"id": i} for i in ids])
+
+def rebuild(conn):
+    """Re-index every image (used by the migration that introduces the table)."""
+    conn.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    rows = conn.execute(text("SELECT id, path, caption, tags FROM images")).fetchall()
+    for i in range(0, len(rows), 1000):
+        index_rows(conn, rows[i:i + 1000])
+
+def _quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+def match_expr(keywords: Sequence[str], phrases: Sequence[str] = ()) -> Optional[str]:
+    """FTS5 MATCH expression: keywords as prefix terms, phrases verbatim, OR-ed and left to BM25 to rank."""
+    terms = [_quote(k) + "*" for k in keywords if k.strip()]
+    terms += [_quote(p) for p in phrases if p.strip()]
+    return " OR ".join(terms) if terms else None
+
+_fts = table(FTS_TABLE, column("rowid", Integer))
+
+def ranked(query, id_column, keywords: Sequence[str], phrases: Sequence[str] = ()):
+    """
+    `query` joined to the index on `id_column` and restricted to rows matching the keywords/phrases,
+    best BM25 score first. The MATCH runs inside the caller's filtered query, so a LIMIT on the
+    result applies after every other filter. None when there is nothing to match.
+    """
+    expr = match_expr(keywords, phrases)
+    if expr is None:
+        return None
+    w = ", ".join(str(x) for x in _WEIGHTS)
+    return (
+        query.join(_fts, _fts.c.rowid == id_column)
+        .filter(text(f"{FTS_TABLE} MATCH :fts_q").bindparams(fts_q=expr))
+        .order_by(text(f"bm25({FTS_TABLE}, {w})"))
+    )
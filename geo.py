@@ -0,0 +1,111 @@
+import csv
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Integer, column, text
+
+from config import GAZETTEER_PATH
+
+# Spatial index and offline place lookup.
+#
+# images_geo is an SQLite R*Tree over images.lat/lon (a point is a zero-size box), keyed by
+# images.id and kept in sync by the writer like the FTS index. Place names in a query resolve
+# through a bundled gazetteer (GAZETTEER_PATH, CSV: name,country,lat_min,lat_max,lon_min,lon_max;
+# alternate names separated by "|") to a bounding box, which search turns into an R*Tree lookup.
+# A box whose lon_min is greater than its lon_max crosses the antimeridian (e.g. Fiji, Alaska).
+# A name prefixed with "~" is also an everyday word or a first name ("~china", "~aspen", "~rio"): it
+# only counts as a place where the query marks it as one (see find_place).
+
+GEO_TABLE = "images_geo"
+
+Bbox = Tuple[float, float, float, float]  # lat_min, lat_max, lon_min, lon_max
+
+def create_table(conn):
+    conn.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {GEO_TABLE} USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+    ))
+
+def index_rows(conn, rows: Iterable[Tuple[int, Optional[float], Optional[float]]]):
+    """(Re)index (image_id, lat, lon) rows; rows without a position are skipped."""
+    params = [{"id": i, "lat": lat, "lon": lon} for i, lat, lon in rows if lat is not None and lon is not None]
+    if params:
+        conn.execute(
+            text(f"INSERT OR REPLACE INTO {GEO_TABLE} (id, min_lat, max_lat, min_lon, max_lon) "
+                 "VALUES (:id, :lat, :lat, :lon, :lon)"),
+            params,
+        )
+
+def delete_rows(conn, ids: Sequence[int]):
+    if ids:
+        conn.execute(text(f"DELETE FROM {GEO_TABLE} WHERE id = :id"), [{"id": i} for i in ids])
+
+def rebuild(conn):
+    """Re-index every located image (used by the migration that introduces the table)."""
+    conn.execute(text(f"DELETE FROM {GEO_TABLE}"))
+    rows = conn.execute(text("SELECT id, lat, lon FROM images WHERE lat IS NOT NULL")).fetchall()
+    for i in range(0, len(rows), 1000):
+        index_rows(conn, rows[i:i + 1000])
+
+def ids_in_bbox(bbox: Bbox):
+    """SELECT of the image ids inside bbox, for use in IN (...)."""
+    lat_min, lat_max, lon_min, lon_max = bbox
+    where = "max_lat >= :geo_s AND min_lat <= :geo_n AND "
+    if lon_min <= lon_max:
+        where += "max_lon >= :geo_w AND min_lon <= :geo_e"
+    else:
+        where += "(max_lon >= :geo_w OR min_lon <= :geo_e)"
+    return text(f"SELECT id FROM {GEO_TABLE} WHERE {where}").bindparams(
+        geo_s=lat_min, geo_n=lat_max, geo_w=lon_min, geo_e=lon_max,
+    ).columns(column("id", Integer))
+
+# ---- gazetteer ----
+
+def normalize(s: str) -> str:
+    """Lowercase ASCII words separated by single spaces ("Côte d'Azur" -> "cote d azur")."""
+    return " ".join(_words(s)).lower()
+
+def _words(s: str) -> List[str]:
+    s = unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("ascii")
+    return [w for w in re.split(r"[^A-Za-z0-9]+", s) if w]
+
+@lru_cache(maxsize=1)
+def gazetteer() -> Dict[str, Tuple[str, Bbox, bool]]:
+    """normalized name -> (display name, bbox, ambiguous); the first entry wins for a name listed twice."""
+    out: Dict[str, Tuple[str, Bbox, bool]] = {}
+    try:
+        with open(GAZETTEER_PATH, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                try:
+                    bbox = tuple(float(row[k]) for k in ("lat_min", "lat_max", "lon_min", "lon_max"))
+                except (KeyError, TypeError, ValueError):
+                    continue
+                names = [n.strip() for n in (row.get("name") or "").split("|") if n.strip(" ~")]
+                for n in names:
+                    out.setdefault(normalize(n), (names[0].lstrip("~"), bbox, n.startswith("~")))
+    except OSError:
+        pass
+    return out
+
+_PLACE_CUES = {"in", "at", "near", "around"}
+
+def find_place(q: str, max_words: int = 4) -> Optional[Tuple[str, Bbox, List[str]]]:
+    """
+    The longest gazetteer name in q (leftmost on ties): (display name, bbox, its normalized words).
+    An ambiguous single-word name only matches when capitalized in q or after "in"/"at"/"near"/"around"
+    ("plates from China", "hike near aspen"), so "china plates" and "aspen trees" stay keywords.
+    """
+    gaz = gazetteer()
+    raw = _words(q)
+    words = [w.lower() for w in raw]
+    for n in range(min(max_words, len(words)), 0, -1):
+        for i in range(len(words) - n + 1):
+            hit = gaz.get(" ".join(words[i:i + n]))
+            if hit is None:
+                continue
+            cued = n > 1 or raw[i][0].isupper() or (i > 0 and words[i - 1] in _PLACE_CUES)
+            if hit[2] and not cued:
+                continue
+            return hit[0], hit[1], words[i:i + n]
+    return None
@@ -0,0 +1,132 @@
+import io
+import math
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image
+from dateutil import parser as dateparser
+
+from config import INDEX_MODE, FACE_DET_SIZE, THUMB_MAX_SIDE, BLIP_MIN_SIDE
+from manifest import bytes_hash
+
+# Single-decode image loading for ingest.
+#
+# Each file is read once. EXIF comes from the header (no pixel decode), and JPEGs are decoded with
+# PIL's draft() so libjpeg downscales in the DCT domain (1/2, 1/4, 1/8) straight to roughly the
+# largest resolution any enabled stage needs. Thumbnail, CLIP, BLIP and face inputs are all derived
+# from that one buffer; only group shots that escalate to the high-resolution face detector are
+# decoded a second time, larger (decode_at).
+
+try:  # HEIC/HEIF support when pillow-heif is installed
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+_EXIF_IFD = 0x8769
+_DATETIME_ORIGINAL = 36867
+_DATETIME = 306
+_GPS_IFD = 0x8825
+_GPS_LAT_REF, _GPS_LAT, _GPS_LON_REF, _GPS_LON = 1, 2, 3, 4
+
+def decode_size(w: int, h: int) -> tuple:
+    """Smallest (w, h) that still satisfies every enabled stage; never larger than the original."""
+    long_need = THUMB_MAX_SIDE
+    short_need = 0
+    if INDEX_MODE == "FULL":
+        long_need = max(long_need, FACE_DET_SIZE)  # InsightFace letterboxes into det_size
+        short_need = BLIP_MIN_SIDE                  # BLIP/CLIP resize + crop on the short side
+    scale = min(1.0, max(long_need / max(w, h), short_need / max(1, min(w, h))))
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+def _decode(im: Image.Image, tw: int, th: int) -> Image.Image:
+    if (tw, th) != im.size:
+        im.draft("RGB", (tw, th))  # JPEG: DCT-domain downscale; no-op for other formats
+    pil = im.convert("RGB")
+    if pil.size[0] > tw or pil.size[1] > th:
+        pil.thumbnail((tw, th), Image.BILINEAR)
+    return pil
+
+def _parse_exif_dt(s) -> Optional[datetime]:
+    if not s:
+        return None
+    s = str(s).strip().strip("\x00")
+    try:
+        return datetime.strptime(s[:19], "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        pass
+    try:
+        return dateparser.parse(s)
+    except (ValueError, OverflowError):
+        return None
+
+def exif_timestamp(exif) -> Optional[datetime]:
+    # DateTimeOriginal lives in the Exif sub-IFD; IFD0 DateTime is the fallback
+    try:
+        ts = _parse_exif_dt(exif.get_ifd(_EXIF_IFD).get(_DATETIME_ORIGINAL))
+    except Exception:
+        ts = None
+    return ts or _parse_exif_dt(exif.get(_DATETIME_ORIGINAL) or exif.get(_DATETIME))
+
+def _dms(v) -> float:
+    d, m, s = (float(x) for x in v)
+    return d + m / 60.0 + s / 3600.0
+
+def exif_gps(exif) -> Optional[Tuple[float, float]]:
+    """(lat, lon) in decimal degrees from the GPS IFD; None if absent or implausible."""
+    try:
+        g = exif.get_ifd(_GPS_IFD)
+        lat, lon = _dms(g[_GPS_LAT]), _dms(g[_GPS_LON])
+    except Exception:
+        return None
+    if str(g.get(_GPS_LAT_REF, "N")).strip("\x00 ").upper() == "S":
+        lat = -lat
+    if str(g.get(_GPS_LON_REF, "E")).strip("\x00 ").upper() == "W":
+        lon = -lon
+    if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > 90 or abs(lon) > 180:
+        return None
+    if lat == 0 and lon == 0:  # unset position written by some cameras
+        return None
+    return lat, lon
+
+def read_gps(path: Path) -> Optional[Tuple[float, float]]:
+    """GPS position from the file's EXIF header only (no pixel decode)."""
+    try:
+        with Image.open(path) as im:
+            return exif_gps(im.getexif())
+    except Exception:
+        return None
+
+def load_image(path: Path, want_hash: bool = False) -> Optional[dict]:
+    """
+    Read and decode `path` once. Returns {"pil", "w", "h", "ts", "gps", "hash"} where w/h are the
+    original dimensions and pil is the reduced RGB decode; None if the file can't be decoded.
+    ts is None when the file has no EXIF date (callers fall back to mtime); gps is (lat, lon) or None.
+    """
+    try:
+        data = Path(path).read_bytes()
+        im = Image.open(io.BytesIO(data))
+        w, h = im.size
+        exif = im.getexif()
+        pil = _decode(im, *decode_size(w, h))
+    except Exception:
+        return None
+    return {
+        "pil": pil,
+        "w": w,
+        "h": h,
+        "ts": exif_timestamp(exif),
+        "gps": exif_gps(exif),
+        "hash": bytes_hash(data) if want_hash else None,
+    }
+
+def decode_at(path: Path, long_side: int) -> Optional[Image.Image]:
+    """RGB decode of `path` with its long side reduced to `long_side` (never enlarged); None on failure."""
+    try:
+        with Image.open(path) as im:
+            w, h = im.size
+            scale = min(1.0, long_side / max(w, h))
+            return _decode(im, max(1, round(w * scale)), max(1, round(h * scale)))
+    except Exception:
+        return None
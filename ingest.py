@@ -1,195 +1,776 @@
 from pathlib import Path
-from typing import Optional, List
-from PIL import Image
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
 from datetime import datetime
-from dateutil import parser as dateparser
-import os, json, hashlib, re
+import os, errno, json, logging, threading
+from concurrent.futures import ThreadPoolExecutor
 
-from config import SUPPORTED_EXTS, THUMBS_DIR, INDEX_MODE
-from db import get_session, Image as ImageRow, Face as FaceRow
-from config import CHROMA_DIR
-import chromadb
+import numpy as np
+
+from config import SUPPORTED_EXTS, INDEX_MODE, CLIP_BATCH_SIZE
+from config import INGEST_DECODE_WORKERS, INGEST_QUEUE_SIZE, INGEST_CONTENT_HASH, DEDUP_ENABLED
+from config import INGEST_PROCESSES, INGEST_WORKER_THREADS
+from config import FACE_GATE_THRESHOLD, FACE_DET_SIZE, FACE_DET_SIZE_LARGE, FACE_GROUP_THRESHOLD, FACE_GROUP_MIN_FACES
+from db import get_session, bump_index_generation, Image as ImageRow, Face as FaceRow
+from manifest import load_manifest, load_manifest_paths, diff_manifest, renamed_paths
+from scanner import scan_tree, is_excluded, check_root, RootUnavailable
+from image_loader import load_image, decode_at, read_gps
+from pipeline import run_pipeline, run_process_pipeline
+from fts import path_tokens
+import fts
+import geo
+import face_store
+import thumbstore
+from writer import write_batch, sync_vector_metadata, BatchWriteError
+from dedup import DedupIndex, perceptual_hashes
+from vectorstore import get_store
+
+log = logging.getLogger(__name__)
 
 # Optional imports used only in FULL mode
 if INDEX_MODE == "FULL":
-    from captions import caption_image
-    from embeddings import image_embedding
-    from faces import detect_faces, recognize, red_shirt_ratio
+    from captions import caption_images, cached_captions
+    from embeddings import image_embeddings, person_scores
+    from faces import detect_faces, recognize_batch, red_shirt_ratio
     from config import OPENAI_API_KEY, USE_OPENAI_VISION_TAGS
-    if OPENAI_API_KEY and USE_OPENAI_VISION_TAGS:
-        from openai_helpers import vision_tags_for_image
+    from openai_helpers import cached_tags
+    from models import registry
 
-# Initialize Chroma (only used when FULL)
-client = chromadb.PersistentClient(path=str(CHROMA_DIR))
-collection = client.get_or_create_collection(name="photos")
+def _load(entry: dict) -> Optional[dict]:
+    """Decode stage (runs on the thread pool): one read + reduced decode, EXIF, thumbnail bytes."""
+    p = entry["path"]
+    img = load_image(p, want_hash=INGEST_CONTENT_HASH and entry.get("hash") is None)
+    if img is None:
+        return None
+    if img["ts"] is None:
+        img["ts"] = datetime.fromtimestamp(entry["mtime"])
+    if img["hash"] is None:
+        img["hash"] = entry.get("hash")
+    try:
+        img["thumb"] = thumbstore.encode(img["pil"])
+    except Exception:
+        img["thumb"] = None
+    entry.update(img)
+    return entry
 
-def _read_exif_ts(path: Path) -> Optional[datetime]:
+def _caption_batch(batch: List[dict]):
+    """Captions from the cache by content hash; BLIP runs batched on the rest (once per distinct hash)."""
+    sess = get_session()
     try:
-        img = Image.open(path)
-        exif = img.getexif()
-        if 36867 in exif:  # DateTimeOriginal
-            return dateparser.parse(exif.get(36867))
+        cached = cached_captions(sess, (it.get("hash") for it in batch))
     except Exception:
-        pass
+        cached = {}
+    finally:
+        sess.close()
+    todo: List[dict] = []
+    first = {}
+    for it in batch:
+        h = it.get("hash")
+        it["caption"] = cached.get(h) if h else None
+        it["caption_new"] = False
+        if it["caption"] is None and not (h and h in first):
+            todo.append(it)
+            if h:
+                first[h] = it
     try:
-        return datetime.fromtimestamp(path.stat().st_mtime)
+        caps = caption_images([it["pil"] for it in todo])
     except Exception:
-        return None
-
-def _read_gps(path: Path) -> Optional[str]:
-    return None  # placeholder; add if you want GPS
-
-def _thumb_path(path: Path) -> Path:
-    h = hashlib.md5(str(path).encode()).hexdigest()[:12]
-    return THUMBS_DIR / f"{h}.jpg"
-
-def _ensure_thumb(path: Path, max_side=400) -> Path:
-    out = _thumb_path(path)
-    if out.exists():
-        return out
-    im = Image.open(path).convert("RGB")
-    w, h = im.size
-    scale = max_side / max(w, h)
-    if scale < 1.0:
-        im = im.resize((int(w * scale), int(h * scale)))
-    im.save(out, "JPEG", quality=85)
-    return out
+        caps = [None] * len(todo)
+    for it, cap in zip(todo, caps):
+        it["caption"] = cap
+        it["caption_new"] = cap is not None
+    # copies of a file captioned in this same batch
+    for it in batch:
+        h = it.get("hash")
+        if it["caption"] is None and h in first and first[h] is not it:
+            it["caption"] = first[h]["caption"]
 
-_TOKEN_SPLIT = re.compile(r"[^A-Za-z0-9]+")
+# Detector cascade counters for the current ingest run (see _face_gate)
+face_stats = {"images": 0, "skipped": 0, "large": 0}
 
-def _path_tokens(p: Path) -> List[str]:
-    parts = list(p.parts)
-    toks: List[str] = []
-    for part in parts:
-        for t in _TOKEN_SPLIT.split(part):
-            t = t.strip()
-            if len(t) >= 2:
-                toks.append(t)
-    return toks
+def _face_gate(items: List[dict]) -> List[tuple]:
+    """
+    (detect?, group shot?) per item from CLIP zero-shot scores on the embeddings already computed.
+    Items without an embedding are always detected.
+    """
+    out = [(True, False)] * len(items)
+    embs = []
+    for it in items:
+        emb = it.get("clip_emb")
+        if emb is None and it.get("dup_kind"):
+            emb = it["dup_ref"].get("clip_emb")
+        embs.append(emb)
+    have = [i for i, e in enumerate(embs) if e is not None]
+    if have and (FACE_GATE_THRESHOLD > 0 or FACE_DET_SIZE_LARGE):
+        try:
+            people, group = person_scores(np.stack([np.asarray(embs[i], dtype=np.float32) for i in have]))
+            for i, p, g in zip(have, people.tolist(), group.tolist()):
+                out[i] = (p >= FACE_GATE_THRESHOLD, g >= FACE_GROUP_THRESHOLD)
+        except Exception:
+            pass
+    face_stats["images"] += len(items)
+    face_stats["skipped"] += sum(1 for want, _ in out if not want)
+    return out
 
-def ingest_folder(root: str):
+def _detect(it: dict, group: bool) -> List[dict]:
     """
-    FULL mode:
-        - EXIF ts, caption (BLIP), CLIP image embed -> Chroma, faces, red shirt, optional OpenAI tags
-    FAST mode:
-        - EXIF ts, basic dims (cheap), store path tokens into 'tags' JSON for SQL LIKE search
-        - No CLIP, no BLIP, no faces, no OpenAI calls
+    Detect at FACE_DET_SIZE on the item's decode; group shots (by CLIP or by face count) again at
+    FACE_DET_SIZE_LARGE on a second, larger decode of the file. Bboxes are in it["pil"] pixels.
     """
-    rootp = Path(root).expanduser()
-    sess = get_session()
+    pil = it["pil"]
+    try:
+        faces = detect_faces(pil)
+    except Exception:
+        return []
+    if FACE_DET_SIZE_LARGE > FACE_DET_SIZE and max(it["w"], it["h"]) > FACE_DET_SIZE \
+            and (group or len(faces) >= FACE_GROUP_MIN_FACES):
+        big_pil = decode_at(it["path"], FACE_DET_SIZE_LARGE)
+        if big_pil is None:
+            return faces
+        # no point in a detector input larger than the decoded image (sizes are multiples of 32)
+        size = min(FACE_DET_SIZE_LARGE, -(-max(big_pil.size) // 32) * 32)
+        try:
+            big = detect_faces(big_pil, det_size=size)
+            face_stats["large"] += 1
+            if len(big) >= len(faces):
+                scale = pil.size[0] / big_pil.size[0]
+                for f in big:
+                    f["bbox"] = tuple(int(round(v * scale)) for v in f["bbox"])
+                faces = big
+        except Exception:
+            pass
+    return faces
 
-    paths = []
-    for p in rootp.rglob("*"):
-        if p.suffix.lower() in SUPPORTED_EXTS:
-            paths.append(p)
+def _tags_enabled() -> bool:
+    return bool(os.getenv("OPENAI_API_KEY")) and os.getenv("USE_OPENAI_VISION_TAGS", "").lower() != "false" \
+        and USE_OPENAI_VISION_TAGS
 
-    added = 0
-    for p in paths:
-        if sess.query(ImageRow).filter_by(path=str(p)).first():
-            continue
+def _submit_tags(batch: List[dict]) -> list:
+    """Tags from the cache by content hash; the rest are sent to the background tagger. Returns (item, future) pairs."""
+    for it in batch:
+        it["tags"], it["tags_new"] = None, False
+    if not batch or not _tags_enabled():
+        return []
+    sess = get_session()
+    try:
+        cached = cached_tags(sess, (it.get("hash") for it in batch))
+    except Exception:
+        cached = {}
+    finally:
+        sess.close()
+    try:
+        tagger = registry.get("openai_tagger")
+    except Exception:
+        tagger = None
+    jobs = []
+    for it in batch:
+        if it.get("hash") in cached:
+            it["tags"] = cached[it["hash"]]
+        elif tagger is not None:
+            try:
+                jobs.append((it, tagger.submit(it["pil"])))
+            except Exception:
+                pass
+    return jobs
 
-        # Open only to get dims & thumbs quickly (both modes need thumb)
+def _collect_tags(jobs: list):
+    for it, fut in jobs:
         try:
-            pil = Image.open(p).convert("RGB")
+            tag_list = fut.result()
         except Exception:
             continue
+        if tag_list:
+            it["tags"], it["tags_new"] = json.dumps(tag_list), True
 
-        ts = _read_exif_ts(p)
-        gps = _read_gps(p)
-        w, h = pil.size
+def _dedup_batch(batch: List[dict], index: DedupIndex):
+    """Perceptual hashes for the batch, then mark each item as a new canonical image or a copy of one."""
+    try:
+        phashes, dhashes = perceptual_hashes([it["pil"] for it in batch])
+    except Exception:
+        return
+    for it, ph, dh in zip(batch, phashes, dhashes):
+        it["phash"], it["dhash"] = ph, dh
+        kind, ref = index.match(it.get("hash"), ph, dh)
+        if kind is None:
+            ref = index.add(it.get("hash"), ph, dh)
+        it["dup_kind"], it["dup_ref"] = kind, ref
+        it["dup_group"] = ref["group"]
 
-        caption = None
-        tags_json = None
-        clip_emb = None
+def _load_refs(refs: List[dict]):
+    """Fill caption/clip_emb/tags/faces of refs that point at already indexed rows."""
+    refs = [r for r in refs if "image_id" in r and "caption" not in r]
+    if not refs:
+        return
+    by_id = {r["image_id"]: r for r in refs}
+    sess = get_session()
+    try:
+        rows = sess.query(ImageRow.id, ImageRow.caption, ImageRow.tags, ImageRow.clip_id) \
+            .filter(ImageRow.id.in_(list(by_id))).all()
+        faces = sess.query(FaceRow.id, FaceRow.image_id, FaceRow.person_name, FaceRow.bbox, FaceRow.red_ratio) \
+            .filter(FaceRow.image_id.in_(list(by_id))).all()
+    finally:
+        sess.close()
+    try:
+        got = get_store().get([r.clip_id for r in rows if r.clip_id], include=("embeddings",))
+        vecs = dict(zip(got["ids"], got["embeddings"]))
+    except Exception:
+        vecs = {}
+    for id_, caption, tags, clip_id in rows:
+        emb = vecs.get(clip_id)
+        by_id[id_].update(caption=caption, tags=tags, faces=[],
+                          clip_emb=np.asarray(emb, dtype=np.float32) if emb is not None else None)
+    embs = face_store.read([f.id for f in faces]) if faces else []
+    for f, emb in zip(faces, embs):
+        by_id[f.image_id]["faces"].append({
+            "bbox": tuple(int(v) for v in f.bbox.split(",")) if f.bbox else (0, 0, 0, 0),
+            "red_ratio": f.red_ratio,
+            "name": f.person_name,
+            "embedding": emb if emb.any() else None,
+        })
+    for r in refs:
+        if "caption" not in r:  # row vanished meanwhile: nothing to reuse
+            r.update(caption=None, tags=None, clip_emb=None, faces=None)
 
-        if INDEX_MODE == "FULL":
-            # Caption (can be slow)
-            try:
-                caption = caption_image(pil)
-            except Exception:
-                caption = None
+def _share_duplicates(batch: List[dict]):
+    """Record canonical outputs on their refs; copy them to the batch's duplicates."""
+    for it in batch:
+        if it.get("dup_kind") is None and "dup_ref" in it:
+            emb = it.get("clip_emb")
+            it["dup_ref"].update(
+                caption=it.get("caption"), tags=it.get("tags"), faces=it.get("faces"),
+                clip_emb=np.asarray(emb, dtype=np.float32) if emb is not None else None,
+            )
+    for it in batch:
+        kind, ref = it.get("dup_kind"), it.get("dup_ref")
+        if kind is None:
+            continue
+        if ref.get("clip_emb") is None:
+            # canonical has no embedding to share (e.g. its CLIP pass failed)
+            it["clip_emb"] = None
+        else:
+            it["clip_emb"] = ref["clip_emb"].tolist()
+        it["caption"], it["tags"] = ref.get("caption"), ref.get("tags")
+        if kind == "exact" and ref.get("faces") is not None:
+            it["faces"] = [dict(f) for f in ref["faces"]]
 
-            # Image embedding (required for vector search)
-            try:
-                emb = image_embedding(pil)
-                clip_emb = emb.tolist()
-            except Exception:
-                clip_emb = None
+def _run_models(batch: List[dict], dedup: Optional[DedupIndex] = None) -> List[dict]:
+    """Model stage (one thread, whole batches): fills caption, clip_emb, faces and tags on each item."""
+    if dedup is not None:
+        _dedup_batch(batch, dedup)
 
-            # Add to Chroma (even if caption is None; doc text can be empty)
-            if clip_emb is not None:
-                doc_id = str(p)
-                collection.add(documents=[caption or ""], embeddings=[clip_emb], ids=[doc_id])
-            else:
-                doc_id = None
+    if INDEX_MODE != "FULL":
+        # FAST MODE:
+        # Use cheap tokens from path/folders/filename as "tags" for LIKE search later
+        for it in batch:
+            toks = path_tokens(it["path"])
+            it["tags"] = json.dumps(sorted(set(toks), key=str.lower)) if toks else None
+            it.pop("pil", None)
+        return batch
 
-            # Faces
-            faces = []
-            try:
-                faces = detect_faces(pil)
-            except Exception:
-                faces = []
-
-            # Optional OpenAI vision tags
-            if os.getenv("OPENAI_API_KEY") and os.getenv("USE_OPENAI_VISION_TAGS", "").lower() != "false":
-                try:
-                    tag_list = vision_tags_for_image(pil)
-                    if tag_list:
-                        tags_json = json.dumps(tag_list)
-                except Exception:
-                    tags_json = None
-
-            row = ImageRow(
-                path=str(p), ts=ts, gps=gps, width=w, height=h,
-                caption=caption, clip_id=str(p) if clip_emb is not None else None, tags=tags_json
-            )
-            sess.add(row)
-            sess.commit()
+    # Exact copies reuse everything of their canonical image; near-duplicates (bursts) reuse its
+    # caption, embedding and tags but still get their own faces. Only new images run every model.
+    _load_refs([it["dup_ref"] for it in batch if it.get("dup_kind")])
+    for it in batch:
+        ref = it.get("dup_ref")
+        if it.get("dup_kind") and "caption" in ref and ref.get("clip_emb") is None:
+            # nothing to reuse (e.g. the original was indexed in FAST mode): run the models after all
+            it["dup_kind"] = None
+    fresh = [it for it in batch if not it.get("dup_kind")]
+    need_faces = [it for it in batch if it.get("dup_kind") != "exact"]
 
-            # Persist faces
-            for f in faces:
-                name, sim = recognize(f["embedding"])
-                rr = red_shirt_ratio(pil, f["bbox"])
-                fr = FaceRow(image_id=row.id,
-                             person_name=name or None,
-                             bbox=",".join(map(str, f["bbox"])),
-                             red_ratio=rr)
-                sess.add(fr)
-            sess.commit()
+    # Optional OpenAI vision tags: uploads start now and run while the local models work
+    tag_jobs = _submit_tags(fresh)
 
-        else:
-            # FAST MODE:
-            # Use cheap tokens from path/folders/filename as "tags" for LIKE search later
-            toks = _path_tokens(p)
-            if toks:
-                tags_json = json.dumps(sorted(set(toks), key=str.lower))
-
-            row = ImageRow(
-                path=str(p), ts=ts, gps=gps, width=w, height=h,
-                caption=None, clip_id=None, tags=tags_json
-            )
-            sess.add(row)
+    # Image embedding (required for vector search); one CLIP forward pass for the whole batch
+    try:
+        embs = image_embeddings([it["pil"] for it in fresh]) if fresh else []
+    except Exception:
+        embs = [None] * len(fresh)
+    for it, emb in zip(fresh, embs):
+        it["clip_emb"] = emb.tolist() if emb is not None else None
+
+    _caption_batch(fresh)
+
+    gate = _face_gate(need_faces)
+    for it, (want, group) in zip(need_faces, gate):
+        pil = it["pil"]
+        # Faces: the red-shirt heuristic needs the pixels, so do it here
+        faces = []
+        if want:
+            faces = _detect(it, group)
+        # bboxes are stored in original-image pixels; the decode may be reduced
+        scale = it["w"] / pil.size[0]
+        for f in faces:
+            f["red_ratio"] = red_shirt_ratio(pil, f["bbox"])
+            f["bbox"] = tuple(int(round(v * scale)) for v in f["bbox"])
+        it["faces"] = faces
+
+    _collect_tags(tag_jobs)
+
+    # Recognize every face in the batch against the person gallery in one pass
+    all_faces = [f for it in need_faces for f in it["faces"]]
+    for f, (name, _) in zip(all_faces, recognize_batch([f["embedding"] for f in all_faces])):
+        f["name"] = name
+
+    _share_duplicates(batch)
+    for it in batch:
+        it.pop("pil", None)
+        it.setdefault("faces", [])
+    return batch
+
+def _remove_images(sess, paths: List[str], dedup: Optional[DedupIndex] = None):
+    """
+    Drop rows, faces, vectors and thumbnail entries of images that are gone (or about to be
+    re-indexed), and forget them in `dedup` if given.
+    """
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        rows = sess.query(ImageRow.id, ImageRow.clip_id, ImageRow.content_hash, ImageRow.phash, ImageRow.dhash) \
+            .filter(ImageRow.path.in_(chunk)).all()
+        ids = [r[0] for r in rows]
+        clip_ids = [r[1] for r in rows if r[1]]
+        if dedup is not None:
+            dedup.discard([(r[0], r[2], r[3], r[4]) for r in rows])
+        # SQL first: a leftover vector without a row is never returned, a row without its vector is.
+        fts.delete_rows(sess, ids)
+        geo.delete_rows(sess, ids)
+        face_ids = [r[0] for r in sess.query(FaceRow.id).filter(FaceRow.image_id.in_(ids)).all()]
+        sess.query(FaceRow).filter(FaceRow.image_id.in_(ids)).delete(synchronize_session=False)
+        sess.query(ImageRow).filter(ImageRow.id.in_(ids)).delete(synchronize_session=False)
+        thumbstore.forget(sess, chunk)
+        bump_index_generation(sess)
+        sess.commit()
+        if clip_ids:
+            get_store().delete(clip_ids)
+        face_store.delete(face_ids)
+
+def _move_images(sess, moves):
+    """Re-point rows, vectors and thumbnails of moved files at their new path; nothing is re-indexed."""
+    for old, e in moves:
+        new = str(e["path"])
+        row = sess.query(ImageRow).filter_by(path=old).first()
+        if row is None:
+            continue
+        if row.clip_id and get_store().rename(row.clip_id, new):
+            row.clip_id = new
+        row.path = new
+        row.file_size, row.file_mtime = e["size"], e["mtime"]
+        if INDEX_MODE != "FULL":
+            toks = path_tokens(e["path"])
+            row.tags = json.dumps(sorted(set(toks), key=str.lower)) if toks else None
+        fts.index_rows(sess, [(row.id, new, row.caption, row.tags)])
+        thumbstore.rename(sess, old, new)
+    bump_index_generation(sess)
+    sess.commit()
+
+def _backfill_gps(sess, root: Path, run: "_Run") -> int:
+    """
+    Read GPS from the EXIF headers of rows indexed before positions were stored (gps IS NULL).
+    A reported phase of the run: progress goes to run.extra, and control() runs between chunks.
+    """
+    prefix = str(root).rstrip(os.sep) + os.sep
+    rows = sess.query(ImageRow.id, ImageRow.path).filter(
+        ImageRow.gps.is_(None), ImageRow.path.startswith(prefix, autoescape=True)
+    ).all()
+    if not rows:
+        return 0
+    run.counts["phase"] = "reading GPS"
+    run.extra.update(gps_todo=len(rows), gps_done=0)
+    run.report()
+    found = 0
+    with ThreadPoolExecutor(max_workers=INGEST_DECODE_WORKERS) as pool:
+        for i in range(0, len(rows), 500):
+            chunk = rows[i:i + 500]
+            values = []
+            for (id_, _), gps in zip(chunk, pool.map(read_gps, [p for _, p in chunk])):
+                values.append({
+                    "id": id_, "gps": f"{gps[0]:.6f},{gps[1]:.6f}" if gps else "",
+                    "lat": gps[0] if gps else None, "lon": gps[1] if gps else None,
+                })
+            sess.bulk_update_mappings(ImageRow, values)
+            geo.index_rows(sess, [(v["id"], v["lat"], v["lon"]) for v in values])
+            found += sum(1 for v in values if v["lat"] is not None)
+            bump_index_generation(sess)
             sess.commit()
+            run.extra["gps_done"] += len(chunk)
+            run.report()
+            run.checkpoint()
+    log.info("read GPS of %d earlier indexed photos (%d with a position)", len(rows), found)
+    return found
 
-        _ensure_thumb(p)
-        added += 1
+def load_dedup_index(sess=None) -> Optional[DedupIndex]:
+    """Duplicate index over the indexed rows, or None when DEDUP_ENABLED is off."""
+    if not DEDUP_ENABLED:
+        return None
+    own = sess is None
+    sess = sess or get_session()
+    try:
+        return DedupIndex.from_db(sess)
+    finally:
+        if own:
+            sess.close()
+
+def _ensure_vector_metadata(sess):
+    # Vectors written before filter pushdown carry no metadata; backfill them once from SQLite
+    store = get_store()
+    if store.supports_where and store.needs_metadata_backfill():
+        sync_vector_metadata(sess, store)
+
+# ---- multi-process ingest (INGEST_PROCESSES > 1) ----
+# State of a worker process: its decode thread pool and its own duplicate index (copies across
+# workers within one run are not detected as such; copies of already indexed photos are).
+_worker: dict = {}
+
+def _thread_env(threads: int) -> dict:
+    """Environment for worker processes: read by the BLAS/OpenMP runtimes and ONNX Runtime as they load."""
+    env = {var: str(threads) for var in
+           ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")}
+    env["FACE_ORT_THREADS"] = str(threads)
+    return env
+
+def _worker_init(threads: int, processes: int):
+    """Runs once in each worker process: cap the thread pools already loaded (the env covers the rest)."""
+    import querycache
+    querycache.set_read_only()  # the coordinator is the only writer of the database
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except Exception:
+        pass
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except Exception:
+        pass
+    if INDEX_MODE == "FULL":
+        try:
+            import torch
+            torch.set_num_threads(threads)
+            torch.set_num_interop_threads(1)
+        except Exception:
+            pass
+        # the OpenAI request budget is shared by all workers
+        from config import OPENAI_CONCURRENCY, OPENAI_RPM
+        def load_tagger():
+            if not OPENAI_API_KEY:
+                return None
+            from openai_helpers import VisionTagger
+            return VisionTagger(concurrency=max(1, OPENAI_CONCURRENCY // processes), rpm=OPENAI_RPM / processes)
+        registry.register("openai_tagger", load_tagger)
+    _worker["pool"] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="worker-decode")
+    _worker["dedup"] = load_dedup_index()
+
+def _work_shard(entries: List[dict]):
+    """
+    Decode + models for one shard in a worker process.
+    Returns (picklable items, face-gate counts, number of undecodable files).
+    """
+    before = dict(face_stats)
+    batch = [it for it in _worker["pool"].map(_load, entries) if it is not None]
+    undecodable = len(entries) - len(batch)
+    if batch:
+        batch = _run_models(batch, _worker.get("dedup"))
+    for it in batch:
+        it.pop("dup_ref", None)
+    return batch, {key: face_stats[key] - before[key] for key in face_stats}, undecodable
+
+class _Run:
+    """Counters and the optional progress/control hooks of one ingest run."""
+
+    def __init__(self, progress: Optional[Callable[[dict], None]], control: Optional[Callable[[], None]]):
+        self.progress, self.control = progress, control
+        self.counts = {"phase": "scanning", "seen": 0, "todo": 0, "processed": 0, "skipped": 0, "failed": 0}
+        self.extra: dict = {}  # phase counters beyond the indexing ones, reported in detail
+        self.lock = threading.Lock()
 
+    def report(self, final: bool = False):
+        if self.progress is not None:
+            detail = dict(face_stats) if INDEX_MODE == "FULL" else {}
+            detail.update(self.extra)
+            self.progress(dict(self.counts, detail=detail or None, final=final))
+
+    def checkpoint(self):
+        if self.control is not None:
+            self.control()
+
+    def counted(self, entries):
+        for e in entries:
+            if not e.get("dir"):
+                self.counts["seen"] += 1
+            yield e
+
+def _apply_delta(sess, manifest: dict, delta: dict, run: _Run, dedup: Optional[DedupIndex] = None) -> int:
+    """
+    Apply a manifest diff: adopt, move, remove, then index added + changed files. Returns the number
+    added. `dedup` is a duplicate index kept by the caller across runs (else one is built here).
+    """
+    counts = run.counts
+    # Rows indexed before fingerprints existed: record the fingerprint instead of re-indexing
+    if delta["adopt"]:
+        sess.bulk_update_mappings(ImageRow, [
+            {"id": manifest[str(e["path"])]["id"], "file_size": e["size"], "file_mtime": e["mtime"]}
+            for e in delta["adopt"]
+        ])
+        sess.commit()
+
+    if INDEX_MODE == "FULL":
+        _ensure_vector_metadata(sess)
+    if delta["moved"]:
+        _move_images(sess, delta["moved"])
+    stale = delta["deleted"] + [str(e["path"]) for e in delta["changed"]]
+    if stale:
+        _remove_images(sess, stale, dedup)
+
+    for key in face_stats:
+        face_stats[key] = 0
+    todo = delta["added"] + delta["changed"]
+    counts.update(phase="indexing", todo=len(todo), skipped=counts["seen"] - len(todo))
+    run.report()
+
+    store = get_store()
+    added = 0
+    def write(batch):
+        nonlocal added
+        try:
+            n = write_batch(sess, store, batch)
+        except BatchWriteError:
+            counts["failed"] += len(batch)
+            run.report(final=True)
+            raise  # the run (and its job) fails
+        added += n
+        counts["processed"] += n
+        run.report()
+        run.checkpoint()
+
+    if INGEST_PROCESSES > 1 and todo:
+        def write_shard(result):
+            batch, stats, undecodable = result
+            for key, n in stats.items():
+                face_stats[key] += n
+            counts["failed"] += undecodable
+            write(batch)
+
+        run_process_pipeline(
+            todo, _work_shard, write_shard, INGEST_PROCESSES, batch_size=CLIP_BATCH_SIZE,
+            initializer=_worker_init, initargs=(INGEST_WORKER_THREADS, INGEST_PROCESSES),
+            env=_thread_env(INGEST_WORKER_THREADS),
+        )
+    elif todo:
+        if dedup is None:
+            # Built after stale rows are gone, so copies only ever point at rows that still exist
+            dedup = load_dedup_index(sess)
+        def load(entry):
+            item = _load(entry)
+            if item is None:
+                with run.lock:
+                    counts["failed"] += 1
+            return item
+
+        def process(batch):
+            return _run_models(batch, dedup)
+
+        run_pipeline(
+            todo, load, process, write,
+            workers=INGEST_DECODE_WORKERS, batch_size=CLIP_BATCH_SIZE, queue_size=INGEST_QUEUE_SIZE,
+        )
+    if INDEX_MODE == "FULL" and face_stats["images"]:
+        log.info("face detection skipped on %d of %d images (%d re-run at %d px)", face_stats["skipped"],
+                 face_stats["images"], face_stats["large"], FACE_DET_SIZE_LARGE)
     return added
 
-def enroll_person_from_photos(name: str, files: List[str]):
+def ingest_folder(root: str, progress: Optional[Callable[[dict], None]] = None,
+                  control: Optional[Callable[[], None]] = None):
+    """
+    FULL mode:
+        - EXIF ts, caption (BLIP), CLIP image embed -> vector store, faces, red shirt, optional OpenAI tags
+    FAST mode:
+        - EXIF ts, basic dims (cheap), store path tokens into 'tags' JSON for SQL LIKE search
+        - No CLIP, no BLIP, no faces, no OpenAI calls
+
+    Incremental: the file-fingerprint manifest (manifest.py) is diffed against the scan (scanner.py,
+    a parallel walk that reuses the listings of unchanged directories), and only added/changed
+    files go through the pipeline; moved files are re-pointed, deleted ones dropped. A root that is
+    missing or can't be listed raises RootUnavailable before anything is deleted.
+
+    Runs as a staged pipeline (see pipeline.py): INGEST_DECODE_WORKERS threads decode files,
+    one model thread consumes batches of CLIP_BATCH_SIZE, and this thread writes the results.
+    Exact and near-duplicate copies reuse the model outputs of their canonical image (dedup.py).
+    With INGEST_PROCESSES > 1, decode + models are sharded across worker processes instead
+    (_work_shard); their results stream back here and are written the same way.
+
+    Hooks (used by the background worker, see jobs.py): `progress(counts)` gets the phase and the
+    seen/todo/processed/skipped/failed counters (plus, in a last "reading GPS" phase, the EXIF
+    position backfill of photos indexed before GPS was stored); `control()` runs between batches and may block
+    (pause) or raise (cancel), which stops the pipeline after the batch in hand.
+    """
+    # A missing or unreadable root (unplugged drive, unmounted share) aborts the run: nothing is deleted
+    rootp = Path(check_root(root))
+    sess = get_session()
+    run = _Run(progress, control)
+    run.report()
+    manifest = load_manifest(sess, rootp)
+    delta = diff_manifest(manifest, run.counted(scan_tree(rootp)), use_hash=INGEST_CONTENT_HASH)
+    if manifest and not run.counts["seen"] and len(delta["deleted"]) == len(manifest):
+        # e.g. the empty mount point of a share that is not mounted
+        raise RootUnavailable(errno.ENOENT, f"no photos found under {rootp}, but {len(manifest)} are indexed "
+                                            "there; is the drive mounted?")
+    run.checkpoint()
+    added = _apply_delta(sess, manifest, delta, run)
+    _backfill_gps(sess, rootp, run)
+    run.report(final=True)
+    return added
+
+def _absent(paths: Iterable[str], root: Optional[str]) -> List[dict]:
+    """
+    Directory entries for the diff (see manifest.diff_manifest) that confirm `paths` are gone: the
+    nearest existing directory above each one, if it can be listed and is not above `root`.
+    """
+    prefix = root.rstrip(os.sep) + os.sep if root is not None else None
+    listed = set()
+    for p in paths:
+        d = os.path.dirname(p)
+        while not os.path.isdir(d) and os.path.dirname(d) != d:
+            d = os.path.dirname(d)
+        if d in listed or (prefix is not None and d != root and not d.startswith(prefix)):
+            continue
+        try:
+            with os.scandir(d):
+                listed.add(d)
+        except OSError:
+            pass
+    return [{"path": Path(d), "dir": True, "listed": True} for d in listed]
+
+def ingest_changes(touched: Iterable[str], moves: Sequence[Tuple[str, str]] = (),
+                   progress: Optional[Callable[[dict], None]] = None,
+                   control: Optional[Callable[[], None]] = None, root: Optional[str] = None,
+                   dedup: Optional[DedupIndex] = None) -> int:
+    """
+    Incremental update for a known set of changes (watch mode, see watcher.py) without walking the tree.
+    `touched` are files or directories that may have been created, modified or deleted; `moves` are
+    (old, new) renames of files or directories reported by the OS, applied in place (row path,
+    vector id, thumbnail) without re-indexing. Deleted + re-created content is also matched as a
+    move by the manifest diff. A touched path is dropped from the index only once it is missing
+    from a directory that can still be listed (below `root`, the watched root, when given; a root
+    that is gone aborts the update). `dedup` (see load_dedup_index) is the duplicate index kept by
+    the watcher between batches; without it, one is built from the whole table. Returns the number
+    of photos added.
+    """
+    if root is not None:
+        root = check_root(root)
+    sess = get_session()
+    run = _Run(progress, control)
+    exts = set(SUPPORTED_EXTS)
+    touched = {str(t) for t in touched}
+
+    # OS-reported renames: expand directory moves to the indexed files below them
+    moved = []
+    for old, new in moves:
+        pairs = renamed_paths(sess, str(old), str(new))
+        if not pairs:
+            touched.add(str(new))  # e.g. "x.jpg.part" -> "x.jpg", or not indexed yet
+        for old_p, new_p in pairs:
+            try:
+                st = os.stat(new_p)
+            except OSError:
+                st = None
+            if st is None or Path(new_p).suffix.lower() not in exts or is_excluded(new_p):
+                touched.add(old_p)  # gone again, or renamed to something we don't index
+                continue
+            moved.append((old_p, {"path": Path(new_p), "size": st.st_size, "mtime": st.st_mtime}))
+    if moved:
+        # a rename over an indexed file replaces it
+        replaced = load_manifest_paths(sess, [str(e["path"]) for _, e in moved])
+        if replaced:
+            _remove_images(sess, list(replaced), dedup)
+        _move_images(sess, moved)
+
+    # Everything else: diff the touched paths (and the indexed files under touched directories)
+    files, dirs = [], []
+    for p in touched:
+        if is_excluded(p):
+            continue  # e.g. a NAS thumbnail folder (SCAN_EXCLUDE)
+        if Path(p).suffix.lower() in exts and not os.path.isdir(p):
+            files.append(p)
+        else:
+            dirs.append(p)
+    manifest = load_manifest_paths(sess, files, dirs)
+    scanned, missing = [], []
+    for p in files:
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            missing.append(p)
+            continue
+        except OSError:
+            continue  # e.g. no permission right now: leave its row alone
+        scanned.append({"path": Path(p), "size": st.st_size, "mtime": st.st_mtime})
+    for d in dirs:
+        if os.path.isdir(d):
+            scanned.extend(scan_tree(Path(d)))
+        elif not os.path.lexists(d):
+            missing.append(d)
+    scanned.extend(_absent(missing, root))
+    delta = diff_manifest(manifest, run.counted(scanned), use_hash=INGEST_CONTENT_HASH)
+    added = _apply_delta(sess, manifest, delta, run, dedup)
+    run.report(final=True)
+    return added
+
+def enroll_person_from_photos(name: str, files: List[str]) -> int:
+    """
+    Add the largest face of each file to `name`'s references; returns how many were added.
+    Existing faces are re-labeled by a "relabel" job in the worker (see relabel_faces).
+    """
     # Person enrollment only makes sense in FULL mode where we use faces.
     if INDEX_MODE != "FULL":
-        return
+        return 0
     from faces import register_person, detect_faces
     embs = []
     for fp in files:
         try:
-            pil = Image.open(fp).convert("RGB")
-            det = detect_faces(pil)
+            img = load_image(Path(fp))
+            if img is None:
+                continue
+            det = detect_faces(img["pil"])
             if not det:
                 continue
             det = sorted(det, key=lambda d: (d["bbox"][2]-d["bbox"][0])*(d["bbox"][3]-d["bbox"][1]), reverse=True)
             embs.append(det[0]["embedding"])
         except Exception:
             continue
-    register_person(name, embs)
\ No newline at end of file
+    register_person(name, embs)
+    return len(embs)
+
+def relabel_faces(thr: float = 0.4) -> int:
+    """
+    Re-score every stored face embedding (face_store) against the current person gallery and
+    update faces.person_name where the answer changed. Runs after enrollment, as a worker job (it
+    writes vector metadata), instead of a full re-index; faces indexed before embeddings were
+    stored are left as they are.
+    Returns the number of faces whose label changed.
+    """
+    if INDEX_MODE != "FULL":
+        return 0
+    from faces import gallery
+    from sqlalchemy import update
+    sess = get_session()
+    current = {fid: (image_id, name) for fid, image_id, name in
+               sess.query(FaceRow.id, FaceRow.image_id, FaceRow.person_name).all()}
+    changes, images, cleared = [], set(), set()
+    for ids, embs in face_store.iter_chunks():
+        for fid, (name, _) in zip(ids.tolist(), gallery.match(embs, thr)):
+            if fid not in current:
+                continue
+            image_id, old = current[fid]
+            if (old or "") != name:
+                changes.append({"id": fid, "person_name": name or None})
+                images.add(image_id)
+                if old:
+                    cleared.add(old)
+    for i in range(0, len(changes), 5000):
+        sess.execute(update(FaceRow), changes[i:i + 5000])
+    if changes:
+        bump_index_generation(sess)
+    sess.commit()
+    # Person filters are pushed into the vector query, so the vector metadata must follow
+    if images:
+        sync_vector_metadata(sess, get_store(), images, cleared_names=cleared)
+    return len(changes)
@@ -0,0 +1,211 @@
+import json
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import select, text, update
+
+from config import DATA_DIR
+from db import Job, get_session
+
+# Persistent job queue for background indexing.
+#
+# The UI enqueues jobs and posts pause/resume/cancel requests into jobs.control; the worker
+# process (worker.py) claims queued jobs, runs ingest_folder with the JobHooks below, and writes
+# progress back into the same row, which the UI polls. Jobs survive UI reruns, closed tabs and
+# worker restarts (a job whose worker died is queued again; ingest is incremental).
+# Besides indexing a folder, a job can re-label stored faces after a person was enrolled (kind
+# "relabel"), so every vector-store write happens in the worker process.
+
+HEARTBEAT_S = 5.0
+
+def worker_lock():
+    """
+    Exclusive, non-blocking lock on DATA_DIR/worker.lock, held for the life of the process by the
+    worker (and by offline maintenance such as thumbstore compaction); None if another process
+    holds it. POSIX only; elsewhere every caller gets it.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return object()
+    f = open(DATA_DIR / "worker.lock", "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+class JobCancelled(Exception):
+    pass
+
+def _now() -> datetime:
+    return datetime.now()
+
+def _as_dict(j: Job) -> dict:
+    return {c.name: getattr(j, c.name) for c in Job.__table__.columns}
+
+def enqueue(root: str, kind: str = "index") -> int:
+    sess = get_session()
+    try:
+        job = Job(root=str(root), kind=kind, state="queued", created_at=_now(), updated_at=_now(),
+                  seen=0, todo=0, processed=0, skipped=0, failed=0)
+        sess.add(job)
+        sess.commit()
+        return job.id
+    finally:
+        sess.close()
+
+def recent(limit: int = 10) -> List[dict]:
+    sess = get_session()
+    try:
+        return [_as_dict(j) for j in sess.execute(select(Job).order_by(Job.id.desc()).limit(limit)).scalars()]
+    finally:
+        sess.close()
+
+def get(job_id: int) -> Optional[dict]:
+    sess = get_session()
+    try:
+        j = sess.get(Job, job_id)
+        return _as_dict(j) if j is not None else None
+    finally:
+        sess.close()
+
+def _update(job_id: int, where=None, **values) -> bool:
+    sess = get_session()
+    try:
+        stmt = update(Job).where(Job.id == job_id)
+        if where is not None:
+            stmt = stmt.where(where)
+        n = sess.execute(stmt.values(updated_at=_now(), **values)).rowcount
+        sess.commit()
+        return n > 0
+    finally:
+        sess.close()
+
+# ---- requests from the UI ----
+
+def cancel(job_id: int):
+    # not started yet: cancel right away; otherwise the worker stops at its next checkpoint
+    if not _update(job_id, Job.state.in_(["queued", "paused"]) & Job.started_at.is_(None),
+                   state="cancelled", finished_at=_now()):
+        _update(job_id, Job.state.in_(["running", "paused"]), control="cancel")
+
+def pause(job_id: int):
+    if not _update(job_id, (Job.state == "queued"), state="paused"):
+        _update(job_id, Job.state == "running", control="pause")
+
+def resume(job_id: int):
+    if not _update(job_id, (Job.state == "paused") & Job.started_at.is_(None), state="queued"):
+        _update(job_id, Job.state == "paused", control="resume")
+
+# ---- worker side ----
+
+def claim_next() -> Optional[dict]:
+    """Mark the oldest queued job as running and return it (None when the queue is empty)."""
+    sess = get_session()
+    try:
+        while True:
+            job_id = sess.execute(select(Job.id).where(Job.state == "queued").order_by(Job.id).limit(1)).scalar()
+            if job_id is None:
+                return None
+            n = sess.execute(update(Job).where(Job.id == job_id, Job.state == "queued").values(
+                state="running", control=None, started_at=_now(), updated_at=_now(), error=None,
+            )).rowcount
+            sess.commit()
+            if n:
+                return _as_dict(sess.get(Job, job_id))
+    finally:
+        sess.close()
+
+def requeue_orphans() -> int:
+    """
+    Jobs left running by a worker that died go back to the queue. Jobs the user paused stay paused;
+    they are only detached from the dead worker (started_at cleared), so resume() queues them again.
+    """
+    sess = get_session()
+    try:
+        n = sess.execute(update(Job).where(Job.state == "running", Job.started_at.isnot(None))
+                         .values(state="queued", control=None, updated_at=_now())).rowcount
+        sess.execute(update(Job).where(Job.state == "paused", Job.started_at.isnot(None))
+                     .values(started_at=None, control=None, updated_at=_now()))
+        sess.commit()
+        return n
+    finally:
+        sess.close()
+
+def finish(job_id: int, state: str, error: Optional[str] = None):
+    _update(job_id, state=state, control=None, error=error, eta_s=None, finished_at=_now())
+
+def heartbeat():
+    sess = get_session()
+    try:
+        sess.execute(text(
+            "INSERT INTO meta (key, value) VALUES ('worker_heartbeat', :t) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+        ), {"t": str(time.time())})
+        sess.commit()
+    finally:
+        sess.close()
+
+def worker_alive() -> bool:
+    sess = get_session()
+    try:
+        v = sess.execute(text("SELECT value FROM meta WHERE key = 'worker_heartbeat'")).scalar()
+    finally:
+        sess.close()
+    try:
+        return time.time() - float(v) < 3 * HEARTBEAT_S
+    except (TypeError, ValueError):
+        return False
+
+class JobHooks:
+    """progress/control callbacks for ingest_folder that mirror the run into a job row."""
+
+    def __init__(self, job_id: int, min_interval: float = 0.5):
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self._last = 0.0
+        self._t0: Optional[float] = None  # start of the indexing phase
+        self._paused_s = 0.0
+
+    def progress(self, counts: Dict):
+        now = time.monotonic()
+        phase = counts.get("phase")
+        if phase == "indexing" and self._t0 is None:
+            self._t0 = now
+        if now - self._last < self.min_interval and not counts.get("final"):
+            return
+        self._last = now
+        values = {k: counts[k] for k in ("phase", "seen", "todo", "processed", "skipped", "failed") if k in counts}
+        if self._t0 is not None and phase == "indexing":
+            active = max(1e-6, now - self._t0 - self._paused_s)
+            done = counts.get("processed", 0) + counts.get("failed", 0)
+            values["rate"] = counts.get("processed", 0) / active
+            left = counts.get("todo", 0) - done
+            values["eta_s"] = left / (done / active) if done and left > 0 else None
+        if counts.get("detail"):
+            values["detail"] = json.dumps(counts["detail"])
+        _update(self.job_id, **values)
+
+    def control(self):
+        """Called between batches: raises JobCancelled, or blocks while the job is paused."""
+        job = get(self.job_id)
+        if job is None or job["control"] is None:
+            return
+        if job["control"] == "cancel":
+            raise JobCancelled()
+        if job["control"] == "pause":
+            _update(self.job_id, state="paused", control=None, eta_s=None)
+            t = time.monotonic()
+            while True:
+                time.sleep(1.0)
+                job = get(self.job_id)
+                if job is None or job["control"] == "cancel":
+                    self._paused_s += time.monotonic() - t
+                    raise JobCancelled()
+                if job["control"] == "resume":
+                    break
+            self._paused_s += time.monotonic() - t
+            _update(self.job_id, state="running", control=None)
@@ -0,0 +1,152 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from db import Image as ImageRow
+
+# File-fingerprint manifest for incremental indexing.
+#
+# Every indexed image row carries (file_size, file_mtime, content_hash). At the start of a run the
+# fingerprints under the root are loaded into memory with one SELECT, and the scanned files are
+# diffed against them:
+#   added    - on disk, not in the manifest
+#   changed  - in the manifest, but size or mtime differ (re-indexed)
+#   moved    - a vanished manifest entry whose content reappears under a new path
+#   deleted  - in the manifest, missing from the completed listing of the nearest scanned directory
+#              above it (a directory that wasn't listed, e.g. an unmounted share, deletes nothing)
+#   adopt    - rows indexed before fingerprints existed; only their fingerprint is filled in
+# Rows are committed batch by batch together with their fingerprint, so after a crash the next
+# run simply sees the unfinished files as "added" again.
+
+_HASH_CHUNK = 1 << 20
+
+def file_hash(path: Path) -> Optional[str]:
+    """128-bit BLAKE2b of the file contents (hex)."""
+    try:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+                h.update(chunk)
+        return h.hexdigest()
+    except OSError:
+        return None
+
+def bytes_hash(data: bytes) -> str:
+    """Same digest as file_hash, for bytes already in memory."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _under(path: str, root: str) -> bool:
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def load_manifest(sess, root: Optional[Path] = None) -> Dict[str, dict]:
+    """path -> {"id", "size", "mtime", "hash"} for every indexed image (optionally only under root)."""
+    rows = sess.query(
+        ImageRow.id, ImageRow.path, ImageRow.file_size, ImageRow.file_mtime, ImageRow.content_hash
+    ).all()
+    r = str(root) if root is not None else None
+    return {
+        path: {"id": id_, "size": size, "mtime": mtime, "hash": chash}
+        for id_, path, size, mtime, chash in rows
+        if r is None or _under(path, r)
+    }
+
+def load_manifest_paths(sess, files: Iterable[str] = (), dirs: Iterable[str] = ()) -> Dict[str, dict]:
+    """Like load_manifest, but only for the given file paths and the indexed files under `dirs`."""
+    cols = (ImageRow.id, ImageRow.path, ImageRow.file_size, ImageRow.file_mtime, ImageRow.content_hash)
+    files, rows = sorted(set(files)), []
+    for i in range(0, len(files), 500):
+        rows += sess.query(*cols).filter(ImageRow.path.in_(files[i:i + 500])).all()
+    for d in set(dirs):
+        prefix = d.rstrip(os.sep) + os.sep
+        rows += sess.query(*cols).filter(ImageRow.path.startswith(prefix, autoescape=True)).all()
+    return {
+        path: {"id": id_, "size": size, "mtime": mtime, "hash": chash}
+        for id_, path, size, mtime, chash in rows
+    }
+
+def renamed_paths(sess, old: str, new: str) -> List[Tuple[str, str]]:
+    """(old_path, new_path) for each indexed file affected by renaming `old` to `new` (a file or a directory)."""
+    if sess.query(ImageRow.id).filter(ImageRow.path == old).first() is not None:
+        return [(old, new)]
+    prefix = old.rstrip(os.sep) + os.sep
+    rows = sess.query(ImageRow.path).filter(ImageRow.path.startswith(prefix, autoescape=True)).all()
+    return [(p, os.path.join(new, p[len(prefix):])) for (p,) in rows]
+
+def _confirmed_gone(path: str, dirs: Dict[str, bool]) -> bool:
+    """True if the nearest scanned entry at or above `path` is a completely listed directory."""
+    d = path
+    while d not in dirs:
+        parent = os.path.dirname(d)
+        if parent == d:
+            return False  # nothing above it was scanned
+        d = parent
+    return dirs[d]
+
+def diff_manifest(manifest: Dict[str, dict], scanned: Iterable[dict], use_hash: bool = False) -> dict:
+    """
+    Diff scanned fingerprints against the manifest. Returns a dict with
+    "added"/"changed"/"adopt" (lists of scanned entries), "moved" (list of (old_path, scanned entry))
+    and "deleted" (list of old paths). With use_hash, a hash is computed for added files whose size
+    matches a deleted entry so moves are matched on content rather than on (size, mtime).
+    Directory entries ({"path", "dir": True, "listed": bool}, see scanner.py) say which listings
+    are complete; a manifest entry counts as gone only below one of those.
+    """
+    seen = set()
+    dirs: Dict[str, bool] = {}
+    added: List[dict] = []
+    changed: List[dict] = []
+    adopt: List[dict] = []
+    for e in scanned:
+        key = str(e["path"])
+        if e.get("dir"):
+            dirs[key] = e["listed"]
+            continue
+        seen.add(key)
+        m = manifest.get(key)
+        if m is None:
+            added.append(e)
+        elif m["size"] is None:
+            adopt.append(e)
+        elif m["size"] != e["size"] or m["mtime"] != e["mtime"]:
+            changed.append(e)
+
+    gone = [p for p in manifest if p not in seen and _confirmed_gone(p, dirs)]
+
+    # Move detection: only added files whose size matches a vanished entry are candidates.
+    by_size: Dict[int, List[str]] = {}
+    for p in gone:
+        if manifest[p]["size"] is not None:
+            by_size.setdefault(manifest[p]["size"], []).append(p)
+
+    moved: List[Tuple[str, dict]] = []
+    still_added: List[dict] = []
+    for e in added:
+        cands = by_size.get(e["size"])
+        match = None
+        if cands:
+            for old in cands:
+                m = manifest[old]
+                if use_hash and m["hash"]:
+                    if e.get("hash") is None:
+                        e["hash"] = file_hash(e["path"])
+                    if e["hash"] == m["hash"]:
+                        match = old
+                        break
+                elif m["mtime"] == e["mtime"]:
+                    match = old
+                    break
+        if match is not None:
+            cands.remove(match)
+            moved.append((match, e))
+        else:
+            still_added.append(e)
+
+    moved_from = {old for old, _ in moved}
+    return {
+        "added": still_added,
+        "changed": changed,
+        "moved": moved,
+        "deleted": [p for p in gone if p not in moved_from],
+        "adopt": adopt,
+    }
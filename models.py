@@ -0,0 +1,95 @@
+import importlib
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Union
+
+# Shared registry of lazily created model handles (CLIP, BLIP, InsightFace, the OpenAI clients).
+#
+# Nothing heavy is imported or loaded until a handle is first requested with registry.get(name),
+# so opening the UI, date-only searches and FAST mode never pay for model start-up. Loaders are
+# referenced as "module:function" so that even the defining module is imported on demand, and each
+# loader imports its heavy dependencies (torch, open_clip, transformers, insightface, the OpenAI
+# SDK) inside its body, so importing the module that defines it stays cheap as well.
+# registry.warm_up() optionally preloads handles on a background thread; registry.status()
+# reports where each one is.
+
+_LOADERS: Dict[str, str] = {
+    "clip": "embeddings:_load_clip",
+    "blip": "captions:_load_blip",
+    "faces": "faces:_load_face_app",
+    "openai": "openai_helpers:_load_client",
+    "openai_tagger": "openai_helpers:_load_tagger",
+}
+
+_MISSING = object()
+
+class ModelRegistry:
+    def __init__(self, loaders: Dict[str, Union[str, Callable[[], Any]]]):
+        self._loaders = dict(loaders)
+        self._models: Dict[str, Any] = {}
+        self._status: Dict[str, str] = {name: "not loaded" for name in loaders}
+        self._seconds: Dict[str, float] = {}
+        self._locks: Dict[str, threading.Lock] = {name: threading.Lock() for name in loaders}
+
+    def register(self, name: str, loader: Union[str, Callable[[], Any]]):
+        self._loaders[name] = loader
+        self._status.setdefault(name, "not loaded")
+        self._locks.setdefault(name, threading.Lock())
+
+    def _resolve(self, name: str) -> Callable[[], Any]:
+        loader = self._loaders[name]
+        if callable(loader):
+            return loader
+        mod, fn = loader.split(":")
+        return getattr(importlib.import_module(mod), fn)
+
+    def get(self, name: str) -> Any:
+        """The handle for `name`, loading it on first use (concurrent callers wait for one load)."""
+        m = self._models.get(name, _MISSING)
+        if m is not _MISSING:
+            return m
+        with self._locks[name]:
+            m = self._models.get(name, _MISSING)
+            if m is not _MISSING:
+                return m
+            self._status[name] = "loading"
+            t0 = time.perf_counter()
+            try:
+                m = self._resolve(name)()
+            except Exception as e:
+                self._status[name] = f"failed: {e}"
+                raise
+            self._seconds[name] = time.perf_counter() - t0
+            self._models[name] = m
+            self._status[name] = "ready"
+            return m
+
+    def loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def status(self) -> Dict[str, str]:
+        """name -> "not loaded" | "loading" | "ready (1.2s)" | "failed: ..." """
+        return {
+            name: f"{s} ({self._seconds[name]:.1f}s)" if s == "ready" and name in self._seconds else s
+            for name, s in self._status.items()
+        }
+
+    def warm_up(self, names: Optional[Iterable[str]] = None, background: bool = True) -> Optional[threading.Thread]:
+        """Load `names` (default: all) now, or on a daemon thread when background=True."""
+        names = [n for n in (names if names is not None else self._loaders) if n in self._loaders]
+
+        def run():
+            for n in names:
+                try:
+                    self.get(n)
+                except Exception:
+                    pass  # recorded in status()
+
+        if not background:
+            run()
+            return None
+        t = threading.Thread(target=run, name="model-warmup", daemon=True)
+        t.start()
+        return t
+
+registry = ModelRegistry(_LOADERS)
@@ -1,14 +1,31 @@
-import base64, io, json, re
-from typing import List
+import asyncio, base64, io, json, random, re, threading, time
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Optional, Tuple
 from PIL import Image
-from config import OPENAI_API_KEY, OPENAI_MODEL_TEXT, OPENAI_MODEL_VISION
-from openai import OpenAI
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from config import OPENAI_API_KEY, OPENAI_MODEL_TEXT, OPENAI_MODEL_VISION, OPENAI_BASE_URL, OPENAI_TIMEOUT
+from config import OPENAI_CONCURRENCY, OPENAI_RPM, OPENAI_MAX_RETRIES, OPENAI_UPLOAD_SIDE
+from db import TagCache
+from models import registry
+import querycache
 
-_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+def _load_client():
+    # None when no API key is configured; the SDK is imported only when a key exists
+    if not OPENAI_API_KEY:
+        return None
+    from openai import OpenAI
+    return OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, timeout=OPENAI_TIMEOUT)
+
+def _load_tagger():
+    if not OPENAI_API_KEY:
+        return None
+    return VisionTagger()
 
 def expand_query_with_openai(q: str) -> List[str]:
     """Expand a natural query into ~5-10 concise visual keywords for CLIP."""
-    if not _client: 
+    client = registry.get("openai")
+    if not client:
         return []
     prompt = f"""
     You are helping convert a user's photo search into visual keywords that a vision embedding
@@ -16,7 +33,7 @@ def expand_query_with_openai(q: str) -> List[str]:
     Query: "{q}"
     Only output the keywords, separated by commas.
     """
-    resp = _client.chat.completions.create(
+    resp = client.chat.completions.create(
         model=OPENAI_MODEL_TEXT,
         messages=[{"role":"user","content":prompt}],
         temperature=0.2,
@@ -27,28 +44,39 @@ def expand_query_with_openai(q: str) -> List[str]:
     kws = [t.strip() for t in re.split(r"[,\n]", text) if t.strip()]
     return kws[:10]
 
-def vision_tags_for_image(pil: Image.Image) -> List[str]:
-    """Ask a VLM to output 8-15 tags describing scene, objects, clothing colors, setting, etc."""
-    if not _client:
-        return []
+def expand_query_cached(q: str) -> List[str]:
+    """expand_query_with_openai, memoized by normalized query (querycache.py)."""
+    return querycache.cached(
+        "expand", q, OPENAI_MODEL_TEXT, lambda: expand_query_with_openai(q),
+        encode=lambda kws: json.dumps(kws).encode("utf-8"),
+        decode=lambda b: json.loads(b.decode("utf-8")),
+    )
+
+# ---- vision tagging ----
+# Requests run on a background event loop (VisionTagger) so ingest can submit a batch's uploads
+# before running its local models and collect the tags afterwards. At most OPENAI_CONCURRENCY
+# requests are in flight, a token bucket keeps the average at OPENAI_RPM, and transient errors
+# (connection, 429, 5xx) are retried with exponential backoff. Images are downscaled before upload.
+
+_TAG_PROMPT = "List 8-15 short tags (single words or 2-word phrases) for this photo: scene type, objects, setting (indoor/outdoor), activities, clothing colors, environment (e.g., beach, mountain, city), time of day. Output JSON array of strings only."
+
+def _encode_upload(pil: Image.Image, max_side: int = OPENAI_UPLOAD_SIDE) -> str:
+    im = pil.copy()
+    im.thumbnail((max_side, max_side))
     buf = io.BytesIO()
-    pil.save(buf, format="JPEG", quality=85)
-    b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-    messages = [{
+    im.save(buf, format="JPEG", quality=80)
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+def _tag_messages(b64: str) -> list:
+    return [{
         "role":"user",
         "content":[
-            {"type":"text","text":"List 8-15 short tags (single words or 2-word phrases) for this photo: scene type, objects, setting (indoor/outdoor), activities, clothing colors, environment (e.g., beach, mountain, city), time of day. Output JSON array of strings only."},
-            {"type":"image_url","image_url":{"url":f"data:image/jpeg;base64,{b64}"}}
+            {"type":"text","text":_TAG_PROMPT},
+            {"type":"image_url","image_url":{"url":f"data:image/jpeg;base64,{b64}","detail":"low"}}
         ]
     }]
-    resp = _client.chat.completions.create(
-        model=OPENAI_MODEL_VISION,
-        messages=messages,
-        temperature=0.2,
-        max_tokens=120,
-        response_format={ "type":"json_object" }  # model will return {"tags":[...]} or fallback text
-    )
-    out = resp.choices[0].message.content
+
+def _parse_tags(out: str) -> List[str]:
     # Be tolerant: accept either raw JSON array or {"tags":[...]} or comma text.
     try:
         data = json.loads(out)
@@ -59,4 +87,110 @@ def vision_tags_for_image(pil: Image.Image) -> List[str]:
     except Exception:
         pass
     # crude fallback: split on commas
-    return [t.strip() for t in re.split(r"[,\n]", out) if t.strip()][:15]
\ No newline at end of file
+    return [t.strip() for t in re.split(r"[,\n]", out) if t.strip()][:15]
+
+def _retry_delay(e: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying after `e`, or None if it isn't worth retrying."""
+    import openai
+    if isinstance(e, openai.APIConnectionError):  # includes timeouts
+        pass
+    elif isinstance(e, openai.APIStatusError) and (e.status_code == 429 or e.status_code >= 500):
+        try:
+            return float(e.response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    else:
+        return None
+    return min(30.0, 0.5 * 2 ** attempt) * (0.5 + random.random())
+
+class _TokenBucket:
+    """Allows `rate` acquisitions per second on average, in bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens = capacity
+        self.t = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.t) * self.rate)
+            self.t = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class VisionTagger:
+    """Tags images concurrently on a daemon event-loop thread; submit() may be called from any thread."""
+
+    def __init__(self, concurrency: int = OPENAI_CONCURRENCY, rpm: float = OPENAI_RPM,
+                 retries: int = OPENAI_MAX_RETRIES):
+        from openai import AsyncOpenAI
+        # retries are ours (they have to go through the rate limiter), so the SDK's are off
+        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL,
+                                  timeout=OPENAI_TIMEOUT, max_retries=0)
+        self.retries = retries
+        self._sem = asyncio.Semaphore(max(1, concurrency))
+        self._bucket = _TokenBucket(max(rpm, 1e-3) / 60.0, max(1, concurrency))
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="openai-tagger", daemon=True).start()
+
+    def submit(self, pil: Image.Image) -> Future:
+        """Start tagging `pil`; the Future resolves to its tag list (or raises after the last retry)."""
+        return asyncio.run_coroutine_threadsafe(self._tag(_encode_upload(pil)), self._loop)
+
+    async def _tag(self, b64: str) -> List[str]:
+        async with self._sem:
+            attempt = 0
+            while True:
+                await self._bucket.acquire()
+                try:
+                    resp = await self.client.chat.completions.create(
+                        model=OPENAI_MODEL_VISION,
+                        messages=_tag_messages(b64),
+                        temperature=0.2,
+                        max_tokens=120,
+                        response_format={ "type":"json_object" }  # model will return {"tags":[...]} or fallback text
+                    )
+                    return _parse_tags(resp.choices[0].message.content or "")
+                except Exception as e:
+                    delay = _retry_delay(e, attempt) if attempt < self.retries else None
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+
+def vision_tags_for_image(pil: Image.Image) -> List[str]:
+    """Ask a VLM to output 8-15 tags describing scene, objects, clothing colors, setting, etc."""
+    tagger = registry.get("openai_tagger")
+    if not tagger:
+        return []
+    return tagger.submit(pil).result()
+
+# ---- tag cache (content hash -> JSON tag list) ----
+
+def cached_tags(sess, hashes: Iterable[str]) -> Dict[str, str]:
+    """hash -> JSON tag list for hashes already tagged by the current OPENAI_MODEL_VISION."""
+    hashes = sorted({h for h in hashes if h})
+    out = {}
+    for i in range(0, len(hashes), 500):
+        rows = sess.execute(
+            select(TagCache.hash, TagCache.tags)
+            .where(TagCache.hash.in_(hashes[i:i + 500]), TagCache.model == OPENAI_MODEL_VISION)
+        ).all()
+        out.update(rows)
+    return out
+
+def remember_tags(sess, pairs: Iterable[Tuple[str, str]]):
+    """Store (hash, JSON tag list) pairs; committed with the caller's transaction."""
+    rows = {h: t for h, t in pairs if h and t}
+    if not rows:
+        return
+    stmt = sqlite_insert(TagCache).values(
+        [{"hash": h, "model": OPENAI_MODEL_VISION, "tags": t} for h, t in rows.items()]
+    )
+    sess.execute(stmt.on_conflict_do_update(
+        index_elements=[TagCache.hash],
+        set_={"model": stmt.excluded.model, "tags": stmt.excluded.tags},
+    ))
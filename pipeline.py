@@ -0,0 +1,195 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import os
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence
+
+# Staged ingest pipeline:
+#   decode  (thread pool: file I/O, JPEG decode, EXIF, thumbnails)
+#   models  (one thread, consumes batches so CLIP/BLIP see full batches)
+#   writer  (the calling thread; sole owner of the SQLite session and the vector store)
+# Stages are joined by bounded queues, so a slow stage back-pressures the ones before it
+# instead of letting decoded images pile up in memory.
+#
+# run_process_pipeline is the multi-core variant: decode + models run in worker processes (each
+# with its own model instances), and only their results come back to the calling process, which
+# still does every write.
+
+_DONE = object()
+_POLL_S = 0.2
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    # Blocking put that gives up once the pipeline is being torn down.
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_S)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while True:
+        try:
+            return q.get(timeout=_POLL_S)
+        except queue.Empty:
+            if stop.is_set():
+                return _DONE
+
+def run_pipeline(
+    inputs: Iterable[Any],
+    load: Callable[[Any], Optional[Dict[str, Any]]],
+    process: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]],
+    write: Callable[[List[Dict[str, Any]]], None],
+    workers: int = 4,
+    batch_size: int = 16,
+    queue_size: int = 64,
+) -> None:
+    """
+    Run `load` over `inputs` on `workers` threads, group the results into batches of up to
+    `batch_size` for `process` (one thread), and hand each processed batch to `write` on the
+    calling thread. `load` may return None to drop an input. At most `queue_size` loaded items
+    are in flight at once. The first exception raised by any stage stops the pipeline and is
+    re-raised here.
+    """
+    workers = max(1, workers)
+    batch_size = max(1, batch_size)
+    queue_size = max(batch_size, queue_size)
+
+    loaded_q: queue.Queue = queue.Queue(maxsize=queue_size)
+    batch_q: queue.Queue = queue.Queue(maxsize=max(2, queue_size // batch_size))
+    stop = threading.Event()
+    errors: List[BaseException] = []
+
+    def _fail(e: BaseException):
+        errors.append(e)
+        stop.set()
+
+    def decode_stage():
+        in_flight = threading.BoundedSemaphore(queue_size)
+
+        def _load_one(x):
+            try:
+                if stop.is_set():
+                    return
+                item = load(x)
+                if item is not None:
+                    _put(loaded_q, item, stop)
+            except BaseException as e:
+                _fail(e)
+            finally:
+                in_flight.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-decode") as ex:
+                for x in inputs:
+                    while not in_flight.acquire(timeout=_POLL_S):
+                        if stop.is_set():
+                            break
+                    if stop.is_set():
+                        break
+                    ex.submit(_load_one, x)
+        except BaseException as e:
+            _fail(e)
+        finally:
+            _put(loaded_q, _DONE, stop)
+
+    def model_stage():
+        batch: List[Dict[str, Any]] = []
+        try:
+            while True:
+                item = _get(loaded_q, stop)
+                if item is _DONE:
+                    break
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not _put(batch_q, process(batch), stop):
+                        return
+                    batch = []
+            if batch and not stop.is_set():
+                _put(batch_q, process(batch), stop)
+        except BaseException as e:
+            _fail(e)
+        finally:
+            _put(batch_q, _DONE, stop)
+
+    threads = [
+        threading.Thread(target=decode_stage, name="ingest-feed", daemon=True),
+        threading.Thread(target=model_stage, name="ingest-models", daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            batch = _get(batch_q, stop)
+            if batch is _DONE:
+                break
+            write(batch)
+    except BaseException as e:
+        _fail(e)
+    finally:
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+
+def run_process_pipeline(
+    inputs: Iterable[Any],
+    work: Callable[[List[Any]], Any],
+    write: Callable[[Any], None],
+    processes: int,
+    batch_size: int = 16,
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: Sequence[Any] = (),
+    env: Optional[Mapping[str, str]] = None,
+) -> None:
+    """
+    Shard `inputs` into batches of `batch_size` and run `work(batch)` on `processes` worker
+    processes (spawned, so each starts clean; `initializer(*initargs)` runs once in each).
+    `env` is set in os.environ while the pool exists, so workers start with it (settings such as
+    OMP_NUM_THREADS are read when numpy/torch load, before any initializer could set them).
+    Results are handed to `write` on the calling thread as they complete. At most two batches per
+    process are queued or running. `work` and its results must be picklable. The first exception
+    stops submitting new batches, cancels queued ones and is re-raised here.
+    """
+    processes = max(1, processes)
+    batch_size = max(1, batch_size)
+    ctx = multiprocessing.get_context("spawn")
+    saved = {k: os.environ.get(k) for k in (env or {})}
+    os.environ.update(env or {})
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=ctx,
+                                 initializer=initializer, initargs=tuple(initargs)) as ex:
+            pending = set()
+            it = iter(inputs)
+            exhausted = False
+            try:
+                while True:
+                    while not exhausted and len(pending) < 2 * processes:
+                        batch = []
+                        for x in it:
+                            batch.append(x)
+                            if len(batch) >= batch_size:
+                                break
+                        if len(batch) < batch_size:
+                            exhausted = True
+                        if batch:
+                            pending.add(ex.submit(work, batch))
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        write(fut.result())
+            except BaseException:
+                for fut in pending:
+                    fut.cancel()
+                raise
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
@@ -1,8 +1,11 @@
 import re
-from datetime import datetime
+from datetime import datetime, date, timedelta
 from dateutil import parser as dateparser
-from typing import Dict, Any
+from dateutil.easter import easter
+from dateutil.relativedelta import relativedelta, TH
+from typing import Dict, Any, Optional, Tuple
 from config import INDEX_MODE  # "FULL" or "FAST"
+from geo import find_place, normalize as normalize_place
 
 YEAR_RE = re.compile(r"(?:19|20)\d{2}")
 MONTHS = {
@@ -13,24 +16,169 @@ MONTHS = {
     )
 }
 
+# ---- Relative / named date phrases ----
+# Each resolves to a half-open [date_from, date_to) range that search serves from the ts index.
+# Seasons are northern-hemisphere meteorological seasons.
+SEASONS = {"spring": 3, "summer": 6, "fall": 9, "autumn": 9, "winter": 12}  # start month, 3 months long
+
+HOLIDAYS = {
+    "christmas eve": lambda y: (date(y, 12, 24), date(y, 12, 25)),
+    "christmas": lambda y: (date(y, 12, 24), date(y, 12, 27)),
+    "xmas": lambda y: (date(y, 12, 24), date(y, 12, 27)),
+    "new year's eve": lambda y: (date(y, 12, 31), date(y + 1, 1, 2)),
+    "new years eve": lambda y: (date(y, 12, 31), date(y + 1, 1, 2)),
+    "new year's day": lambda y: (date(y, 1, 1), date(y, 1, 2)),
+    # Thursday to Sunday (relativedelta applies days before weekday, so the 4 days are added after)
+    "thanksgiving": lambda y: (date(y, 11, 1) + relativedelta(weekday=TH(4)),
+                               date(y, 11, 1) + relativedelta(weekday=TH(4)) + timedelta(days=4)),
+    "halloween": lambda y: (date(y, 10, 31), date(y, 11, 1)),
+    "easter": lambda y: (easter(y) - timedelta(days=2), easter(y) + timedelta(days=2)),
+    "valentine's day": lambda y: (date(y, 2, 14), date(y, 2, 15)),
+    "valentines day": lambda y: (date(y, 2, 14), date(y, 2, 15)),
+    "4th of july": lambda y: (date(y, 7, 4), date(y, 7, 5)),
+    "fourth of july": lambda y: (date(y, 7, 4), date(y, 7, 5)),
+    "independence day": lambda y: (date(y, 7, 4), date(y, 7, 5)),
+}
+
+_YEAR = r"((?:19|20)\d{2})"
+_NAMED = "|".join(re.escape(n) for n in sorted(list(HOLIDAYS) + list(SEASONS), key=len, reverse=True))
+NAMED_RE = re.compile(rf"\b(?:(last|this|past)\s+)?({_NAMED})(?:\s+(?:of\s+)?{_YEAR})?\b")
+RELATIVE_RE = re.compile(
+    r"\b(today|yesterday|(?:this|last|past)\s+(?:week|month|year)|"
+    r"(?:last|past)\s+(\d+)\s+(days?|weeks?|months?|years?))\b"
+)
+BOUND_RE = re.compile(rf"\b(since|after|before)\s+{_YEAR}\b")
+
+def _dt(d: date) -> datetime:
+    return datetime(d.year, d.month, d.day)
+
+def _named_range(name: str, year: int) -> Tuple[date, date]:
+    if name in SEASONS:
+        start = date(year, SEASONS[name], 1)
+        return start, start + relativedelta(months=3)
+    return HOLIDAYS[name](year)
+
+def _resolve_named(qual: Optional[str], name: str, year: Optional[int], today: date) -> Tuple[date, date]:
+    if year:
+        return _named_range(name, year)
+    if qual == "this":
+        # the one we're in (in February, "this winter" started last December), else this year's
+        for y in (today.year, today.year - 1):
+            start, end = _named_range(name, y)
+            if start <= today < end:
+                return start, end
+        return _named_range(name, today.year)
+    # "last summer" / "past christmas": the most recent one that is already over
+    for y in (today.year, today.year - 1):
+        start, end = _named_range(name, y)
+        if end <= today:
+            return start, end
+    return _named_range(name, today.year - 2)
+
+def _relative_range(m: "re.Match", today: date) -> Tuple[date, date]:
+    phrase = m.group(1)
+    if phrase == "today":
+        return today, today + timedelta(days=1)
+    if phrase == "yesterday":
+        return today - timedelta(days=1), today
+    if m.group(2):
+        n = int(m.group(2))
+        unit = m.group(3).rstrip("s") + "s"
+        return today - relativedelta(**{unit: n}), today + timedelta(days=1)
+    qual, unit = phrase.split()
+    if unit == "week":
+        start = today - timedelta(days=today.weekday())
+        step = relativedelta(weeks=1)
+    elif unit == "month":
+        start = today.replace(day=1)
+        step = relativedelta(months=1)
+    else:
+        start = today.replace(month=1, day=1)
+        step = relativedelta(years=1)
+    if qual == "this":
+        return start, start + step
+    if qual == "past":
+        return today - step, today + timedelta(days=1)
+    return start - step, start
+
+def _parse_dates(ql: str, today: date) -> Tuple[Dict[str, Any], list]:
+    """
+    Find named/relative date phrases in the lowercased query.
+    Returns the date fields found and the (start, end) spans they occupy.
+    A fixed-date holiday without a year or qualifier ("christmas") matches every year via
+    month/day; a bare movable one ("easter", "thanksgiving") has no fixed month/day, so it means the
+    most recent one; a bare season ("summer") is left alone as a visual keyword.
+    """
+    found: Dict[str, Any] = {}
+    spans = []
+
+    m = NAMED_RE.search(ql)
+    if m:
+        qual, name, year = m.group(1), m.group(2), m.group(3)
+        if qual is None and year is None:
+            if name in {"easter", "thanksgiving"}:
+                start, end = _resolve_named(None, name, None, today)
+                found.update(date_from=_dt(start), date_to=_dt(end))
+                spans.append(m.span())
+            elif name in HOLIDAYS:
+                start, end = HOLIDAYS[name](today.year)
+                last = end - timedelta(days=1)
+                if start.month == last.month:
+                    found.update(month=start.month, day_from=start.day, day_to=last.day)
+                else:
+                    found.update(month=start.month, day_from=start.day, day_to=31)
+                spans.append(m.span())
+        else:
+            start, end = _resolve_named(qual, name, int(year) if year else None, today)
+            found.update(date_from=_dt(start), date_to=_dt(end))
+            spans.append(m.span())
+    if not spans:
+        m = RELATIVE_RE.search(ql)
+        if m:
+            start, end = _relative_range(m, today)
+            found.update(date_from=_dt(start), date_to=_dt(end))
+            spans.append(m.span())
+
+    for b in BOUND_RE.finditer(ql):
+        word, y = b.group(1), int(b.group(2))
+        if word == "before":
+            found["date_to"] = datetime(y, 1, 1)
+        else:
+            found["date_from"] = datetime(y + (1 if word == "after" else 0), 1, 1)
+        spans.append(b.span())
+    return found, spans
+
+def _blank(s: str, spans) -> str:
+    for a, b in spans:
+        s = s[:a] + " " * (b - a) + s[b:]
+    return s
+
 # Common stopwords we can safely ignore for keyword/path matching
 STOPWORDS = {
     "show","me","all","pictures","photos","from","with","in","of","our","trip","wearing",
     "the","a","an","to","pull","up","at","on"
 }
 
-def parse_query(q: str) -> Dict[str, Any]:
+def parse_query(q: str, now: Optional[datetime] = None) -> Dict[str, Any]:
     """
     Returns a dict: {
         'year': int|None,
         'month': int|None,
+        'day_from': int|None,      # day-of-month range within 'month' (e.g. bare "christmas";
+        'day_to': int|None,        # a bare "easter"/"thanksgiving" is the most recent one instead)
         'person': str|None,
         'red_shirt': bool,
         'keywords': [str,...],
-        'date_from': None,
-        'date_to': None
+        'phrases': [str,...],      # "double-quoted" parts of the query, matched verbatim
+        'date_from': datetime|None,  # half-open [date_from, date_to), from phrases like
+        'date_to': datetime|None,    # "last summer", "christmas 2021", "since 2019"
+        'place': str|None,           # gazetteer place name (see geo.py) and its
+        'bbox': tuple|None           # (lat_min, lat_max, lon_min, lon_max)
     }
 
+    A place name is a location filter, not a keyword (nor a person). Names that are also everyday
+    words ("china", "aspen") only count as places when capitalized or after "in"/"at"/"near".
+
     In FAST mode:
       - We DO NOT remove a detected person token from keywords.
       - We also force-add any detected person token back into keywords (lowercased).
@@ -39,11 +187,16 @@ def parse_query(q: str) -> Dict[str, Any]:
     out = {
         "year": None,
         "month": None,
+        "day_from": None,
+        "day_to": None,
         "person": None,
         "red_shirt": False,
         "keywords": [],
+        "phrases": [],
         "date_from": None,
         "date_to": None,
+        "place": None,
+        "bbox": None,
     }
 
     if not q or not q.strip():
@@ -52,35 +205,50 @@ def parse_query(q: str) -> Dict[str, Any]:
     q_str = q.strip()
     ql = q_str.lower()
 
+    # Quoted phrases
+    out["phrases"] = [p.strip().lower() for p in re.findall(r'"([^"]+)"', q_str) if p.strip()]
+
     # Flags
     if "red shirt" in ql or "red top" in ql:
         out["red_shirt"] = True
 
-    # Year
-    years = YEAR_RE.findall(q_str)
-    if years:
-        # re.findall gives full matches thanks to non-capturing group
-        y = re.findall(r"(?:19|20)\d{2}", q_str)
-        if y:
-            out["year"] = int(y[0])
+    # Named / relative dates ("last summer", "christmas 2021"); their words don't become keywords
+    dates, spans = _parse_dates(ql, (now or datetime.now()).date())
+    out.update(dates)
+    if spans and len(ql) == len(q_str):
+        ql, q_str = _blank(ql, spans), _blank(q_str, spans)
+
+    # Year (a named range like "winter 2020" already pins the dates and may span two years)
+    if out["date_from"] is None and out["date_to"] is None:
+        years = YEAR_RE.findall(q_str)
+        if years:
+            out["year"] = int(years[0])
+
+    # Place ("2022 Cancun", "beach in bali")
+    place_words = set()
+    hit = find_place(q_str)
+    if hit:
+        out["place"], out["bbox"], words = hit
+        place_words = set(words)
 
     # Month
-    for name, num in MONTHS.items():
-        if name in ql:
-            out["month"] = num
-            break
+    if out["month"] is None and out["date_from"] is None:
+        for name, num in MONTHS.items():
+            if name in ql:
+                out["month"] = num
+                break
 
     # Naive person heuristic (capitalized token following 'of'/'for', or first standalone capitalized token)
     person = None
     m = re.search(r"(?:\bof\b|\bfor\b)\s+([A-Z][a-zA-Z]+)", q_str)
-    if m:
+    if m and m.group(1).lower() not in place_words:
         person = m.group(1)
     else:
         caps = re.findall(r"\b([A-Z][a-zA-Z]+)\b", q_str)
         # Skip months and years
         for c in caps:
             cl = c.lower()
-            if cl not in MONTHS and not re.match(r"(?:19|20)\d{2}", c):
+            if cl not in MONTHS and cl not in place_words and not re.match(r"(?:19|20)\d{2}", c):
                 person = c
                 break
     if person:
@@ -89,7 +257,7 @@ def parse_query(q: str) -> Dict[str, Any]:
     # Build keywords:
     # - break into alpha tokens from the ORIGINAL query (to keep proper words)
     # - drop months, years, and obvious stopwords
-    tokens = [t for t in re.findall(r"[A-Za-z]+", q_str)]
+    tokens = [t for t in re.findall(r"[^\W\d_]+", q_str)]
     kw = []
     for t in tokens:
         tl = t.lower()
@@ -99,6 +267,8 @@ def parse_query(q: str) -> Dict[str, Any]:
             continue
         if YEAR_RE.fullmatch(t):
             continue
+        if place_words and normalize_place(tl) in place_words:
+            continue
         kw.append(tl)
 
     # In FULL mode, old behavior was to remove the person token from keywords to reduce duplication.
@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import TEXT_EMB_CACHE_SIZE, QUERY_CACHE_PERSIST
+from db import QueryCache, get_session
+
+# Memoization for the query path (CLIP text embeddings, OpenAI query expansions).
+#
+# Keys are normalized query text. Lookups go to an in-process LRU first, then (when
+# QUERY_CACHE_PERSIST) to the query_cache table, so popular queries survive restarts; only a miss
+# in both computes. Entries are tagged with the model that produced them and ignored if it changes.
+
+class LRU:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._d: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._d:
+                return default
+            self._d.move_to_end(key)
+            return self._d[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._d[key] = value
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+_memory = LRU(TEXT_EMB_CACHE_SIZE)
+_MISS = object()
+_read_only = False
+
+def set_read_only(flag: bool = True):
+    """Stop writing the query_cache table from this process (ingest workers leave writes to the coordinator)."""
+    global _read_only
+    _read_only = flag
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def _load(kind: str, key: str, model: str) -> Optional[bytes]:
+    sess = get_session()
+    try:
+        return sess.execute(select(QueryCache.value).where(
+            QueryCache.kind == kind, QueryCache.key == key, QueryCache.model == model
+        )).scalar()
+    finally:
+        sess.close()
+
+def _store(kind: str, key: str, model: str, value: bytes):
+    sess = get_session()
+    try:
+        stmt = sqlite_insert(QueryCache).values(kind=kind, key=key, model=model, value=value)
+        sess.execute(stmt.on_conflict_do_update(
+            index_elements=[QueryCache.kind, QueryCache.key],
+            set_={"model": stmt.excluded.model, "value": stmt.excluded.value},
+        ))
+        sess.commit()
+    finally:
+        sess.close()
+
+def cached(kind: str, text: str, model: str, compute: Callable[[], Any],
+           encode: Callable[[Any], bytes], decode: Callable[[bytes], Any]) -> Any:
+    """compute() for `text`, memoized in memory and (optionally) SQLite under (kind, normalized text, model)."""
+    key = normalize(text)
+    mkey = (kind, key, model)
+    v = _memory.get(mkey, _MISS)
+    if v is not _MISS:
+        return v
+    if QUERY_CACHE_PERSIST:
+        try:
+            raw = _load(kind, key, model)
+        except Exception:
+            raw = None
+        if raw is not None:
+            v = decode(raw)
+            _memory.put(mkey, v)
+            return v
+    v = compute()
+    _memory.put(mkey, v)
+    if QUERY_CACHE_PERSIST and not _read_only:
+        try:
+            _store(kind, key, model, encode(v))
+        except Exception:
+            pass  # e.g. database busy; the in-memory entry still serves this process
+    return v
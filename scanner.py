@@ -0,0 +1,173 @@
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import SUPPORTED_EXTS, SCAN_THREADS, SCAN_DIR_CACHE, SCAN_INCLUDE, SCAN_EXCLUDE
+from db import DirCache, get_session
+
+# Folder scan for ingest: yields {"path", "size", "mtime"} for every photo under a root, as a stream,
+# plus {"path", "dir": True, "listed": True} for every directory whose listing is complete, so the
+# manifest diff only drops rows whose directory was actually read (see manifest.diff_manifest).
+# A directory (or entry) that can't be read right now - permissions, a flaky NAS - is yielded with
+# "listed": False instead, and the indexed files below it are kept.
+#
+# Directories are listed with os.scandir on SCAN_THREADS threads (on a NAS the walk is bound by
+# round trips, not CPU). Each directory's listing (photo names, subdirectories) is cached in the
+# dir_cache table with the directory's mtime; while that mtime is unchanged the directory isn't read
+# again, but its photos are still stat'ed: a file rewritten in place keeps the directory's mtime, and
+# its new size/mtime is what the manifest diff re-indexes it by. Subdirectories are still visited:
+# a change below does not touch the parent's mtime.
+# Names matching SCAN_EXCLUDE (files and directories) are skipped; with SCAN_INCLUDE only matching
+# photos are yielded. A glob containing "/" is matched against the path relative to the root.
+
+class RootUnavailable(OSError):
+    """The root is missing or can't be listed (e.g. an unplugged drive): the run must not delete anything."""
+
+_RACY_S = 2.0  # a directory modified this recently may change again within its mtime tick: don't cache it
+
+def _match(globs: List[str], name: str, rel: str) -> bool:
+    return any(fnmatch(rel if "/" in g else name, g) for g in globs)
+
+def is_excluded(path: str, exclude: Iterable[str] = SCAN_EXCLUDE) -> bool:
+    """True if any component of `path` matches a (name-only) SCAN_EXCLUDE glob."""
+    globs = [g for g in exclude if "/" not in g]
+    return any(fnmatch(part, g) for part in Path(path).parts for g in globs)
+
+def check_root(root) -> str:
+    """The expanded root path; raises RootUnavailable unless it is a directory that can be listed."""
+    top = str(Path(root).expanduser())
+    try:
+        with os.scandir(top):
+            pass
+    except OSError as e:
+        raise RootUnavailable(e.errno, f"photo root {top} is not available ({e.strerror or e})") from e
+    return top
+
+_UNLISTED = object()  # _list_dir's listing for a directory that could not be read
+
+def _list_dir(path: str, cached: Optional[Tuple[int, str]]) -> Tuple[object, Optional[int], bool]:
+    """
+    (listing, mtime_ns, fresh) of one directory; the cached names when its mtime is unchanged, with
+    each photo stat'ed again. listing is _UNLISTED if the directory can't be read; names in
+    listing["errors"] couldn't be stat'ed.
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return _UNLISTED, None, False
+    if cached is not None and cached[0] == mtime_ns:
+        try:
+            listing = json.loads(cached[1])
+        except ValueError:
+            listing = None
+        if listing is not None:
+            files, errors = [], []
+            for name, *_ in listing["files"]:
+                try:
+                    st = os.stat(os.path.join(path, name))
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    errors.append(name)
+                    continue
+                files.append([name, st.st_size, st.st_mtime])
+            listing = {"files": files, "dirs": listing["dirs"]}
+            if errors:
+                listing["errors"] = errors
+            return listing, mtime_ns, False
+    files, dirs, errors = [], [], []
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        dirs.append(e.name)
+                    elif os.path.splitext(e.name)[1].lower() in SUPPORTED_EXTS and e.is_file():
+                        st = e.stat()
+                        files.append([e.name, st.st_size, st.st_mtime])
+                except OSError:
+                    errors.append(e.name)
+    except OSError:
+        return _UNLISTED, None, False
+    listing = {"files": files, "dirs": dirs}
+    if errors:
+        listing["errors"] = errors
+    return listing, mtime_ns, True
+
+def _load_cache(sess, root: str) -> Dict[str, Tuple[int, str]]:
+    prefix = root.rstrip(os.sep) + os.sep
+    rows = sess.execute(
+        select(DirCache.path, DirCache.mtime_ns, DirCache.listing)
+        .where((DirCache.path == root) | DirCache.path.startswith(prefix, autoescape=True))
+    ).all()
+    return {p: (m, l) for p, m, l in rows}
+
+def _save_cache(sess, root: str, fresh: List[dict], visited: set, old: Dict[str, Tuple[int, str]]):
+    for i in range(0, len(fresh), 500):
+        stmt = sqlite_insert(DirCache).values(fresh[i:i + 500])
+        sess.execute(stmt.on_conflict_do_update(
+            index_elements=[DirCache.path],
+            set_={"mtime_ns": stmt.excluded.mtime_ns, "listing": stmt.excluded.listing},
+        ))
+    # directories that are gone (or now excluded)
+    gone = [p for p in old if p not in visited]
+    for i in range(0, len(gone), 500):
+        sess.query(DirCache).filter(DirCache.path.in_(gone[i:i + 500])).delete(synchronize_session=False)
+    sess.commit()
+
+def scan_tree(root: Path, threads: int = SCAN_THREADS, use_cache: bool = SCAN_DIR_CACHE,
+              include: Iterable[str] = SCAN_INCLUDE, exclude: Iterable[str] = SCAN_EXCLUDE) -> Iterator[dict]:
+    """
+    Yield {"path", "size", "mtime"} for every photo under root while the walk is still running, and a
+    {"path", "dir": True, "listed": bool} entry for each directory visited ("listed": False for one
+    that could not be read, and for entries of a listing that could not be stat'ed).
+    """
+    top = str(Path(root).expanduser())
+    include, exclude = list(include), list(exclude)
+    sess = get_session() if use_cache else None
+    try:
+        cache = _load_cache(sess, top) if sess is not None else {}
+        fresh, visited = [], set()
+        now = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="scan") as pool:
+            def submit(d):
+                return pool.submit(_list_dir, d, cache.get(d))
+            pending = {submit(top): top}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    d = pending.pop(fut)
+                    listing, mtime_ns, is_fresh = fut.result()
+                    visited.add(d)  # an unreadable directory keeps its cached listing
+                    if listing is _UNLISTED:
+                        yield {"path": Path(d), "dir": True, "listed": False}
+                        continue
+                    yield {"path": Path(d), "dir": True, "listed": True}
+                    for name in listing.get("errors", ()):
+                        yield {"path": Path(d, name), "dir": True, "listed": False}
+                    cacheable = is_fresh and not listing.get("errors") and now - mtime_ns / 1e9 > _RACY_S
+                    if cacheable and sess is not None:
+                        fresh.append({"path": d, "mtime_ns": mtime_ns, "listing": json.dumps(listing)})
+                    rel_dir = os.path.relpath(d, top).replace(os.sep, "/")
+                    rel_dir = "" if rel_dir == "." else rel_dir + "/"
+                    for name in listing["dirs"]:
+                        if not _match(exclude, name, rel_dir + name):
+                            sub = os.path.join(d, name)
+                            pending[submit(sub)] = sub
+                    for name, size, mtime in listing["files"]:
+                        rel = rel_dir + name
+                        if _match(exclude, name, rel) or (include and not _match(include, name, rel)):
+                            continue
+                        yield {"path": Path(d, name), "size": size, "mtime": mtime}
+        if sess is not None:
+            _save_cache(sess, top, fresh, visited, cache)
+    finally:
+        if sess is not None:
+            sess.close()
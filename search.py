@@ -1,9 +1,15 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from db import get_session, Image as ImageRow, Face as FaceRow
-from sqlalchemy import extract, or_
-import chromadb
+from sqlalchemy import and_, or_, Integer, column, text
+from sqlalchemy.exc import OperationalError
+import fts
+import geo
 import json
-from config import CHROMA_DIR, INDEX_MODE
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from config import INDEX_MODE, RED_SHIRT_MIN_RATIO, SEARCH_COLLAPSE_DUPS
+from config import OPENAI_API_KEY, USE_OPENAI_EXPAND_QUERY, EXPAND_DEADLINE_S
+from vectorstore import get_store
 
 # Conditional import for CLIP text embeddings
 if INDEX_MODE == "FULL":
@@ -11,11 +17,8 @@ if INDEX_MODE == "FULL":
 else:
     text_embedding = None  # type: ignore
 
-client = chromadb.PersistentClient(path=str(CHROMA_DIR))
-collection = client.get_or_create_collection(name="photos")
-
 def _sql_like_filters(kws: List[str]):
-    """Generate SQLAlchemy LIKE conditions for path/caption/tags JSON (stored as text)."""
+    """LIKE conditions for path/caption/tags JSON; only used if the FTS5 index is unavailable."""
     likes = []
     for kw in kws:
         pat = f"%{kw}%"
@@ -24,48 +27,170 @@ def _sql_like_filters(kws: List[str]):
         likes.append(ImageRow.tags.ilike(pat))     # tags is JSON string
     return or_(*likes) if likes else None
 
-def search(qobj: Dict[str, Any], k: int = 100) -> List[ImageRow]:
-    sess = get_session()
+def _date_filters(base, qobj: Dict[str, Any]):
+    """Date constraints as plain comparisons on indexed columns (ts, year/month/day)."""
+    if qobj.get("date_from"):
+        base = base.filter(ImageRow.ts >= qobj["date_from"])
+    if qobj.get("date_to"):
+        base = base.filter(ImageRow.ts < qobj["date_to"])
+    if qobj.get("year"):
+        base = base.filter(ImageRow.year == qobj["year"])
+    if qobj.get("month"):
+        base = base.filter(ImageRow.month == qobj["month"])
+        if qobj.get("day_from"):
+            base = base.filter(ImageRow.day >= qobj["day_from"])
+        if qobj.get("day_to"):
+            base = base.filter(ImageRow.day <= qobj["day_to"])
+    return base
+
+def _place_filter(qobj: Dict[str, Any]):
+    """
+    Inside the place's bounding box (an R*Tree lookup, see geo.py), or, for photos without a
+    GPS position, the place name in their path/caption/tags (e.g. a "Cancun 2022" folder).
+    """
+    in_box = ImageRow.id.in_(geo.ids_in_bbox(qobj["bbox"]))
+    expr = fts.match_expr([], [geo.normalize(qobj["place"])])
+    if expr is None:
+        return in_box
+    named = text(f"SELECT rowid FROM {fts.FTS_TABLE} WHERE {fts.FTS_TABLE} MATCH :place_q").bindparams(
+        place_q=expr).columns(column("rowid", Integer))
+    return or_(in_box, and_(ImageRow.lat.is_(None), ImageRow.id.in_(named)))
 
-    base = sess.query(ImageRow)
+def _vector_where(qobj: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The query's date/person/red-shirt constraints as a vector-metadata filter (see writer.vector_metadata)."""
+    conds = []
+    if qobj.get("date_from"):
+        d = qobj["date_from"]
+        conds.append({"date": {"$gte": d.year * 10000 + d.month * 100 + d.day}})
+    if qobj.get("date_to"):
+        d = qobj["date_to"]
+        conds.append({"date": {"$lt": d.year * 10000 + d.month * 100 + d.day}})
     if qobj.get("year"):
-        base = base.filter(extract('year', ImageRow.ts) == qobj["year"])
+        conds.append({"year": qobj["year"]})
     if qobj.get("month"):
-        base = base.filter(extract('month', ImageRow.ts) == qobj["month"])
+        conds.append({"month": qobj["month"]})
+        if qobj.get("day_from"):
+            conds.append({"day": {"$gte": qobj["day_from"]}})
+        if qobj.get("day_to"):
+            conds.append({"day": {"$lte": qobj["day_to"]}})
+    person, red = qobj.get("person"), qobj.get("red_shirt")
+    if person and red:
+        conds.append({f"red:{person}": True})
+    elif person:
+        conds.append({f"person:{person}": True})
+    elif red:
+        conds.append({"red_shirt": True})
+    if not conds:
+        return None
+    return conds[0] if len(conds) == 1 else {"$and": conds}
+
+def _hydrate(sess, clip_ids: List[str]) -> List[ImageRow]:
+    """Rows for vector ids in one query, in the vector ranking order."""
+    if not clip_ids:
+        return []
+    rows = sess.query(ImageRow).filter(ImageRow.clip_id.in_(clip_ids)).all()
+    rank = {c: n for n, c in enumerate(clip_ids)}
+    rows.sort(key=lambda im: rank[im.clip_id])
+    return rows
+
+# OpenAI query expansion runs here, next to the local SQL/vector work; a late answer is still cached
+_expand_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="query-expand")
+
+def _start_expansion(text: str) -> Optional[Future]:
+    if not (USE_OPENAI_EXPAND_QUERY and OPENAI_API_KEY):
+        return None
+    from openai_helpers import expand_query_cached
+    return _expand_pool.submit(expand_query_cached, text)
+
+def _expansion_by(fut: Optional[Future], deadline: float) -> List[str]:
+    """Expanded keywords if they are in by `deadline` (time.monotonic()), else []."""
+    if fut is None:
+        return []
+    try:
+        return fut.result(timeout=max(0.0, deadline - time.monotonic())) or []
+    except FutureTimeout:
+        return []
+    except Exception:
+        return []
+
+def _fuse(primary: List[str], secondary: List[str], weight: float = 0.5, c: int = 60) -> List[str]:
+    """Reciprocal-rank fusion of two id rankings; the secondary list counts `weight` as much."""
+    score: Dict[str, float] = {}
+    for n, i in enumerate(primary):
+        score[i] = score.get(i, 0.0) + 1.0 / (c + n)
+    for n, i in enumerate(secondary):
+        score[i] = score.get(i, 0.0) + weight / (c + n)
+    return sorted(score, key=lambda i: -score[i])
+
+def _collapse(rows: List[ImageRow], k: int) -> List[ImageRow]:
+    """Keep the best-ranked photo of each near-duplicate group (see dedup.py)."""
+    seen, out = set(), []
+    for im in rows:
+        if im.dup_group is not None:
+            if im.dup_group in seen:
+                continue
+            seen.add(im.dup_group)
+        out.append(im)
+        if len(out) >= k:
+            break
+    return out
+
+def search(qobj: Dict[str, Any], k: int = 100, collapse: Optional[bool] = None) -> List[ImageRow]:
+    if collapse is None:
+        collapse = SEARCH_COLLAPSE_DUPS
+    if collapse:
+        # over-fetch so that k distinct groups usually survive
+        return _collapse(search(qobj, k * 4, collapse=False), k)
+
+    sess = get_session()
+
+    base = _date_filters(sess.query(ImageRow), qobj)
+    if qobj.get("bbox"):
+        base = base.filter(_place_filter(qobj))
 
     person = qobj.get("person")
     red = qobj.get("red_shirt")
 
     # Person / red-shirt only available in FULL mode (faces exist)
     if INDEX_MODE == "FULL" and (person or red):
-        from db import Face as FaceRow
         sub = sess.query(FaceRow.image_id)
         if person:
             sub = sub.filter(FaceRow.person_name == person)
         if red:
-            sub = sub.filter(FaceRow.red_ratio >= 0.06)
+            sub = sub.filter(FaceRow.red_ratio >= RED_SHIRT_MIN_RATIO)
         sub = sub.distinct().subquery()
         base = base.filter(ImageRow.id.in_(sub))
 
-    imgs = base.all()
-
     kws = qobj.get("keywords", [])
-    if not kws:
-        return imgs[:k]
+    if not kws and not qobj.get("phrases"):
+        return base.limit(k).all()
 
-    # FULL: prefer CLIP vector search if we have text_embedding
+    # FULL: prefer CLIP vector search if we have text_embedding. Filters are pushed into the
+    # vector query, so the top-k is taken among matching photos only, however selective.
+    # Query expansion (OpenAI) overlaps with it and is merged only if back within EXPAND_DEADLINE_S.
     if INDEX_MODE == "FULL" and text_embedding is not None:
         try:
-            text = " ".join(kws)
-            qemb = text_embedding(text).tolist()
-            res = collection.query(query_embeddings=[qemb], n_results=k)
-            idset = set(res["ids"][0])
-            ranked = [im for im in imgs if im.clip_id in idset] if imgs else [
-                sess.query(ImageRow).filter(ImageRow.clip_id == i).first() for i in res["ids"][0]
-            ]
-            ranked = [r for r in ranked if r]
-            # Boost by tag overlap if present
-            kwset = {w.lower() for w in kws}
+            text = " ".join(kws + qobj.get("phrases", []))
+            deadline = time.monotonic() + EXPAND_DEADLINE_S
+            expansion = _start_expansion(text)
+            qemb = text_embedding(text)
+            store = get_store()
+            where = _vector_where(qobj)
+            candidates = None
+            if qobj.get("bbox") or (where is not None and not store.supports_where):
+                # Place filters (and everything, for a backend without metadata) are resolved by
+                # the indexed SQL filters; the vector query then ranks just those candidates
+                candidates = [c for (c,) in base.with_entities(ImageRow.clip_id)
+                              .filter(ImageRow.clip_id.isnot(None)).all()]
+                where = None
+            ids = store.query(qemb, k, where=where, candidates=candidates)
+            extra = [w for w in _expansion_by(expansion, deadline) if w.lower() not in text.lower()]
+            if extra:
+                eids = store.query(text_embedding(" ".join(extra)), k, where=where, candidates=candidates)
+                ids = _fuse(ids, eids)[:k]
+            ranked = _hydrate(sess, ids)
+            # Boost by tag overlap if present (stable sort keeps vector order within a score)
+            kwset = {w.lower() for w in kws + extra}
             def score(im):
                 s = 1.0
                 if im.tags:
@@ -79,12 +204,21 @@ def search(qobj: Dict[str, Any], k: int = 100) -> List[ImageRow]:
             ranked.sort(key=score, reverse=True)
             return ranked[:k]
         except Exception:
-            # fall back to LIKE below
+            # fall back to keyword search below
             pass
 
-    # FAST (or FULL fallback): SQL LIKE across path/caption/tags
+    # FAST (or FULL fallback): BM25-ranked FTS5 over path tokens/captions/tags
+    # The MATCH is part of the filtered query, so the top k are taken among matching photos only
+    try:
+        ranked = fts.ranked(base, ImageRow.id, kws, qobj.get("phrases", []))
+        hits = ranked.limit(k).all() if ranked is not None else []
+    except OperationalError:
+        sess.rollback()
+        hits = None
+    if hits is not None:
+        return hits
+
     cond = _sql_like_filters(kws)
     if cond is not None:
-        imgs2 = base.filter(cond).all()
-        return imgs2[:k]
-    return imgs[:k]
\ No newline at end of file
+        return base.filter(cond).limit(k).all()
+    return base.limit(k).all()
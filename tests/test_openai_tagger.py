@@ -0,0 +1,105 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("dotenv")
+pytest.importorskip("sqlalchemy")
+Image = pytest.importorskip("PIL.Image")
+
+import openai_helpers
+from openai_helpers import VisionTagger, _TokenBucket
+
+# VisionTagger against a local stand-in for the chat completions endpoint: each request pops the
+# next scripted status (200 once the script runs out) and its arrival time is recorded.
+
+_COMPLETION = {
+    "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "stub",
+    "choices": [{"index": 0, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": '{"tags": ["beach", "sunset"]}'}}],
+}
+
+class _Stub(ThreadingHTTPServer):
+    def __init__(self, script):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.script = list(script)
+        self.arrivals = []
+        self.lock = threading.Lock()
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length") or 0))
+        with self.server.lock:
+            self.server.arrivals.append(time.monotonic())
+            status = self.server.script.pop(0) if self.server.script else 200
+        body = json.dumps(_COMPLETION if status == 200 else {"error": {"message": "slow down"}}).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        if status == 429:
+            self.send_header("retry-after", "0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stub(monkeypatch):
+    servers = []
+
+    def start(script=()):
+        srv = _Stub(script)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        servers.append(srv)
+        monkeypatch.setattr(openai_helpers, "OPENAI_API_KEY", "test-key")
+        monkeypatch.setattr(openai_helpers, "OPENAI_BASE_URL", f"http://127.0.0.1:{srv.server_port}/v1")
+        return srv
+
+    yield start
+    for srv in servers:
+        srv.shutdown()
+        srv.server_close()
+
+def _image():
+    return Image.new("RGB", (32, 24), (200, 120, 40))
+
+def test_tags_after_429_retries(stub):
+    srv = stub([429, 429])
+    tagger = VisionTagger(concurrency=1, rpm=6000, retries=3)
+    assert tagger.submit(_image()).result(timeout=10) == ["beach", "sunset"]
+    assert len(srv.arrivals) == 3
+
+def test_gives_up_after_last_retry(stub):
+    import openai
+    srv = stub([429] * 5)
+    tagger = VisionTagger(concurrency=1, rpm=6000, retries=1)
+    with pytest.raises(openai.RateLimitError):
+        tagger.submit(_image()).result(timeout=10)
+    assert len(srv.arrivals) == 2
+
+def test_requests_are_paced_by_rpm(stub):
+    srv = stub()
+    # 600 rpm = one request per 0.1 s after a burst of `concurrency` (1)
+    tagger = VisionTagger(concurrency=1, rpm=600, retries=0)
+    futures = [tagger.submit(_image()) for _ in range(4)]
+    assert all(f.result(timeout=10) == ["beach", "sunset"] for f in futures)
+    gaps = [b - a for a, b in zip(srv.arrivals, srv.arrivals[1:])]
+    assert len(gaps) == 3 and min(gaps) >= 0.08
+
+def test_token_bucket_burst_then_rate():
+    bucket = _TokenBucket(rate=20.0, capacity=2)
+
+    async def take(n):
+        t0 = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - t0
+
+    # two tokens are there at once, the next three come at 20/s
+    assert asyncio.run(take(2)) < 0.05
+    assert asyncio.run(take(3)) >= 0.14
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("dateutil")
+pytest.importorskip("sqlalchemy")
+
+from query import parse_query
+
+def _range(q, now):
+    r = parse_query(q, now=now)
+    return r["date_from"], r["date_to"]
+
+def test_this_winter_in_february_is_the_current_winter():
+    assert _range("this winter", datetime(2026, 2, 10)) == (datetime(2025, 12, 1), datetime(2026, 3, 1))
+
+def test_this_winter_in_december_starts_now():
+    assert _range("this winter", datetime(2026, 12, 5)) == (datetime(2026, 12, 1), datetime(2027, 3, 1))
+
+def test_this_season_not_yet_started_is_this_years():
+    assert _range("this summer", datetime(2026, 1, 15)) == (datetime(2026, 6, 1), datetime(2026, 9, 1))
+
+def test_last_winter_in_january_is_the_one_before():
+    assert _range("last winter", datetime(2026, 1, 15)) == (datetime(2024, 12, 1), datetime(2025, 3, 1))
+
+def test_bare_easter_is_the_most_recent():
+    assert _range("easter", datetime(2026, 2, 10)) == (datetime(2025, 4, 18), datetime(2025, 4, 22))
@@ -0,0 +1,33 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("sqlalchemy")
+
+from scanner import _list_dir
+
+def test_cached_listing_still_sees_a_file_rewritten_in_place(tmp_path):
+    photo = tmp_path / "a.jpg"
+    photo.write_bytes(b"x" * 10)
+    (tmp_path / "sub").mkdir()
+    listing, mtime_ns, fresh = _list_dir(str(tmp_path), None)
+    assert fresh and listing["dirs"] == ["sub"]
+    cached = (mtime_ns, json.dumps(listing))
+
+    # an in-place rewrite changes the file, not its directory's mtime
+    photo.write_bytes(b"y" * 25)
+    os.utime(photo, (1_000_000, 1_000_000))
+    assert os.stat(tmp_path).st_mtime_ns == mtime_ns
+
+    listing, _, fresh = _list_dir(str(tmp_path), cached)
+    assert not fresh
+    assert listing == {"files": [["a.jpg", 25, 1_000_000.0]], "dirs": ["sub"]}
+
+def test_cached_listing_skips_a_file_that_vanished(tmp_path):
+    (tmp_path / "a.jpg").write_bytes(b"x")
+    listing, mtime_ns, _ = _list_dir(str(tmp_path), None)
+    listing["files"].append(["gone.jpg", 1, 1.0])
+    listing, _, _ = _list_dir(str(tmp_path), (mtime_ns, json.dumps(listing)))
+    assert [f[0] for f in listing["files"]] == ["a.jpg"]
@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("numpy")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("PIL")
+
+import writer
+from writer import BatchWriteError, write_batch
+
+class _Session:
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+class _BrokenStore:
+    """Every upsert fails, as with a full disk."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def upsert(self, *args, **kwargs):
+        self.calls += 1
+        raise OSError(28, "No space left on device")
+
+def test_batch_that_never_writes_raises_after_the_retries(monkeypatch):
+    monkeypatch.setattr(writer, "WRITE_RETRIES", 3)
+    sess, store = _Session(), _BrokenStore()
+    batch = [{"path": "/photos/a.jpg", "clip_emb": [0.0, 1.0]}]
+    with pytest.raises(BatchWriteError, match="No space left"):
+        write_batch(sess, store, batch)
+    assert store.calls == 3 and sess.rollbacks == 3
+
+def test_empty_batch_writes_nothing():
+    assert write_batch(_Session(), _BrokenStore(), []) == 0
@@ -0,0 +1,200 @@
+import io
+import mmap
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from PIL import Image
+from sqlalchemy import delete, func, insert, select, update
+
+from config import THUMBS_DIR, THUMB_MAX_SIDE, THUMB_PACK_BYTES, THUMB_COMPACT_DEAD_RATIO
+from db import Thumb, Image as ImageRow, get_session
+
+# Packed thumbnail store.
+#
+# JPEG thumbnails are appended to a few large files (THUMBS_DIR/pack-NNNNN.bin, rotated at
+# THUMB_PACK_BYTES) and located through the `thumbs` table (path -> pack, offset, length), instead
+# of one small file per photo. Readers mmap the packs and slice them without copying.
+# Only the ingest writer appends. Removed photos just lose their index row; compact() rewrites
+# the live thumbnails into fresh packs and deletes the old ones. Compaction must not overlap an
+# append, so it runs in the worker (maintain(), between jobs) or offline under the worker lock.
+
+_lock = threading.Lock()
+_maps: Dict[int, mmap.mmap] = {}
+
+def _pack_path(pack: int) -> Path:
+    return THUMBS_DIR / f"pack-{pack:05d}.bin"
+
+def _packs() -> List[int]:
+    return sorted(int(p.stem.split("-")[1]) for p in THUMBS_DIR.glob("pack-*.bin"))
+
+def encode(pil: Image.Image, max_side: int = THUMB_MAX_SIDE) -> bytes:
+    """JPEG thumbnail bytes from an already decoded image."""
+    im = pil.copy()
+    im.thumbnail((max_side, max_side))
+    buf = io.BytesIO()
+    im.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+def make_thumb(path: Path, max_side: int = THUMB_MAX_SIDE) -> bytes:
+    """Thumbnail bytes straight from the file (reduced JPEG decode); not stored."""
+    im = Image.open(path)
+    im.draft("RGB", (max_side, max_side))
+    return encode(im.convert("RGB"), max_side)
+
+# ---- writing (ingest writer only) ----
+
+def append(sess, items: Sequence[Tuple[str, bytes]]):
+    """Append (path, jpeg bytes) to the current pack and index them; committed with the caller's transaction."""
+    items = [(str(p), b) for p, b in items if b]
+    if not items:
+        return
+    rows = []
+    with _lock:
+        packs = _packs()
+        pack = packs[-1] if packs else 0
+        f = open(_pack_path(pack), "ab")
+        try:
+            for path, data in items:
+                if f.tell() and f.tell() + len(data) > THUMB_PACK_BYTES:
+                    f.close()
+                    pack += 1
+                    f = open(_pack_path(pack), "ab")
+                rows.append({"path": path, "pack": pack, "offset": f.tell(), "length": len(data)})
+                f.write(data)
+        finally:
+            f.close()
+    forget(sess, [r["path"] for r in rows])
+    sess.execute(insert(Thumb), rows)
+
+def forget(sess, paths: Sequence[str]):
+    for i in range(0, len(paths), 500):
+        sess.execute(delete(Thumb).where(Thumb.path.in_(list(paths[i:i + 500]))))
+
+def rename(sess, old: str, new: str):
+    sess.execute(update(Thumb).where(Thumb.path == old).values(path=new))
+
+# ---- reading ----
+
+def _view(pack: int, offset: int, length: int) -> Optional[memoryview]:
+    with _lock:
+        mm = _maps.get(pack)
+        if mm is None or offset + length > len(mm):
+            try:
+                with open(_pack_path(pack), "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+            # the previous (shorter) map is released once no view references it
+            _maps[pack] = mm
+    if offset + length > len(mm):
+        return None
+    return memoryview(mm)[offset:offset + length]
+
+def get_thumbs(paths: Iterable[str], sess=None) -> Dict[str, memoryview]:
+    """path -> zero-copy view of its JPEG thumbnail, for every path that has one (one SELECT)."""
+    paths = [str(p) for p in paths]
+    own = sess is None
+    sess = sess or get_session()
+    try:
+        out = {}
+        for i in range(0, len(paths), 500):
+            rows = sess.execute(
+                select(Thumb.path, Thumb.pack, Thumb.offset, Thumb.length).where(Thumb.path.in_(paths[i:i + 500]))
+            ).all()
+            for path, pack, offset, length in rows:
+                v = _view(pack, offset, length)
+                if v is not None:
+                    out[path] = v
+        return out
+    finally:
+        if own:
+            sess.close()
+
+def get_thumb(path: str, sess=None) -> Optional[memoryview]:
+    return get_thumbs([path], sess).get(str(path))
+
+# ---- maintenance ----
+
+def compact() -> Tuple[int, int]:
+    """
+    Rewrite thumbnails of photos still in the index into new packs and delete the old packs.
+    Only from the process that appends (the worker) or under its lock: an append after the
+    snapshot below would be lost with its pack. Returns (thumbnails kept, bytes reclaimed).
+    """
+    sess = get_session()
+    with _lock:
+        _maps.clear()
+    old_packs = _packs()
+    before = sum(_pack_path(p).stat().st_size for p in old_packs)
+    # drop index rows of photos that are gone
+    sess.execute(delete(Thumb).where(Thumb.path.not_in(select(ImageRow.path))))
+    rows = sess.execute(select(Thumb.path, Thumb.pack, Thumb.offset, Thumb.length)
+                        .order_by(Thumb.pack, Thumb.offset)).all()
+
+    pack = (old_packs[-1] + 1) if old_packs else 0
+    new_packs = [pack]
+    out = open(_pack_path(pack), "wb")
+    updates = []
+    src: Dict[int, object] = {}
+    try:
+        for path, p, offset, length in rows:
+            if p not in src:
+                src[p] = open(_pack_path(p), "rb")
+            f = src[p]
+            f.seek(offset)
+            data = f.read(length)
+            if out.tell() and out.tell() + len(data) > THUMB_PACK_BYTES:
+                out.close()
+                pack += 1
+                new_packs.append(pack)
+                out = open(_pack_path(pack), "wb")
+            updates.append({"path": path, "pack": pack, "offset": out.tell(), "length": len(data)})
+            out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    finally:
+        out.close()
+        for f in src.values():
+            f.close()
+
+    for i in range(0, len(updates), 5000):
+        sess.execute(update(Thumb), updates[i:i + 5000])
+    sess.commit()
+    sess.close()
+    for p in old_packs:
+        _pack_path(p).unlink(missing_ok=True)
+    with _lock:
+        for p in old_packs:
+            _maps.pop(p, None)  # views mapped meanwhile keep their (unlinked) pack alive until released
+    after = sum(_pack_path(p).stat().st_size for p in new_packs)
+    return len(updates), before - after
+
+def maintain(dead_ratio: float = THUMB_COMPACT_DEAD_RATIO) -> List[str]:
+    """compact() once `dead_ratio` of the pack bytes belong to removed photos; returns what was done."""
+    total = sum(_pack_path(p).stat().st_size for p in _packs())
+    if not total:
+        return []
+    sess = get_session()
+    try:
+        live = sess.execute(select(func.coalesce(func.sum(Thumb.length), 0))).scalar()
+    finally:
+        sess.close()
+    if (total - live) / total < dead_ratio:
+        return []
+    kept, freed = compact()
+    return [f"compacted: kept {kept} thumbnails, reclaimed {freed / 1e6:.1f} MB"]
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["compact"]:
+        import jobs
+        lock = jobs.worker_lock()
+        if lock is None:
+            print("a worker is running; it compacts the thumbnails itself (stop it to compact now)")
+            sys.exit(1)
+        kept, freed = compact()
+        print(f"kept {kept} thumbnails, reclaimed {freed / 1e6:.1f} MB")
+    else:
+        print("usage: python thumbstore.py compact")
@@ -1,39 +1,117 @@
 import streamlit as st
 from pathlib import Path
-from PIL import Image
-from config import THUMBS_DIR, SUPPORTED_EXTS
-from ingest import ingest_folder, enroll_person_from_photos
+from config import APP_DIR, DATA_DIR, THUMBS_DIR, SUPPORTED_EXTS, INDEX_MODE, MODEL_WARMUP, UI_PAGE_SIZE, UI_MAX_RESULTS
+from config import SEARCH_COLLAPSE_DUPS
+from models import registry
+import thumbstore
+from ingest import enroll_person_from_photos
+import jobs
 from query import parse_query
 from search import search
-from db import get_session, Image as ImageRow
-import os, subprocess, platform
+from db import get_engine, get_index_generation
+from vectorstore import refresh_store
+from datetime import date
+import os, subprocess, platform, sys
 import json
 
 st.set_page_config(page_title="Family Photo RAG", layout="wide")
 
+# One DB engine (connection pool) and one model registry per server process, shared by all sessions
+@st.cache_resource
+def _shared_resources():
+    return get_engine(), registry
+
+_shared_resources()
+
+# Models load on first use; optionally start loading them in the background once per process
+@st.cache_resource
+def _start_model_warmup():
+    if INDEX_MODE == "FULL" and MODEL_WARMUP:
+        registry.warm_up(MODEL_WARMUP)
+    return True
+
+_start_model_warmup()
+with st.sidebar.expander("Models"):
+    for model_name, model_status in registry.status().items():
+        st.caption(f"{model_name}: {model_status}")
+
 # ---- Session defaults ----
 if "last_query" not in st.session_state:
     st.session_state["last_query"] = ""
 if "last_results" not in st.session_state:
     st.session_state["last_results"] = []
-# indices requested to open/reveal after rerun
-if "open_request" not in st.session_state:
-    st.session_state["open_request"] = None
-if "reveal_request" not in st.session_state:
-    st.session_state["reveal_request"] = None
+if "page" not in st.session_state:
+    st.session_state["page"] = 0
 
 st.title("📸 Family Photo RAG")
 
 tab1, tab2, tab3 = st.tabs(["Index", "People", "Search"])
 
 # ---------------- Index Tab ----------------
+def _ensure_worker():
+    """Start the background indexing worker (worker.py) unless one is alive."""
+    if jobs.worker_alive():
+        return
+    # the child keeps its own copy of the log descriptor, so ours is closed right away
+    with open(DATA_DIR / "worker.log", "a") as log:
+        subprocess.Popen([sys.executable, str(APP_DIR / "worker.py")], cwd=str(APP_DIR),
+                         stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+def _fmt_eta(s) -> str:
+    if not s:
+        return "–"
+    s = int(s)
+    return f"{s // 3600}h {s % 3600 // 60:02d}m" if s >= 3600 else f"{s // 60}m {s % 60:02d}s"
+
+# Polls the jobs table (one small query) every 2s, rerunning only this fragment
+@st.experimental_fragment(run_every=2)
+def render_jobs():
+    rows = jobs.recent(limit=8)
+    if not rows:
+        return
+    st.caption("Worker: running" if jobs.worker_alive() else "Worker: not running (starts when you index)")
+    for j in rows:
+        with st.container(border=True):
+            c1, c2 = st.columns([4, 1])
+            with c1:
+                what = "re-label faces" if j["kind"] == "relabel" else f"`{j['root']}`"
+                st.markdown(f"**#{j['id']}** {what} — {j['state']}"
+                            + (f" ({j['phase']})" if j["state"] == "running" and j["phase"] else ""))
+                todo = j["todo"] or 0
+                done = (j["processed"] or 0) + (j["failed"] or 0)
+                if j["state"] in ("running", "paused") and todo:
+                    st.progress(min(1.0, done / todo))
+                st.caption(
+                    f"seen {j['seen'] or 0} · processed {j['processed'] or 0} / {todo} · "
+                    f"skipped {j['skipped'] or 0} · failed {j['failed'] or 0}"
+                    + (f" · {j['rate']:.1f} photos/s · ETA {_fmt_eta(j['eta_s'])}" if j["rate"] else "")
+                )
+                if j["detail"]:
+                    d = json.loads(j["detail"])
+                    if d.get("images"):
+                        st.caption(f"Face detection skipped on {d['skipped']} of {d['images']} photos with no "
+                                   f"people in them; {d['large']} group shots re-scanned at high resolution.")
+                    if d.get("gps_todo"):
+                        st.caption(f"Read GPS of {d['gps_done']} / {d['gps_todo']} earlier indexed photos.")
+                if j["error"]:
+                    st.caption(f"Error: {j['error']}")
+            with c2:
+                if j["state"] == "running":
+                    st.button("Pause", key=f"pause_{j['id']}", on_click=jobs.pause, args=(j["id"],))
+                elif j["state"] == "paused":
+                    st.button("Resume", key=f"resume_{j['id']}", on_click=jobs.resume, args=(j["id"],))
+                if j["state"] in ("queued", "running", "paused"):
+                    st.button("Cancel", key=f"cancel_{j['id']}", on_click=jobs.cancel, args=(j["id"],))
+
 with tab1:
     st.subheader("Index your photo library")
     photo_root = st.text_input("Photos root folder", value=str(Path.home() / "Pictures"))
     if st.button("Index"):
-        with st.spinner("Indexing... (first run downloads models; be patient)"):
-            added = ingest_folder(photo_root)
-        st.success(f"Added {added} new photos")
+        # Runs in the background worker; search keeps working meanwhile
+        job_id = jobs.enqueue(photo_root)
+        _ensure_worker()
+        st.toast(f"Queued indexing job #{job_id}")
+    render_jobs()
 
 # ---------------- People Tab ----------------
 with tab2:
@@ -56,108 +134,138 @@ with tab2:
                 p.write_bytes(f.read())
                 paths.append(str(p))
             count = len(paths)
-            enroll_person_from_photos(name, paths)
+            enrolled = enroll_person_from_photos(name, paths)
             for p in paths:
                 try:
                     os.remove(p)
                 except Exception:
                     pass
-            st.success(f"Enrolled {name} from {count} image(s).")
+            if enrolled:
+                # Existing faces are re-labeled by the worker, the only process writing the vector store
+                job_id = jobs.enqueue("", kind="relabel")
+                _ensure_worker()
+                st.success(f"Enrolled {name} from {enrolled} of {count} image(s); re-labeling existing "
+                           f"faces in the background (job #{job_id}).")
+            else:
+                st.warning(f"No face found in the {count} image(s)")
 
 # ---------------- Search Tab ----------------
+def _open_file(target: str):
+    try:
+        if platform.system() == "Darwin":
+            subprocess.call(["open", target])  # open in default app
+        elif platform.system() == "Windows":
+            os.startfile(target)  # type: ignore[attr-defined]
+        else:
+            subprocess.call(["xdg-open", target])
+        st.toast(f"Opening: {target}")
+    except Exception as e:
+        st.toast(f"Could not open file: {e}")
+
+def _reveal_file(target: str):
+    try:
+        if platform.system() == "Darwin":
+            subprocess.call(["open", "-R", target])  # reveal in Finder
+        elif platform.system() == "Windows":
+            # Best-effort reveal: open the folder
+            subprocess.call(["explorer", str(Path(target).parent)])
+        else:
+            # Linux: open folder containing file
+            subprocess.call(["xdg-open", str(Path(target).parent)])
+        st.toast(f"Revealed: {target}")
+    except Exception as e:
+        st.toast(f"Could not reveal file: {e}")
+
+# Results are cached per (query, index generation): any ingest/move/delete/relabel bumps the
+# generation, so stale lists are never served. The day is part of the key for relative dates.
+@st.cache_data(max_entries=256, show_spinner=False)
+def _cached_search(q: str, generation: int, day: str, k: int, collapse: bool):
+    refresh_store(generation)  # see the vectors the worker wrote since the last search
+    qobj = parse_query(q)
+    qobj["raw_query"] = q
+    results = search(qobj, k=k, collapse=collapse)
+    items = [
+        {"path": im.path, "ts": str(im.ts) if im.ts else "", "name": Path(im.path).name}
+        for im in results
+    ]
+    return qobj, items
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _page_thumbs(paths: tuple, generation: int) -> dict:
+    """path -> JPEG bytes for one page of tiles (one index lookup; on-the-fly fallback)."""
+    views = thumbstore.get_thumbs(paths)
+    out = {}
+    for p in paths:
+        v = views.get(p)
+        if v is not None:
+            out[p] = bytes(v)
+            continue
+        try:
+            # Not in the store (e.g. indexed before packed thumbnails): render on the fly
+            out[p] = thumbstore.make_thumb(Path(p))
+        except Exception:
+            pass
+    return out
+
+def _set_page(page: int):
+    st.session_state["page"] = page
+
+# Paging and Open/Reveal clicks rerun only this fragment, not the whole app
+@st.experimental_fragment
+def render_results(items, generation: int):
+    if not items:
+        st.info("No results.")
+        return
+
+    pages = max(1, -(-len(items) // UI_PAGE_SIZE))
+    page = min(st.session_state.get("page", 0), pages - 1)
+    start = page * UI_PAGE_SIZE
+    page_items = items[start:start + UI_PAGE_SIZE]
+
+    nav1, nav2, nav3 = st.columns([1, 3, 1])
+    with nav1:
+        st.button("◀ Prev", disabled=page == 0, on_click=_set_page, args=(page - 1,), key="page_prev")
+    with nav2:
+        st.caption(f"{len(items)} results · page {page + 1} of {pages}")
+    with nav3:
+        st.button("Next ▶", disabled=page >= pages - 1, on_click=_set_page, args=(page + 1,), key="page_next")
+
+    thumbs = _page_thumbs(tuple(it["path"] for it in page_items), generation)
+    cols = st.columns(5)
+    for j, it in enumerate(page_items):
+        img = thumbs.get(it["path"])
+        if img is None:
+            continue
+        i = start + j
+        with cols[j % 5]:
+            st.image(img, caption=f"{it['name']}\n{it['ts']}", use_column_width=True)
+            c1, c2 = st.columns([1, 1])
+            with c1:
+                st.button("Open", key=f"open_{i}", on_click=_open_file, args=(it["path"],))
+            with c2:
+                st.button("Reveal", key=f"reveal_{i}", on_click=_reveal_file, args=(it["path"],))
+
 with tab3:
     st.subheader("Search")
 
-    def render_results(items):
-        if not items:
-            st.info("No results.")
-            return
-
-        cols = st.columns(5)
-        for i, it in enumerate(items):
-            # Build / ensure thumb (uses the hash-based path from ingest)
-            from ingest import _thumb_path, _ensure_thumb  # local import to avoid circulars at top-level
-
-            path = Path(it["path"])
-            thumb = _thumb_path(path)
-            _ensure_thumb(path)
-
-            try:
-                img = Image.open(thumb)
-            except Exception:
-                # Fallback to original if thumb missing/corrupt
-                img = Image.open(path).convert("RGB")
-
-            with cols[i % 5]:
-                st.image(img, caption=f"{it['name']}\n{it['ts']}", use_column_width=True)
-                c1, c2 = st.columns([1, 1])
-                with c1:
-                    if st.button("Open", key=f"open_{i}_{it['name']}"):
-                        # Defer actual open until after rerun completes
-                        st.session_state["open_request"] = i
-                with c2:
-                    if st.button("Reveal", key=f"reveal_{i}_{it['name']}"):
-                        # Defer reveal-in-Finder until after rerun
-                        st.session_state["reveal_request"] = i
-
     q = st.text_input(
         "Type a query (e.g., '2022 Cancun', 'mountains 2025', 'all pictures from July 2023')",
         value=st.session_state.get("last_query", ""),
     )
 
+    collapse = st.checkbox("Collapse near-duplicates (bursts, copies)", value=SEARCH_COLLAPSE_DUPS)
+    generation = get_index_generation()
     run_search = st.button("Run search")
     if run_search and q.strip():
-        qobj = parse_query(q)
-        qobj["raw_query"] = q
-        results = search(qobj, k=200)
-
+        qobj, items = _cached_search(q, generation, date.today().isoformat(), UI_MAX_RESULTS, collapse)
         # Persist for reruns so UI doesn't clear on button clicks
-        # st.session_state["last_query"] = q
-        st.session_state["last_results"] = [
-            {"path": im.path, "ts": str(im.ts) if im.ts else "", "name": Path(im.path).name}
-            for im in results
-        ]
-
+        st.session_state["last_results"] = items
+        st.session_state["page"] = 0
         st.caption(f"Parsed: {qobj}")
 
     # Always render from session (sticky results across reruns)
     items = st.session_state.get("last_results", [])
     if items:
-        render_results(items)
-    else:
-        if run_search:
-            st.info("No results.")
-
-    # Handle deferred "Open" / "Reveal" AFTER rendering (so rerun doesn't clear the gallery)
-    open_idx = st.session_state.pop("open_request", None)
-    if open_idx is not None:
-        try:
-            target = st.session_state["last_results"][open_idx]["path"]
-            if platform.system() == "Darwin":
-                subprocess.call(["open", target])  # open in default app
-                # To reveal in Finder instead of opening, use: ["open", "-R", target]
-            elif platform.system() == "Windows":
-                os.startfile(target)  # type: ignore[attr-defined]
-            else:
-                subprocess.call(["xdg-open", target])
-            st.toast(f"Opening: {target}")
-        except Exception as e:
-            st.warning(f"Could not open file: {e}")
-
-    reveal_idx = st.session_state.pop("reveal_request", None)
-    if reveal_idx is not None:
-        try:
-            target = st.session_state["last_results"][reveal_idx]["path"]
-            if platform.system() == "Darwin":
-                subprocess.call(["open", "-R", target])  # reveal in Finder
-            elif platform.system() == "Windows":
-                # Best-effort reveal: open the folder
-                folder = str(Path(target).parent)
-                subprocess.call(["explorer", folder])
-            else:
-                # Linux: open folder containing file
-                folder = str(Path(target).parent)
-                subprocess.call(["xdg-open", folder])
-            st.toast(f"Revealed: {target}")
-        except Exception as e:
-            st.warning(f"Could not reveal file: {e}")
\ No newline at end of file
+        render_results(items, generation)
+    elif run_search:
+        st.info("No results.")
@@ -0,0 +1,458 @@
+import json
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config import VECTOR_BACKEND, CHROMA_DIR, VECTORS_DIR, VECTOR_IVF_NPROBE
+from config import VECTOR_COMPACT_DEAD_RATIO, VECTOR_IVF_MIN_ROWS, VECTOR_CHUNK
+
+# Pluggable vector store for CLIP image embeddings.
+#
+#   chroma - chromadb.PersistentClient collection (the original backend); supports metadata `where`
+#   mmap   - built-in: append-only float16 matrix + sidecar id list, memory-mapped, exact dot-product
+#            top-k (optionally IVF-partitioned). Metadata filters are not stored here; search passes
+#            the SQL-filtered candidate ids instead (`supports_where = False`).
+#
+# Use get_store(); nothing is opened until the first call. Only the worker process writes (see
+# worker.py); readers call refresh_store() with the index generation to pick up its writes.
+
+class VectorStore:
+    supports_where = False
+
+    def upsert(self, ids: Sequence[str], embeddings, documents=None, metadatas=None):
+        raise NotImplementedError
+
+    def delete(self, ids: Sequence[str]):
+        raise NotImplementedError
+
+    def get(self, ids: Sequence[str], include: Sequence[str] = ("embeddings", "documents", "metadatas")) -> Dict[str, list]:
+        """{"ids", "embeddings", "documents", "metadatas"} for the ids that exist; fields not in `include` are None."""
+        raise NotImplementedError
+
+    def update(self, ids: Sequence[str], metadatas: Sequence[dict]):
+        """Merge metadata into existing vectors (no-op for backends without metadata)."""
+
+    def query(self, embedding, k: int, where: Optional[dict] = None,
+              candidates: Optional[Sequence[str]] = None) -> List[str]:
+        """Ids of the k nearest vectors, best first; restricted to `candidates` when given."""
+        raise NotImplementedError
+
+    def needs_metadata_backfill(self) -> bool:
+        return False
+
+    def maintain(self) -> List[str]:
+        """Housekeeping the backend wants done while no ingest is writing; returns what was done."""
+        return []
+
+    def reopen(self):
+        """Drop cached state so writes made by another process (the worker) become visible."""
+
+    def rename(self, old: str, new: str) -> bool:
+        got = self.get([old])
+        if not got["ids"]:
+            return False
+        md = got["metadatas"][0] if got.get("metadatas") else None
+        doc = got["documents"][0] if got.get("documents") else None
+        self.upsert([new], [got["embeddings"][0]], documents=[doc or ""], metadatas=[md] if md else None)
+        self.delete([old])
+        return True
+
+
+class ChromaStore(VectorStore):
+    supports_where = True
+
+    def __init__(self, path: Path = CHROMA_DIR, name: str = "photos"):
+        self.path, self.name = path, name
+        self._connect()
+
+    def _connect(self):
+        import chromadb
+        self.client = chromadb.PersistentClient(path=str(self.path))
+        self.collection = self.client.get_or_create_collection(name=self.name)
+
+    def reopen(self):
+        # Embedded Chroma keeps one cached system per path and process; drop it to re-read the files
+        self.client.clear_system_cache()
+        self._connect()
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        self.collection.upsert(ids=list(ids), embeddings=[list(map(float, e)) for e in embeddings],
+                               documents=documents, metadatas=metadatas)
+
+    def delete(self, ids):
+        if ids:
+            self.collection.delete(ids=list(ids))
+
+    def get(self, ids, include=("embeddings", "documents", "metadatas")):
+        # in chunks: Chroma binds every id as an SQL variable
+        ids = list(ids)
+        out = {"ids": [], **{k: ([] if k in include else None) for k in ("embeddings", "documents", "metadatas")}}
+        for a in range(0, len(ids), VECTOR_CHUNK):
+            got = self.collection.get(ids=ids[a:a + VECTOR_CHUNK], include=list(include))
+            out["ids"].extend(got["ids"])
+            for k in include:
+                out[k].extend(got[k] if got.get(k) is not None else [None] * len(got["ids"]))
+        return out
+
+    def update(self, ids, metadatas):
+        if ids:
+            self.collection.update(ids=list(ids), metadatas=list(metadatas))
+
+    def query(self, embedding, k, where=None, candidates=None):
+        if candidates is not None:
+            if not candidates:
+                return []
+            # Chroma can't restrict a query to ids; score the candidates exactly instead, a chunk of
+            # embeddings at a time (a broad place can mean tens of thousands of candidates)
+            q = np.asarray(embedding, dtype=np.float32)
+            ids: List[str] = []
+            scores = np.zeros(0, dtype=np.float32)
+            candidates = list(candidates)
+            for a in range(0, len(candidates), VECTOR_CHUNK):
+                got = self.get(candidates[a:a + VECTOR_CHUNK], include=("embeddings",))
+                if not got["ids"]:
+                    continue
+                ids += got["ids"]
+                scores = np.concatenate([scores, np.asarray(got["embeddings"], dtype=np.float32) @ q])
+                if len(ids) > k:
+                    best = _topk(scores, k)
+                    ids, scores = [ids[i] for i in best], scores[best]
+            return [ids[i] for i in _topk(scores, k)]
+        res = self.collection.query(query_embeddings=[list(map(float, embedding))], n_results=k, where=where)
+        return res["ids"][0]
+
+    def needs_metadata_backfill(self):
+        got = self.collection.get(limit=1, include=["metadatas"])
+        return bool(got["ids"]) and not (got["metadatas"] and got["metadatas"][0])
+
+
+def _topk(scores: np.ndarray, k: int) -> np.ndarray:
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    part = np.argpartition(-scores, k)[:k]
+    return part[np.argsort(-scores[part])]
+
+
+class MmapStore(VectorStore):
+    """
+    Files under `root`:
+      vectors.f16     row-major float16 (rows, dim), append-only
+      ids.txt         one id per line; line i names row i
+      tombstones.i64  row numbers superseded by an upsert or deleted
+      meta.json       {"dim": ..., "generation": ...}
+      ivf.npz         optional partitioning from build_ivf()
+    Other processes' appends are picked up on the next call by reading only the new tail.
+    compact() writes the live rows to the next generation's files (vectors.<gen>.f16, ...) and then
+    switches meta.json over; readers notice the new generation on their next call and reopen.
+    """
+
+    _CHUNK = 1 << 16  # rows scored per block
+
+    def __init__(self, root: Path = VECTORS_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._meta = self.root / "meta.json"
+        self._lock = threading.RLock()
+        self._meta_mtime = None
+        self.dim = None
+        self._open(0)
+        self._read_meta()
+
+    def _paths(self, gen: int) -> tuple:
+        sfx = f".{gen}" if gen else ""
+        return (self.root / f"vectors{sfx}.f16", self.root / f"ids{sfx}.txt",
+                self.root / f"tombstones{sfx}.i64", self.root / f"ivf{sfx}.npz")
+
+    def _open(self, gen: int):
+        """Forget everything read so far and read generation `gen` from the start."""
+        self.generation = gen
+        self._vec, self._ids, self._tomb, self._ivf_path = self._paths(gen)
+        self.ids: List[str] = []
+        self.row_of: Dict[str, int] = {}
+        self._ids_off = 0
+        self._tomb_off = 0
+        self._dead = np.zeros(0, dtype=bool)
+        self._mm: Optional[np.memmap] = None
+        self._ivf = None
+        self._ivf_mtime = None
+
+    def _read_meta(self):
+        try:
+            mtime = self._meta.stat().st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._meta_mtime:
+            return
+        try:
+            meta = json.loads(self._meta.read_text())
+        except (OSError, ValueError):
+            return  # being replaced; read it next time
+        self._meta_mtime = mtime
+        self.dim = meta.get("dim")
+        if meta.get("generation", 0) != self.generation:
+            self._open(meta.get("generation", 0))
+
+    def _write_meta(self, gen: int):
+        tmp = self._meta.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"dim": self.dim, "generation": gen}))
+        os.replace(tmp, self._meta)
+
+    # ---- reading ----
+
+    def _refresh(self):
+        with self._lock:
+            self._read_meta()
+            self._read_new_ids()
+            self._read_new_tombstones()
+            rows = min(len(self.ids), self._vec_rows())
+            if self._mm is None or self._mm.shape[0] != rows:
+                self._mm = np.memmap(self._vec, dtype=np.float16, mode="r", shape=(rows, self.dim)) if rows else None
+
+    def _vec_rows(self) -> int:
+        if not self.dim:
+            return 0
+        try:
+            return os.path.getsize(self._vec) // (self.dim * 2)
+        except OSError:
+            return 0
+
+    def _read_new_ids(self):
+        try:
+            size = os.path.getsize(self._ids)
+        except OSError:
+            return
+        if size <= self._ids_off:
+            return
+        with open(self._ids, "rb") as f:
+            f.seek(self._ids_off)
+            data = f.read(size - self._ids_off)
+        end = data.rfind(b"\n") + 1  # ignore a partially written last line
+        for line in data[:end].decode("utf-8").split("\n")[:-1]:
+            old = self.row_of.get(line)
+            if old is not None:
+                self._grow_dead(old + 1)
+                self._dead[old] = True
+            self.row_of[line] = len(self.ids)
+            self.ids.append(line)
+        self._ids_off += end
+        self._grow_dead(len(self.ids))
+
+    def _read_new_tombstones(self):
+        try:
+            size = os.path.getsize(self._tomb)
+        except OSError:
+            return
+        if size <= self._tomb_off:
+            return
+        rows = np.fromfile(self._tomb, dtype=np.int64, offset=self._tomb_off, count=(size - self._tomb_off) // 8)
+        self._tomb_off += len(rows) * 8
+        self._grow_dead(int(rows.max()) + 1 if len(rows) else 0)
+        self._dead[rows] = True
+        for r in rows.tolist():
+            if r < len(self.ids) and self.row_of.get(self.ids[r]) == r:
+                del self.row_of[self.ids[r]]
+
+    def _grow_dead(self, n: int):
+        if len(self._dead) < n:
+            self._dead = np.concatenate([self._dead, np.zeros(n - len(self._dead), dtype=bool)])
+
+    # ---- writing (single writer) ----
+
+    def _repair_tail(self):
+        """
+        Cut off what a writer that crashed mid-append left behind: vector rows that no id names
+        (the next id would otherwise point at one of them), a partial id line, a partial tombstone.
+        Runs under the lock right after _refresh(), before every append.
+        """
+        for path, keep in ((self._vec, len(self.ids) * (self.dim or 0) * 2),
+                           (self._ids, self._ids_off), (self._tomb, self._tomb_off)):
+            try:
+                if os.path.getsize(path) > keep:
+                    os.truncate(path, keep)
+            except OSError:
+                pass
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        if not len(ids):
+            return
+        E = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            self._refresh()
+            if self.dim is None:
+                self.dim = int(E.shape[1])
+                self._write_meta(self.generation)
+            self._repair_tail()
+            # Rows first, ids second: a crash in between leaves rows no id points at, never the reverse
+            with open(self._vec, "ab") as f:
+                E.astype(np.float16).tofile(f)
+            with open(self._ids, "ab") as f:
+                f.write("".join(f"{i}\n" for i in ids).encode("utf-8"))
+            self._refresh()
+
+    def delete(self, ids):
+        with self._lock:
+            self._refresh()
+            rows = [self.row_of[i] for i in ids if i in self.row_of]
+            if not rows:
+                return
+            self._repair_tail()
+            with open(self._tomb, "ab") as f:
+                np.asarray(rows, dtype=np.int64).tofile(f)
+            self._refresh()
+
+    def get(self, ids, include=("embeddings", "documents", "metadatas")):
+        self._refresh()
+        found = [i for i in ids if i in self.row_of]
+        rows = [self.row_of[i] for i in found]
+        embs = np.asarray(self._mm[rows], dtype=np.float32).tolist() if rows else []
+        return {"ids": found, "embeddings": embs, "documents": None, "metadatas": None}
+
+    def compact(self):
+        """
+        Rewrite the live rows into the next generation's files, dropping superseded/deleted ones.
+        Only the writer may call this; readers in other processes switch over on their next call.
+        """
+        with self._lock:
+            self._refresh()
+            self._repair_tail()
+            live = np.flatnonzero(~self._dead[:len(self.ids)])
+            old, gen = self._paths(self.generation), self.generation + 1
+            vec, ids, _, _ = self._paths(gen)
+            with open(vec, "wb") as f:
+                for a in range(0, len(live), self._CHUNK):
+                    np.asarray(self._mm[live[a:a + self._CHUNK]]).tofile(f)
+            ids.write_text("".join(f"{self.ids[r]}\n" for r in live.tolist()), encoding="utf-8")
+            self._write_meta(gen)
+            self._mm = None
+            for path in old:
+                path.unlink(missing_ok=True)
+            self._refresh()
+
+    # ---- search ----
+
+    def query(self, embedding, k, where=None, candidates=None):
+        self._refresh()
+        if self._mm is None:
+            return []
+        q = np.asarray(embedding, dtype=np.float32)
+        if candidates is not None:
+            rows = np.asarray(sorted(self.row_of[c] for c in candidates if c in self.row_of), dtype=np.int64)
+        else:
+            rows = self._ivf_rows(q)
+        if rows is None:
+            scores = np.empty(self._mm.shape[0], dtype=np.float32)
+            for a in range(0, len(scores), self._CHUNK):
+                scores[a:a + self._CHUNK] = np.asarray(self._mm[a:a + self._CHUNK], dtype=np.float32) @ q
+            scores[self._dead[:len(scores)]] = -np.inf
+            best = _topk(scores, k)
+            best = best[np.isfinite(scores[best])]
+        else:
+            if not len(rows):
+                return []
+            scores = np.empty(len(rows), dtype=np.float32)
+            for a in range(0, len(rows), self._CHUNK):
+                block = rows[a:a + self._CHUNK]
+                scores[a:a + self._CHUNK] = np.asarray(self._mm[block], dtype=np.float32) @ q
+            scores[self._dead[rows]] = -np.inf
+            order = _topk(scores, k)
+            best = rows[order[np.isfinite(scores[order])]]
+        return [self.ids[r] for r in best.tolist()]
+
+    # ---- optional IVF partitioning ----
+
+    def build_ivf(self, nlist: int = 0, iters: int = 10, sample: int = 100_000, seed: int = 0):
+        """
+        Partition the live rows into `nlist` k-means cells (default ~sqrt(rows)). Queries then score
+        only the VECTOR_IVF_NPROBE closest cells plus rows appended after the build.
+        """
+        self._refresh()
+        live = np.flatnonzero(~self._dead[:len(self.ids)])
+        if not len(live):
+            return
+        nlist = nlist or max(1, int(np.sqrt(len(live))))
+        rng = np.random.default_rng(seed)
+        train = np.asarray(self._mm[np.sort(rng.choice(live, min(sample, len(live)), replace=False))], dtype=np.float32)
+        cent = train[rng.choice(len(train), min(nlist, len(train)), replace=False)]
+        for _ in range(iters):
+            assign = np.argmax(train @ cent.T, axis=1)
+            for c in range(len(cent)):
+                members = train[assign == c]
+                if len(members):
+                    v = members.mean(axis=0)
+                    cent[c] = v / (np.linalg.norm(v) + 1e-9)
+        assign = np.empty(len(live), dtype=np.int64)
+        for a in range(0, len(live), self._CHUNK):
+            block = np.asarray(self._mm[live[a:a + self._CHUNK]], dtype=np.float32)
+            assign[a:a + self._CHUNK] = np.argmax(block @ cent.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.searchsorted(assign[order], np.arange(len(cent) + 1))
+        tmp = self._ivf_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:  # readers load it on their next query, so never expose a partial file
+            np.savez(f, centroids=cent, rows=live[order], offsets=offsets, built_rows=len(self.ids))
+        os.replace(tmp, self._ivf_path)
+
+    def maintain(self, dead_ratio: float = VECTOR_COMPACT_DEAD_RATIO,
+                 ivf_min_rows: int = VECTOR_IVF_MIN_ROWS) -> List[str]:
+        """
+        Compact once `dead_ratio` of the rows are superseded or deleted; build the IVF partitioning
+        once `ivf_min_rows` rows are live (0 = never), and rebuild it when the rows appended since
+        (which every query scans exhaustively) exceed a quarter of the rows it covers.
+        """
+        done = []
+        with self._lock:
+            self._refresh()
+            rows = len(self.ids)
+            dead = int(self._dead[:rows].sum())
+            if rows and dead and dead >= dead_ratio * rows:
+                self.compact()
+                done.append(f"compacted {rows} -> {rows - dead} vectors")
+            live = len(self.row_of)
+            if ivf_min_rows and live >= ivf_min_rows:
+                try:
+                    with np.load(self._ivf_path) as z:
+                        built = int(z["built_rows"])
+                except (OSError, ValueError, KeyError):
+                    built = None
+                if built is None or len(self.ids) - built > built // 4:
+                    self.build_ivf()
+                    done.append(f"built IVF over {live} vectors")
+        return done
+
+    def _ivf_rows(self, q: np.ndarray) -> Optional[np.ndarray]:
+        try:
+            mtime = self._ivf_path.stat().st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._ivf_mtime:
+            z = np.load(self._ivf_path)
+            self._ivf = {k: z[k] for k in z.files}
+            self._ivf_mtime = mtime
+        ivf = self._ivf
+        cells = _topk(ivf["centroids"] @ q, VECTOR_IVF_NPROBE)
+        parts = [ivf["rows"][ivf["offsets"][c]:ivf["offsets"][c + 1]] for c in cells.tolist()]
+        parts.append(np.arange(int(ivf["built_rows"]), self._mm.shape[0], dtype=np.int64))
+        return np.sort(np.concatenate(parts))
+
+
+@lru_cache(maxsize=1)
+def get_store() -> VectorStore:
+    """The process-wide vector store selected by VECTOR_BACKEND."""
+    if VECTOR_BACKEND == "mmap":
+        return MmapStore()
+    return ChromaStore()
+
+_generation: Optional[int] = None  # index generation at the last refresh_store() call
+
+def refresh_store(generation: int):
+    """
+    For read-only processes (the UI), before each search: reopen the store once the index
+    generation has moved on, so vectors the worker wrote since are seen.
+    """
+    global _generation
+    if _generation is not None and generation != _generation and get_store.cache_info().currsize:
+        get_store().reopen()
+    _generation = generation
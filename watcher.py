@@ -0,0 +1,312 @@
+import ctypes, ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import SUPPORTED_EXTS, WATCH_BACKEND, WATCH_DEBOUNCE_S, WATCH_MAX_WAIT_S, WATCH_POLL_S
+
+# Watch mode: keep a root indexed as files change, without walking the tree.
+#
+# A watcher collects created/modified/deleted paths and OS-reported renames, debounces them (a
+# copy of 500 photos arrives as one batch) and hands them to ingest.ingest_changes, which diffs
+# only those paths against the manifest. Renames re-point rows and vectors in place.
+#   inotify (Linux) - one watch per directory; new directories are watched as they appear. If the
+#                     kernel queue overflows, events were lost and the next batch is a full rescan.
+#   polling         - stats every directory each WATCH_POLL_S and lists only those whose mtime
+#                     changed. Directory mtimes don't change when a file is rewritten in place,
+#                     so such edits are picked up by the next full index run only.
+# The worker (worker.py) runs the watchers between queued jobs, so there is still a single writer.
+
+log = logging.getLogger("watcher")
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# IN_MODIFY is left out on purpose: IN_CLOSE_WRITE marks the end of a write
+_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+         | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len; followed by the NUL-padded name
+
+def _wanted(path: str, isdir: bool) -> bool:
+    return isdir or os.path.splitext(path)[1].lower() in SUPPORTED_EXTS
+
+class _Watcher:
+    """Debounced change set shared by both backends; subclasses implement _read(timeout)."""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self._reset()
+
+    def _reset(self):
+        self.touched: Set[str] = set()
+        self.moves: List[Tuple[str, str]] = []
+        self.rescan = False
+        self._first: Optional[float] = None
+        self._last: Optional[float] = None
+
+    def _mark(self):
+        now = time.monotonic()
+        if self._first is None:
+            self._first = now
+        self._last = now
+
+    def _read(self, timeout: float):
+        raise NotImplementedError
+
+    def _flush(self) -> dict:
+        changes = {"touched": sorted(self.touched), "moves": list(self.moves), "rescan": self.rescan}
+        self._reset()
+        return changes
+
+    def changes(self, timeout: float) -> Optional[dict]:
+        """Wait up to `timeout` for events; returns {"touched", "moves", "rescan"} once a batch has settled."""
+        self._read(timeout)
+        if self._first is None:
+            return None
+        now = time.monotonic()
+        if now - self._last >= WATCH_DEBOUNCE_S or now - self._first >= WATCH_MAX_WAIT_S:
+            return self._flush()
+        return None
+
+    def close(self):
+        pass
+
+class InotifyWatcher(_Watcher):
+    def __init__(self, root: str):
+        super().__init__(root)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.wds: Dict[int, str] = {}
+        self._moved_from: Dict[int, Tuple[str, bool]] = {}  # cookie -> (path, isdir)
+        try:
+            self._watch_tree(self.root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _watch_tree(self, top: str):
+        for d, _, _ in os.walk(top):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(d), _MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if d == top or err == 28:  # ENOSPC: fs.inotify.max_user_watches is too low
+                    raise OSError(err, f"inotify_add_watch failed for {d}")
+                continue  # e.g. removed meanwhile
+            self.wds[wd] = d
+
+    def _watch_new(self, path: str):
+        try:
+            self._watch_tree(path)
+        except OSError as e:
+            # gone already, or out of watches: events below `path` may be missed
+            if e.errno == 28:
+                log.warning("%s; raise fs.inotify.max_user_watches", e)
+
+    def _unwatch_tree(self, top: str):
+        prefix = top.rstrip(os.sep) + os.sep
+        for wd, d in list(self.wds.items()):
+            if d == top or d.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                self.wds.pop(wd, None)
+
+    def _rename_tree(self, old: str, new: str):
+        prefix = old.rstrip(os.sep) + os.sep
+        for wd, d in list(self.wds.items()):
+            if d == old:
+                self.wds[wd] = new
+            elif d.startswith(prefix):
+                self.wds[wd] = os.path.join(new, d[len(prefix):])
+
+    def _read(self, timeout: float):
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+        off = 0
+        while off + _EVENT.size <= len(data):
+            wd, mask, cookie, n = _EVENT.unpack_from(data, off)
+            name = os.fsdecode(data[off + _EVENT.size:off + _EVENT.size + n].rstrip(b"\0"))
+            off += _EVENT.size + n
+            self._event(wd, mask, cookie, name)
+
+    def _event(self, wd: int, mask: int, cookie: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self.rescan = True
+            self._mark()
+            return
+        if mask & IN_IGNORED:
+            self.wds.pop(wd, None)
+            return
+        base = self.wds.get(wd)
+        if base is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            return  # reported by the parent directory's watch
+        path = os.path.join(base, name) if name else base
+        isdir = bool(mask & IN_ISDIR)
+        if mask & IN_MOVED_FROM:
+            self._moved_from[cookie] = (path, isdir)
+        elif mask & IN_MOVED_TO:
+            src = self._moved_from.pop(cookie, None)
+            if src is None:
+                # moved in from outside the root
+                if isdir:
+                    self._watch_new(path)
+                if _wanted(path, isdir):
+                    self.touched.add(path)
+            else:
+                if isdir:
+                    self._rename_tree(src[0], path)
+                self.moves.append((src[0], path))
+        elif mask & (IN_CREATE | IN_CLOSE_WRITE | IN_DELETE):
+            if isdir and mask & IN_CREATE:
+                self._watch_new(path)  # files created before the watch are found by the scan of `path`
+            if not _wanted(path, isdir):
+                return
+            self.touched.add(path)
+        else:
+            return
+        self._mark()
+
+    def _flush(self) -> dict:
+        # a rename whose other half never came moved the file out of the root: a delete
+        for path, isdir in self._moved_from.values():
+            if isdir:
+                self._unwatch_tree(path)
+            if _wanted(path, isdir):
+                self.touched.add(path)
+        self._moved_from.clear()
+        return super()._flush()
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(_Watcher):
+    def __init__(self, root: str, interval: float = WATCH_POLL_S):
+        super().__init__(root)
+        self.interval = interval
+        self._next = time.monotonic() + interval
+        # directory -> (mtime, {name: (isdir, size, mtime)} of its subdirectories and photos)
+        self.dirs: Dict[str, Tuple[float, dict]] = {}
+        self._snap_tree(self.root)
+
+    def _list(self, d: str) -> Optional[Tuple[float, dict]]:
+        try:
+            mtime = os.stat(d).st_mtime
+            entries = {}
+            with os.scandir(d) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            entries[e.name] = (True, 0, 0.0)
+                        elif _wanted(e.name, False):
+                            st = e.stat()
+                            entries[e.name] = (False, st.st_size, st.st_mtime)
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return mtime, entries
+
+    def _snap_tree(self, top: str):
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            snap = self._list(d)
+            if snap is None:
+                continue
+            self.dirs[d] = snap
+            stack.extend(os.path.join(d, n) for n, (isdir, _, _) in snap[1].items() if isdir)
+
+    def _drop_tree(self, top: str):
+        prefix = top.rstrip(os.sep) + os.sep
+        for d in [d for d in self.dirs if d == top or d.startswith(prefix)]:
+            del self.dirs[d]
+
+    def _read(self, timeout: float):
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(max(0.0, timeout))
+            return
+        time.sleep(max(0.0, wait))
+        self._next = time.monotonic() + self.interval
+        for d, (mtime, entries) in list(self.dirs.items()):
+            if d not in self.dirs:
+                continue  # dropped with a removed parent during this pass
+            try:
+                if os.stat(d).st_mtime == mtime:
+                    continue
+            except OSError:
+                continue  # removed: its parent's listing reports it
+            snap = self._list(d)
+            if snap is None:
+                continue
+            self.dirs[d] = snap
+            new = snap[1]
+            for name in entries.keys() | new.keys():
+                before, after = entries.get(name), new.get(name)
+                if before == after:
+                    continue
+                path = os.path.join(d, name)
+                if before is not None and before[0]:
+                    self._drop_tree(path)
+                if after is not None and after[0]:
+                    self._snap_tree(path)
+                self.touched.add(path)
+                self._mark()
+
+def open_watcher(root: str) -> _Watcher:
+    """An inotify watcher where available (and WATCH_BACKEND allows), else a polling one."""
+    if WATCH_BACKEND != "poll" and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            if WATCH_BACKEND == "inotify":
+                raise
+            log.warning("inotify unavailable for %s (%s); polling every %.0fs", root, e, WATCH_POLL_S)
+    return PollingWatcher(root)
+
+# Duplicate index shared by every watcher and kept between batches, so a batch of a few photos doesn't
+# rebuild it from the whole table; it is dropped after anything else changed the library.
+_dedup = None
+
+def reset_dedup():
+    """Forget the kept duplicate index (after an indexing job, a rescan or a failed batch)."""
+    global _dedup
+    _dedup = None
+
+def apply(w: _Watcher, changes: dict) -> int:
+    """Index one settled batch of changes; returns the number of photos added."""
+    global _dedup
+    from ingest import ingest_changes, ingest_folder, load_dedup_index
+    if changes["rescan"]:
+        log.info("%s: event queue overflowed, rescanning", w.root)
+        reset_dedup()
+        return ingest_folder(w.root)
+    log.info("%s: %d changed path(s), %d rename(s)", w.root, len(changes["touched"]), len(changes["moves"]))
+    if _dedup is None:
+        _dedup = load_dedup_index()
+    try:
+        return ingest_changes(changes["touched"], changes["moves"], root=w.root, dedup=_dedup)
+    except BaseException:
+        reset_dedup()  # may hold refs of photos that were never written
+        raise
@@ -0,0 +1,127 @@
+import logging
+import sys
+import threading
+import time
+
+from config import WATCH_ROOTS, VECTOR_BACKEND
+import jobs
+import thumbstore
+import watcher
+from ingest import ingest_folder, relabel_faces
+from vectorstore import get_store
+
+# Background indexing worker: `python worker.py [--watch ROOT ...]` (the UI starts one when none
+# is running). Runs queued jobs one at a time (see jobs.py) and is the only process that writes
+# the vector store (embedded Chroma is not safe to share between processes). Only one worker per
+# data directory: a second instance exits right away. A daemon thread keeps a heartbeat in the
+# meta table so the UI can tell whether a worker is alive. Between jobs it applies the changes
+# seen by its watchers (--watch roots and WATCH_ROOTS, see watcher.py). As the only writer, it
+# also does the upkeep of the vector store and the thumbnail packs after each job or watch batch;
+# `python worker.py --maintain` does it once and exits.
+
+log = logging.getLogger("worker")
+
+POLL_S = 1.0
+
+def _beat():
+    while True:
+        try:
+            jobs.heartbeat()
+        except Exception:
+            log.debug("heartbeat failed", exc_info=True)
+        time.sleep(jobs.HEARTBEAT_S)
+
+def _run(job: dict, hooks: jobs.JobHooks) -> str:
+    if job["kind"] == "relabel":
+        log.info("job %d: re-labeling faces", job["id"])
+        n = relabel_faces()
+        hooks.progress({"phase": "relabeling", "processed": n, "final": True})
+        return f"{n} faces re-labeled"
+    log.info("job %d: indexing %s", job["id"], job["root"])
+    added = ingest_folder(job["root"], progress=hooks.progress, control=hooks.control)
+    return f"{added} photos added"
+
+def run_job(job: dict):
+    hooks = jobs.JobHooks(job["id"])
+    try:
+        result = _run(job, hooks)
+    except jobs.JobCancelled:
+        jobs.finish(job["id"], "cancelled")
+        log.info("job %d: cancelled", job["id"])
+    except Exception as e:
+        jobs.finish(job["id"], "failed", error=f"{type(e).__name__}: {e}")
+        log.exception("job %d: failed", job["id"])
+    else:
+        jobs.finish(job["id"], "done")
+        log.info("job %d: done, %s", job["id"], result)
+
+def maintain():
+    """
+    Upkeep of the stores only this process writes, when due: compaction / IVF (re)build of the mmap
+    vector store (see MmapStore.maintain) and compaction of the thumbnail packs (thumbstore.maintain).
+    """
+    if VECTOR_BACKEND == "mmap":
+        try:
+            for step in get_store().maintain():
+                log.info("vectors: %s", step)
+        except Exception:
+            log.exception("vector store maintenance failed")
+    try:
+        for step in thumbstore.maintain():
+            log.info("thumbnails: %s", step)
+    except Exception:
+        log.exception("thumbnail maintenance failed")
+
+def _watch_roots(argv) -> list:
+    roots = list(WATCH_ROOTS)
+    for i, a in enumerate(argv):
+        if a == "--watch" and i + 1 < len(argv):
+            roots.append(argv[i + 1])
+    return roots
+
+def run_watchers(watchers, timeout: float):
+    for w in watchers:
+        changes = w.changes(timeout / len(watchers))
+        if changes is None:
+            continue
+        try:
+            added = watcher.apply(w, changes)
+            log.info("%s: %d photos added", w.root, added)
+        except Exception:
+            log.exception("%s: applying changes failed", w.root)
+        maintain()
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    argv = sys.argv[1:] if argv is None else argv
+    lock = jobs.worker_lock()
+    if lock is None:
+        if "--maintain" in argv:
+            log.info("a worker is running; it maintains the stores itself")
+            return 1
+        log.info("another worker is already running")
+        return 0
+    if "--maintain" in argv:
+        maintain()
+        return 0
+    n = jobs.requeue_orphans()
+    if n:
+        log.info("re-queued %d interrupted job(s)", n)
+    threading.Thread(target=_beat, name="worker-heartbeat", daemon=True).start()
+    # watching starts before the first job, so nothing that changes during it is lost
+    watchers = [watcher.open_watcher(r) for r in _watch_roots(argv)]
+    for w in watchers:
+        log.info("watching %s (%s)", w.root, type(w).__name__)
+    while True:
+        job = jobs.claim_next()
+        if job is not None:
+            run_job(job)
+            watcher.reset_dedup()
+            maintain()
+        elif watchers:
+            run_watchers(watchers, POLL_S)
+        else:
+            time.sleep(POLL_S)
+
+if __name__ == "__main__":
+    sys.exit(main())
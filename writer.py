@@ -0,0 +1,179 @@
+import logging
+from typing import List, Optional
+
+from sqlalchemy import insert
+
+from config import WRITE_RETRIES, VECTOR_CHUNK, RED_SHIRT_MIN_RATIO
+from db import Image as ImageRow, Face as FaceRow, bump_index_generation
+import captions
+import fts
+import geo
+import face_store
+import openai_helpers
+import thumbstore
+
+log = logging.getLogger(__name__)
+
+# Batched writer for the ingest pipeline's writer stage.
+#
+# One batch = one SQLite transaction (executemany inserts for images, FTS/R*Tree rows, thumbnail
+# index, caption/tag caches, faces) plus chunked vector upserts. Vectors go first; if anything after
+# that fails, the transaction is rolled back and the batch's vectors are deleted again, so SQLite
+# and the vector store never disagree about a batch.
+# The whole unit is retried up to WRITE_RETRIES times; then BatchWriteError stops the run, which
+# fails instead of reporting success with nothing stored (the batch's files are not in the
+# manifest, so the next run picks them up again).
+
+class BatchWriteError(Exception):
+    """A batch could not be written after WRITE_RETRIES attempts (disk full, schema mismatch, ...)."""
+
+def _chunks(seq, n):
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+def _image_values(it: dict) -> dict:
+    ts = it.get("ts")
+    gps = it.get("gps")
+    return {
+        "path": str(it["path"]),
+        "ts": ts,
+        "year": ts.year if ts else None,
+        "month": ts.month if ts else None,
+        "day": ts.day if ts else None,
+        "gps": f"{gps[0]:.6f},{gps[1]:.6f}" if gps else "",
+        "lat": gps[0] if gps else None,
+        "lon": gps[1] if gps else None,
+        "width": it.get("w"),
+        "height": it.get("h"),
+        "caption": it.get("caption"),
+        "clip_id": str(it["path"]) if it.get("clip_emb") is not None else None,
+        "tags": it.get("tags"),
+        "file_size": it.get("size"),
+        "file_mtime": it.get("mtime"),
+        "content_hash": it.get("hash"),
+        "phash": it.get("phash"),
+        "dhash": it.get("dhash"),
+        "dup_group": it.get("dup_group"),
+    }
+
+def vector_metadata(ts, faces) -> dict:
+    """
+    Filterable metadata stored with each vector so search can push date/person/red-shirt
+    constraints into the vector query. `faces` is a list of (person_name, red_ratio).
+    Persons become boolean keys ("person:Daniel", "red:Daniel" for a red shirt on that face).
+    """
+    md = {"red_shirt": False}
+    if ts is not None:
+        md.update(year=ts.year, month=ts.month, day=ts.day, date=ts.year * 10000 + ts.month * 100 + ts.day)
+    for name, red_ratio in faces:
+        red = (red_ratio or 0.0) >= RED_SHIRT_MIN_RATIO
+        if red:
+            md["red_shirt"] = True
+        if name:
+            md[f"person:{name}"] = True
+            if red:
+                md[f"red:{name}"] = True
+    return md
+
+def sync_vector_metadata(sess, store, image_ids=None, cleared_names=()):
+    """
+    Recompute vector metadata from SQLite for the given images (all when None), e.g. after faces
+    were re-labeled. `cleared_names` are person names that may have been removed from these
+    images; their keys are set to False because metadata updates merge rather than replace.
+    """
+    q = sess.query(ImageRow.id, ImageRow.clip_id, ImageRow.ts).filter(ImageRow.clip_id.isnot(None))
+    if image_ids is not None:
+        image_ids = list(image_ids)
+    chunks = [None] if image_ids is None else list(_chunks(image_ids, 1000))
+    for chunk in chunks:
+        rows = (q if chunk is None else q.filter(ImageRow.id.in_(chunk))).all()
+        faces = {}
+        fq = sess.query(FaceRow.image_id, FaceRow.person_name, FaceRow.red_ratio)
+        if chunk is not None:
+            fq = fq.filter(FaceRow.image_id.in_(chunk))
+        for image_id, name, rr in fq.all():
+            faces.setdefault(image_id, []).append((name, rr))
+        for part in _chunks(rows, VECTOR_CHUNK):
+            metas = []
+            for id_, _, ts in part:
+                md = {f"{k}:{n}": False for n in cleared_names for k in ("person", "red")}
+                md.update(vector_metadata(ts, faces.get(id_, [])))
+                metas.append(md)
+            store.update(ids=[r[1] for r in part], metadatas=metas)
+
+def _upsert_vectors(store, batch: List[dict]) -> List[str]:
+    vec = [it for it in batch if it.get("clip_emb") is not None]
+    done: List[str] = []
+    for chunk in _chunks(vec, VECTOR_CHUNK):
+        ids = [str(it["path"]) for it in chunk]
+        store.upsert(
+            ids=ids,
+            embeddings=[it["clip_emb"] for it in chunk],
+            documents=[it.get("caption") or "" for it in chunk],
+            metadatas=[
+                vector_metadata(it.get("ts"), [(f.get("name"), f.get("red_ratio")) for f in it.get("faces") or []])
+                for it in chunk
+            ],
+        )
+        done.extend(ids)
+    return done
+
+def _insert_rows(sess, batch: List[dict]):
+    values = [_image_values(it) for it in batch]
+    stmt = insert(ImageRow).returning(ImageRow.id, sort_by_parameter_order=True)
+    ids = sess.execute(stmt, values).scalars().all()
+    fts.index_rows(sess, [(i, v["path"], v["caption"], v["tags"]) for i, v in zip(ids, values)])
+    geo.index_rows(sess, [(i, v["lat"], v["lon"]) for i, v in zip(ids, values)])
+    thumbstore.append(sess, [(v["path"], it.get("thumb")) for it, v in zip(batch, values)])
+    captions.remember_captions(sess, [(it.get("hash"), it.get("caption")) for it in batch if it.get("caption_new")])
+    openai_helpers.remember_tags(sess, [(it.get("hash"), it.get("tags")) for it in batch if it.get("tags_new")])
+
+    face_rows, face_embs = [], []
+    for it, image_id in zip(batch, ids):
+        for f in it.get("faces") or []:
+            face_rows.append({
+                "image_id": image_id,
+                "person_name": f.get("name") or None,
+                "bbox": ",".join(map(str, f["bbox"])),
+                "red_ratio": f.get("red_ratio"),
+            })
+            face_embs.append(f.get("embedding"))
+    if not face_rows:
+        return [], []
+    stmt = insert(FaceRow).returning(FaceRow.id, sort_by_parameter_order=True)
+    face_ids = sess.execute(stmt, face_rows).scalars().all()
+    keep = [(i, e) for i, e in zip(face_ids, face_embs) if e is not None]
+    return [i for i, _ in keep], [e for _, e in keep]
+
+def write_batch(sess, store, batch: List[dict]) -> int:
+    """Write one processed batch as a unit. Returns the number of images stored; raises BatchWriteError."""
+    if not batch:
+        return 0
+    error: Optional[Exception] = None
+    for attempt in range(1, WRITE_RETRIES + 1):
+        vec_ids: List[str] = []
+        try:
+            vec_ids = _upsert_vectors(store, batch)
+            face_ids, face_embs = _insert_rows(sess, batch)
+            bump_index_generation(sess)
+            sess.commit()
+            break
+        except Exception as e:
+            error = e
+            sess.rollback()
+            if vec_ids:
+                try:
+                    store.delete(ids=vec_ids)
+                except Exception:
+                    log.exception("could not roll back %d vectors", len(vec_ids))
+            log.warning("batch write failed (attempt %d/%d)", attempt, WRITE_RETRIES, exc_info=True)
+    else:
+        raise BatchWriteError(f"could not write a batch of {len(batch)} images after {WRITE_RETRIES} "
+                              f"attempts: {type(error).__name__}: {error}") from error
+
+    # Face embeddings are keyed by the committed faces.id, so they are stored after the commit
+    try:
+        face_store.write(face_ids, face_embs)
+    except Exception:
+        log.exception("could not store %d face embeddings", len(face_ids))
+    return len(batch)